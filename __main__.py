@@ -1,18 +1,97 @@
-from game.board import Board
+import argparse
 
-def main():
-    board = Board(Board.LAN)
+from game.bitboard import SYMBOLS, decode_position
+from game.board import Board
+from game.renderer import TerminalRenderer
+from globals import MULTIPLAYER_PORT, SPECTATOR_PORT
+from lan.connection import Connection
+from lan.lan import check_lan_servers
+from lan.multiplayer_game import MultiplayerGame
+from lan.spectator_service import SPECTATE_MESSAGE
 
+def play_game(board: Board):
+    '''
+    Play one game to the end.
+    Returns:
+        True if the local player won, False if the opponent won, None for a cat's game.
+    '''
     while True:
         board.print()
         board.next_turn()
         if board.winner:
-            break
+            winner = board.player_x if board.winner == board.player_x.symbol else board.player_o
+            return winner.mode == MultiplayerGame.LOCAL
         if board.cat:
             board.print()
             print('Cat\'s game!')
-            break
+            return None
+
+def spectate():
+    '''
+    Find a game on the LAN and watch it until the host closes the connection.
+    '''
+    print('Searching for games to watch...')
+    # Only games in progress answer as spectatable. A host still waiting for its opponent does not.
+    hosts = check_lan_servers(MULTIPLAYER_PORT, first_response=True,
+                              accept=lambda host: host.server_info['message'] == SPECTATE_MESSAGE)
+    if not hosts:
+        print('No games to watch.')
+        return
+    connection = Connection(ip=hosts[0]._ip, port=SPECTATOR_PORT)
+    connection.tcp_connect()
+    if not connection.is_connected():
+        print('Could not connect to the game.')
+        return
+
+    renderer = TerminalRenderer()
+    while connection.dynamic_receive():
+        for msg in connection.get_recvd_messages():
+            board = decode_position(msg)
+            grid = [[board.symbol_at(row * board.width + col) for col in range(board.width)] for row in range(board.height)]
+            renderer.render(grid)
+            winner = board.winner()
+            if winner is not None:
+                renderer.message(f'{SYMBOLS[winner]} wins!')
+            elif board.is_full():
+                renderer.message('Cat\'s game!')
+        connection.clear_recvd_messages()
+    print('The host closed the game.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play tic-tac-toe over the LAN.')
+    parser.add_argument('--best-of', type=int, default=1, help='play a series of up to this many games against the same opponent. The choice of the player who is X in the first game is used')
+    parser.add_argument('--spectate', action='store_true', help='watch a game on the LAN instead of playing')
+    args = parser.parse_args()
+    if args.spectate:
+        spectate()
+        return
+
+    board = Board(Board.LAN)
+    # The first game's X player decides the series length. Roles are known on both sides, even
+    # through a MatchServer where neither player is the host.
+    if board.player_x.mode == MultiplayerGame.LOCAL:
+        best_of = args.best_of
+        board.send_to_peer(str(best_of))
+    else:
+        best_of = int(board.receive_from_peer())
+
+    wins = losses = 0
+    for game in range(best_of):
+        if game > 0:
+            board.rematch()
+        result = play_game(board)
+        if result is True:
+            wins += 1
+        elif result is False:
+            losses += 1
+        if best_of > 1:
+            print(f'Series: you {wins}, opponent {losses}')
+            # Both peers see the same results, so they stop after the same game.
+            if max(wins, losses) > best_of // 2:
+                break
+    board.stop_spectator_service()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,398 @@
+'''
+Benchmark suite for game logic, framing and discovery.
+Everything runs locally on loopback sockets with no external services.
+
+Usage (from the repository root):
+    python -m benchmarks.bench                          Run everything and print JSON.
+    python -m benchmarks.bench --output results.json    Also save the results.
+    python -m benchmarks.bench --compare baseline.json  Flag regressions against a saved run.
+    python -m benchmarks.bench --only frame             Run only benchmarks whose name contains 'frame'.
+'''
+
+import argparse
+import json
+import math
+import platform
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+
+from game.analysis_server import AnalysisClient, AnalysisServer
+from game.bitboard import BitBoard
+from game.board import Board
+from game.mcts import MCTSEngine
+from lan.broadcast_responder import BroadcastResponder
+from lan.client_handler import ClientHandler
+from lan.connection import Connection
+from lan.lan import check_lan_servers
+
+FRAME_PAYLOAD_SIZES = (16, 1024, 65536)
+FANOUT_CLIENTS = (1, 8, 32)
+SPECTATORS = 100
+DRAIN_FRAMES = 10
+DISCOVERY_PORT = 42380
+ANALYSIS_BATCH = 1000
+
+
+def measure(func, repeat=5):
+    '''
+    Run func repeat times and return the median of the values it returns.
+    '''
+    return statistics.median(func() for _ in range(repeat))
+
+
+def result(value, unit, higher_is_better) -> dict:
+    return {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+# Game logic
+
+def bench_check_winner(iterations) -> dict:
+    board = Board()
+    for row, col in ((0, 0), (1, 1), (0, 1), (2, 2), (1, 0)):
+        board.play_move(row, col)
+
+    def run():
+        start = time.perf_counter()
+        for _ in range(iterations):
+            board.check_winner()
+        return iterations / (time.perf_counter() - start)
+
+    return {'board.check_winner': result(measure(run), 'calls/s', True)}
+
+
+def bench_full_games(games) -> dict:
+    rng = random.Random(0)
+
+    def run():
+        start = time.perf_counter()
+        for _ in range(games):
+            board = Board()
+            while not board.is_over():
+                row, col = divmod(rng.choice(board.bitboard.legal_moves()), board.width)
+                board.play_move(row, col)
+        return games / (time.perf_counter() - start)
+
+    return {'board.random_games': result(measure(run), 'games/s', True)}
+
+
+def bench_position_hash(iterations) -> dict:
+    board = Board()
+    for row, col in ((0, 0), (1, 1), (0, 1), (2, 2), (1, 0)):
+        board.play_move(row, col)
+
+    def run():
+        start = time.perf_counter()
+        for _ in range(iterations):
+            board.canonical_hash()
+        return iterations / (time.perf_counter() - start)
+
+    return {'board.canonical_hash': result(measure(run), 'calls/s', True)}
+
+
+def bench_mcts(iterations) -> dict:
+    '''
+    MCTS iterations per second from the empty 7x7 board with a win length of 4, in one process.
+    '''
+    def run():
+        engine = MCTSEngine(time_limit=None, iterations=iterations, seed=0)
+        start = time.perf_counter()
+        engine.choose_move(BitBoard(7, 7, 4), 0)
+        return iterations / (time.perf_counter() - start)
+
+    return {'mcts.iterations': result(measure(run), 'iterations/s', True)}
+
+
+# Framing
+
+def bench_frame_round_trip(iterations) -> dict:
+    results = {}
+    for size in FRAME_PAYLOAD_SIZES:
+        sock_a, sock_b = socket.socketpair()
+        a = Connection(socket=sock_a)
+        b = Connection(socket=sock_b)
+        payload = 'x' * size
+
+        def echo():
+            for _ in range(iterations * 5):
+                while not b.dynamic_receive():
+                    pass
+                b.dynamic_send(b.get_recvd_messages().pop())
+
+        # The echo thread answers every round trip of every repeat measure() makes.
+        echo_thread = threading.Thread(target=echo)
+        echo_thread.start()
+
+        def run():
+            start = time.perf_counter()
+            for _ in range(iterations):
+                a.dynamic_send(payload)
+                while not a.dynamic_receive():
+                    pass
+                a.clear_recvd_messages()
+            return (time.perf_counter() - start) / iterations
+
+        results[f'connection.round_trip.{size}'] = result(measure(run), 's', False)
+        echo_thread.join()
+        sock_a.close()
+        sock_b.close()
+    return results
+
+
+def bench_client_handler(iterations) -> dict:
+    results = {}
+    for n_clients in FANOUT_CLIENTS:
+        # No accept delay, so the accept timing measures accepting rather than the wait for a connection.
+        handler = ClientHandler(0, socket_accept_delay=0)
+        port = handler._socket.getsockname()[1]
+
+        start = time.perf_counter()
+        clients = []
+        for _ in range(n_clients):
+            client = Connection(ip='127.0.0.1', port=port)
+            client.tcp_connect()
+            clients.append(client)
+            # The listen backlog is small, so accept as clients arrive.
+            while len(handler._clients) < len(clients):
+                handler.accept_clients()
+        results[f'client_handler.accept.{n_clients}'] = result(n_clients / (time.perf_counter() - start), 'clients/s', True)
+
+        def run():
+            start = time.perf_counter()
+            for _ in range(iterations):
+                handler.send_tcp_all_clients('0,0')
+                for client in clients:
+                    while not client.dynamic_receive():
+                        pass
+                    client.clear_recvd_messages()
+            return (time.perf_counter() - start) / iterations
+
+        results[f'client_handler.fanout.{n_clients}'] = result(measure(run), 's', False)
+
+        def drain():
+            for client in clients:
+                for _ in range(DRAIN_FRAMES):
+                    client.dynamic_send('0,0')
+            start = time.perf_counter()
+            received = 0
+            while received < n_clients * DRAIN_FRAMES:
+                handler.receive_tcp_all_clients()
+                received += len(handler.get_recvd_messages())
+                handler.clear_recvd_messages()
+            return time.perf_counter() - start
+
+        results[f'client_handler.drain.{n_clients}'] = result(measure(drain), 's', False)
+        for client in clients:
+            client.close_socket()
+        handler.close_socket()
+    return results
+
+
+def bench_spectators(iterations) -> dict:
+    '''
+    Broadcast to SPECTATORS watchers while one of them never reads.
+    '''
+    handler = ClientHandler(0, spectator_port=0)
+    port = handler._spectator_socket.getsockname()[1]
+    watchers = []
+    for _ in range(SPECTATORS):
+        watchers.append(socket.create_connection(('127.0.0.1', port)))
+        while handler.spectator_count() < len(watchers):
+            handler.accept_spectators()
+    # watchers[0] is the stalled one.
+    for watcher in watchers[1:]:
+        watcher.setblocking(False)
+    payload = 'x' * 1024
+
+    def run():
+        elapsed = 0.0
+        for _ in range(iterations):
+            start = time.perf_counter()
+            handler.broadcast_to_spectators(payload)
+            elapsed += time.perf_counter() - start
+            for watcher in watchers[1:]:
+                try:
+                    while watcher.recv(1 << 16):
+                        pass
+                except BlockingIOError:
+                    pass
+        return elapsed / iterations
+
+    try:
+        latency = measure(run)
+    finally:
+        for watcher in watchers:
+            watcher.close()
+        handler.close_spectators()
+        handler.close_socket()
+    return {f'client_handler.spectator_broadcast.{SPECTATORS}': result(latency, 's', False)}
+
+
+# Analysis
+
+def bench_analysis(iterations) -> dict:
+    '''
+    Round trips of ANALYSIS_BATCH random 3x3 positions to an AnalysisServer, with an empty and a warm cache.
+    '''
+    rng = random.Random(0)
+    batch = []
+    for _ in range(ANALYSIS_BATCH):
+        board = BitBoard()
+        for ply in range(rng.randrange(8)):
+            move = rng.choice(board.legal_moves())
+            board.place(move, ply % 2)
+            if board.has_won_at(move, ply % 2):
+                break
+        batch.append(board)
+
+    server = AnalysisServer(port=0, processes=0)
+    stop = threading.Event()
+
+    def serve():
+        while not stop.is_set():
+            server.run_once(0.05)
+
+    server_thread = threading.Thread(target=serve)
+    server_thread.start()
+    client = AnalysisClient(port=server._socket.getsockname()[1])
+
+    def run(cold):
+        elapsed = 0.0
+        for _ in range(iterations):
+            if cold:
+                server.cache.clear()
+            start = time.perf_counter()
+            client.analyze(batch)
+            elapsed += time.perf_counter() - start
+        return iterations * ANALYSIS_BATCH / elapsed
+
+    try:
+        results = {
+            'analysis.cold': result(measure(lambda: run(True)), 'positions/s', True),
+            'analysis.warm': result(measure(lambda: run(False)), 'positions/s', True),
+        }
+    finally:
+        client.close()
+        stop.set()
+        server_thread.join()
+        server.close()
+    return results
+
+
+# Discovery
+
+def bench_discovery(iterations, port=DISCOVERY_PORT) -> dict:
+    responder = BroadcastResponder(port)
+    # Answer every broadcast; the benchmark asks repeatedly from the same address.
+    responder._recent_request_limit = 0
+    stop = threading.Event()
+
+    def respond():
+        while not stop.is_set():
+            responder.respond_to_broadcast('ping')
+
+    responder_thread = threading.Thread(target=respond)
+    responder_thread.start()
+
+    def run():
+        start = time.perf_counter()
+        found = 0
+        for _ in range(iterations):
+            found += len(check_lan_servers(port, first_response=True))
+        elapsed = time.perf_counter() - start
+        if found < iterations:
+            return float('nan')
+        return elapsed / iterations
+
+    try:
+        latency = measure(run, repeat=3)
+    finally:
+        stop.set()
+        responder_thread.join()
+        responder.close_socket()
+    return {'discovery.first_response': result(latency, 's', False)}
+
+
+BENCHMARKS = {
+    'check_winner': lambda quick: bench_check_winner(20000 if quick else 200000),
+    'full_games': lambda quick: bench_full_games(500 if quick else 5000),
+    'position_hash': lambda quick: bench_position_hash(20000 if quick else 200000),
+    'mcts': lambda quick: bench_mcts(1000 if quick else 10000),
+    'frame_round_trip': lambda quick: bench_frame_round_trip(200 if quick else 2000),
+    'client_handler': lambda quick: bench_client_handler(20 if quick else 200),
+    'spectators': lambda quick: bench_spectators(50 if quick else 500),
+    'analysis': lambda quick: bench_analysis(2 if quick else 20),
+    'discovery': lambda quick: bench_discovery(5 if quick else 20),
+}
+
+
+def run_benchmarks(only=None, quick=False) -> dict:
+    results = {}
+    for name, bench in BENCHMARKS.items():
+        if only and only not in name:
+            continue
+        print(f'Running {name}...', file=sys.stderr)
+        results.update(bench(quick))
+    return {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': quick,
+        },
+        'results': results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    '''
+    Compare two runs.
+    Returns:
+        A list of (name, baseline value, current value, relative change) for every benchmark
+        that got worse by more than threshold. Positive change always means worse.
+    '''
+    regressions = []
+    for name, base in baseline['results'].items():
+        now = current['results'].get(name)
+        # Skip benchmarks that were not run or failed (NaN) in either run.
+        if now is None or not base['value'] or math.isnan(base['value']) or math.isnan(now['value']):
+            continue
+        change = (now['value'] - base['value']) / base['value']
+        if base['higher_is_better']:
+            change = -change
+        if change > threshold:
+            regressions.append((name, base['value'], now['value'], change))
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Run the benchmark suite.')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown counted as a regression')
+    parser.add_argument('--only', help='only run benchmarks whose name contains this')
+    parser.add_argument('--quick', action='store_true', help='fewer iterations')
+    args = parser.parse_args()
+
+    current = run_benchmarks(args.only, args.quick)
+    print(json.dumps(current, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        for name, base, now, change in regressions:
+            print(f'REGRESSION {name}: {base:.6g} -> {now:.6g} ({change:+.1%} worse)', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print('No regressions.', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,19 @@
 '''
 Module for debug logging.
+Messages take printf-style arguments that are only formatted if the level is enabled,
+so disabled log calls cost a comparison and nothing else.
 '''
 
+import collections
+import queue
+import sys
+import threading
+
 class dLog:
     '''
     A class for logging messages to the console.
     Has 3 separate log levels.
+    Output goes to a list of sinks. A sink is any callable taking one formatted line.
     '''
 
     LOGLEVEL_DEBUG = 0
@@ -14,23 +22,112 @@ class dLog:
     LOGLEVEL_ERROR = 3
     LOGLEVEL_QUIET = 4
 
-    def __init__(self, loglevel=LOGLEVEL_ERROR):
+    def __init__(self, loglevel=LOGLEVEL_ERROR, sinks=None):
         self._loglevel = loglevel
         self._debug = False
+        self._sinks = [print] if sinks is None else list(sinks)
+
+    def set_loglevel(self, loglevel) -> None:
+        self._loglevel = loglevel
+
+    def is_enabled(self, loglevel) -> bool:
+        '''
+        Use as a guard around log calls whose arguments are expensive to compute.
+        '''
+        return self._loglevel <= loglevel
+
+    def add_sink(self, sink) -> None:
+        self._sinks.append(sink)
+
+    def remove_sink(self, sink) -> None:
+        self._sinks.remove(sink)
+
+    def _emit(self, prefix, message, args) -> None:
+        if args:
+            message = message % args
+        line = prefix + message
+        for sink in self._sinks:
+            sink(line)
 
     # Logging methods
-    def log_debug(self, message):
+    def log_debug(self, message, *args):
         if self._loglevel <= dLog.LOGLEVEL_DEBUG:
-            print("[DEBUG]: " + message)
+            self._emit("[DEBUG]: ", message, args)
 
-    def log_info(self, message):
+    def log_info(self, message, *args):
         if self._loglevel <= dLog.LOGLEVEL_INFO:
-            print("[INFO]: " + message)
-            
-    def log_warning(self, message):
+            self._emit("[INFO]: ", message, args)
+
+    def log_warning(self, message, *args):
         if self._loglevel <= dLog.LOGLEVEL_WARNING:
-            print("[WARNING]: " + message)
+            self._emit("[WARNING]: ", message, args)
 
-    def log_error(self, message):
+    def log_error(self, message, *args):
         if self._loglevel <= dLog.LOGLEVEL_ERROR:
-            print("[ERROR]: " + message)
+            self._emit("[ERROR]: ", message, args)
+
+
+class RingBufferSink:
+    '''
+    Keeps the most recent lines in memory instead of writing them anywhere.
+    '''
+
+    def __init__(self, capacity=1000):
+        self._lines = collections.deque(maxlen=capacity)
+
+    def __call__(self, line) -> None:
+        self._lines.append(line)
+
+    def lines(self) -> list:
+        return list(self._lines)
+
+    def clear(self) -> None:
+        self._lines.clear()
+
+
+class BackgroundWriter:
+    '''
+    Writes lines to a stream on a background thread, so logging never waits on console or file I/O.
+    '''
+
+    def __init__(self, stream=None):
+        '''
+        Args:
+            stream: a text stream or a file path. Defaults to sys.stdout.
+        '''
+        self._owns_stream = isinstance(stream, str)
+        self._stream = open(stream, 'a') if self._owns_stream else (stream or sys.stdout)
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name='BackgroundWriter', daemon=True)
+        self._thread.start()
+
+    def __call__(self, line) -> None:
+        self._queue.put(line)
+
+    def _run(self) -> None:
+        while True:
+            line = self._queue.get()
+            if line is None:
+                break
+            lines = [line]
+            # Write everything that is already queued in one go.
+            while True:
+                try:
+                    line = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if line is None:
+                    self._queue.put(None)
+                    break
+                lines.append(line)
+            self._stream.write('\n'.join(lines) + '\n')
+            self._stream.flush()
+
+    def close(self) -> None:
+        '''
+        Write any queued lines and stop the thread.
+        '''
+        self._queue.put(None)
+        self._thread.join()
+        if self._owns_stream:
+            self._stream.close()
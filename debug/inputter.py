@@ -1,38 +1,120 @@
 '''
 This module is for retrieving input from user.
 This comes in handy because it makes it super easy to retrieve input from a file for testing as if a user entered it.
+Each game can be given its own input source (ConsoleInput or ScriptedInput).
+The module level functions drive a single default source for code that does not pass one.
 '''
 
 TEST_MODE = 0
 RELEASE_MODE = 1
 
+
+class ConsoleInput:
+    '''
+    Reads input from the user.
+    '''
+
+    def get_input(self, prompt: str) -> str:
+        return input(prompt)
+
+
+class ScriptedInput:
+    '''
+    Replays input from a script, one line per call.
+    The file is opened once and read with a persistent iterator, so replaying n lines costs O(n).
+    '''
+
+    def __init__(self, lines, echo=True):
+        '''
+        Args:
+            lines: a file name or any iterable of lines.
+            echo: print each prompt and the replayed line, as if a user typed it.
+        '''
+        self._file = None
+        if isinstance(lines, str):
+            self._file = open(lines, 'r')
+            lines = self._file
+        self._lines = iter(lines)
+        self._echo = echo
+        self.line_number = 0
+
+    def get_input(self, prompt: str) -> str:
+        '''
+        Returns the next line of the script.
+        Raises EOFError when the script is exhausted, like input() at the end of stdin.
+        '''
+        try:
+            inp = next(self._lines).strip()
+        except StopIteration:
+            self.close()
+            raise EOFError('Test script exhausted')
+        self.line_number += 1
+        if self._echo:
+            print(f'{prompt}{inp}')
+        return inp
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> 'ScriptedInput':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def iter_scripts(file_name: str, echo=False):
+    '''
+    Lazily split one file into many game scripts separated by blank lines.
+    The file is read once from start to end, so thousands of games can be replayed back to back.
+    Yields:
+        A ScriptedInput for each game.
+    '''
+    with open(file_name, 'r') as f:
+        game = []
+        for line in f:
+            if line.strip():
+                game.append(line)
+            elif game:
+                yield ScriptedInput(game, echo)
+                game = []
+        if game:
+            yield ScriptedInput(game, echo)
+
+
 mode = RELEASE_MODE
 test_file = None
-file_line = 0
+_console = ConsoleInput()
+_script = None
 
 def set_test_file(file_name: str) -> None:
     global test_file
+    global _script
+    if _script is not None:
+        _script.close()
     test_file = file_name
+    _script = ScriptedInput(file_name)
 
 def set_mode(new_mode: int) -> None:
     global mode
     mode = new_mode
 
-def get_input(prompt: str) -> str:
+def get_source():
+    '''
+    Returns the default input source for the current mode.
+    '''
     if mode == TEST_MODE:
-        return test_input(prompt)
-    else:
-        return input(prompt)
+        if _script is None:
+            raise Exception('Test file not set')
+        return _script
+    return _console
+
+def get_input(prompt: str) -> str:
+    return get_source().get_input(prompt)
 
 def test_input(prompt: str) -> str:
-    global test_file
-    global file_line
-    if test_file is None:
+    if _script is None:
         raise Exception('Test file not set')
-    with open(test_file, 'r') as f:
-        for i in range(file_line):
-            f.readline()
-        file_line += 1
-        inp = f.readline().strip()
-        print(f'{prompt}{inp}')
-        return inp
\ No newline at end of file
+    return _script.get_input(prompt)
@@ -0,0 +1,199 @@
+'''
+Search engine used by AI players.
+Implements negamax with alpha-beta pruning, move ordering and a transposition table keyed by Zobrist hash.
+'''
+
+import time
+
+from game.bitboard import BitBoard
+
+WIN_SCORE = 10000
+
+# Transposition table entry flags
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+
+class SearchTimeout(Exception):
+    '''
+    Raised inside the search when the time budget runs out.
+    '''
+    pass
+
+
+class NegamaxEngine:
+    '''
+    Picks moves for a player using negamax with alpha-beta pruning.
+    Scores are relative to the player to move. A win n plies away is worth WIN_SCORE - n.
+    '''
+
+    def __init__(self, max_depth=None, time_limit=None) -> None:
+        '''
+        Args:
+            max_depth: the maximum number of plies to search. None searches to the end of the game.
+            time_limit: the wall clock budget per move in seconds. None means no limit.
+        '''
+        self.max_depth = max_depth
+        self.time_limit = time_limit
+        self._tt = {}
+        self._deadline = None
+        self.nodes = 0
+
+    def clear(self) -> None:
+        '''
+        Clear the transposition table.
+        '''
+        self._tt = {}
+
+    def choose_move(self, board: BitBoard, player: int) -> int:
+        '''
+        Find the best move for player.
+        Uses iterative deepening so that a move is always available when the time budget runs out.
+        Args:
+            board: the position to search. It is not modified.
+            player: the player to move, X or O.
+        Returns:
+            The index of the chosen cell.
+        '''
+        return self.analyze(board, player)[1]
+
+    def analyze(self, board: BitBoard, player: int) -> tuple:
+        '''
+        Like choose_move(), but also returns the score of the chosen move from the deepest completed search.
+        Returns:
+            A tuple (score, move). score is relative to player and is 0 if no search depth completed in time.
+        '''
+        moves = board.legal_moves()
+        if not moves:
+            raise ValueError('No legal moves.')
+
+        board = board.copy()
+        self.nodes = 0
+        self._deadline = None if self.time_limit is None else time.perf_counter() + self.time_limit
+
+        max_depth = len(moves) if self.max_depth is None else min(self.max_depth, len(moves))
+        best_move = self._order_moves(board, player, moves)[0]
+        best_score = 0
+        for depth in range(1, max_depth + 1):
+            try:
+                score, move = self._search_root(board, player, depth)
+            except SearchTimeout:
+                break
+            best_score, best_move = score, move
+            if abs(score) >= WIN_SCORE - board.cells:
+                # A forced result was found. Searching deeper will not change it.
+                break
+        return best_score, best_move
+
+    def evaluate(self, board: BitBoard, player: int) -> int:
+        '''
+        Returns the value of the position for player without a time limit.
+        '''
+        self._deadline = None
+        depth = len(board.legal_moves())
+        return self._negamax(board.copy(), player, depth, -WIN_SCORE - 1, WIN_SCORE + 1)
+
+    def _search_root(self, board: BitBoard, player: int, depth: int) -> tuple:
+        alpha = -WIN_SCORE - 1
+        beta = WIN_SCORE + 1
+        best_move = None
+        best_score = alpha
+        for move in self._order_moves(board, player, board.legal_moves()):
+            score = self._score_move(board, player, move, depth, -beta, -alpha)
+            if score > best_score:
+                best_score = score
+                best_move = move
+            alpha = max(alpha, score)
+        self._tt[board.zobrist ^ board.geometry.player_keys[player]] = (depth, best_score, EXACT, best_move)
+        return best_score, best_move
+
+    def _score_move(self, board: BitBoard, player: int, move: int, depth: int, alpha: int, beta: int) -> int:
+        '''
+        Play move, score it from player's point of view and undo it.
+        alpha and beta are given from the opponent's point of view.
+        '''
+        board.place(move, player)
+        try:
+            if board.has_won_at(move, player):
+                return WIN_SCORE - 1
+            score = -self._negamax(board, 1 - player, depth - 1, alpha, beta)
+        finally:
+            board.remove(move, player)
+        # Move wins and losses one ply further away from the current position.
+        if score > 0:
+            score -= 1
+        elif score < 0:
+            score += 1
+        return score
+
+    def _negamax(self, board: BitBoard, player: int, depth: int, alpha: int, beta: int) -> int:
+        self.nodes += 1
+        if self._deadline is not None and self.nodes & 0xff == 0 and time.perf_counter() > self._deadline:
+            raise SearchTimeout
+
+        moves = board.legal_moves()
+        if not moves or depth <= 0:
+            return 0
+
+        key = board.zobrist ^ board.geometry.player_keys[player]
+        entry = self._tt.get(key)
+        if entry is not None and entry[0] >= depth:
+            _, value, flag, _ = entry
+            if flag == EXACT:
+                return value
+            if flag == LOWER:
+                alpha = max(alpha, value)
+            elif flag == UPPER:
+                beta = min(beta, value)
+            if alpha >= beta:
+                return value
+
+        alpha_orig = alpha
+        best_score = -WIN_SCORE - 1
+        best_move = None
+        for move in self._order_moves(board, player, moves):
+            score = self._score_move(board, player, move, depth, -beta, -alpha)
+            if score > best_score:
+                best_score = score
+                best_move = move
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+
+        if best_score <= alpha_orig:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self._tt[key] = (depth, best_score, flag, best_move)
+        return best_score
+
+    def _order_moves(self, board: BitBoard, player: int, moves: list) -> list:
+        '''
+        Orders moves so the most promising are searched first.
+        The transposition table move comes first, then immediate wins, then blocks.
+        Other moves keep the order of BitBoard.legal_moves(), which puts cells on more lines first.
+        '''
+        entry = self._tt.get(board.zobrist ^ board.geometry.player_keys[player])
+        tt_move = entry[3] if entry is not None else None
+        opponent = 1 - player
+
+        def priority(move):
+            if move == tt_move:
+                return 0
+            bit = 1 << move
+            board.masks[player] |= bit
+            wins = board.has_won_at(move, player)
+            board.masks[player] &= ~bit
+            if wins:
+                return 1
+            board.masks[opponent] |= bit
+            blocks = board.has_won_at(move, opponent)
+            board.masks[opponent] &= ~bit
+            if blocks:
+                return 2
+            return 3
+
+        return sorted(moves, key=priority)
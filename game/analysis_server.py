@@ -0,0 +1,482 @@
+'''
+Local position analysis service.
+Clients send a batch of positions in one frame and get the score and best move of every position back in one frame.
+Results are kept in a bounded LRU cache keyed by canonical Zobrist hash, so a position is only searched once
+along with all its rotations and reflections. 3x3 positions are answered from the tablebase in the server process.
+Other positions are searched by a pool of worker processes, so a long search never holds up other clients.
+Like lan.match_server, the server is a selectors event loop over non-blocking sockets using the lan frame format.
+
+Request body, one position per line:
+    3x3/3:X...O....    width x height / win length : the cells in row order, each X, O or '.'
+    The player to move is X if both players have the same number of pieces, O otherwise.
+Response body, one line per position in the same order:
+    score,move         score is for the player to move on the NegamaxEngine scale.
+                       move is a cell index, or - if the game is already over.
+A request that cannot be parsed, including one that is not valid UTF-8, is answered with a single line
+starting with ERROR_PREFIX.
+
+Run with: python -m game.analysis_server
+'''
+
+import argparse
+import collections
+import functools
+import multiprocessing
+import os
+import selectors
+import socket
+import time
+
+from game.ai import NegamaxEngine, WIN_SCORE
+from game.bitboard import BitBoard, O, X, decode_position, encode_position
+from game.player import DEFAULT_AI_TIME_LIMIT
+from game.tablebase import Tablebase, TablebaseEngine
+from globals import dlogger, ANALYSIS_PORT
+from lan.connection import Connection, FRAME_HEADER_BYTES, MAX_RECEIVE_FRAME_BYTES, decode_frame_header, encode_frame
+from lan.metrics import Metrics
+
+RECV_BYTES = 65536
+ERROR_PREFIX = '!ERROR '
+DEFAULT_CACHE_SIZE = 100000
+# Positions are limited to what game.record can store.
+MAX_CELLS = 256
+
+
+def analyze_position(engine, board: BitBoard) -> tuple:
+    '''
+    Returns:
+        A tuple (score, move) for the player to move. move is None if the game is over.
+    '''
+    player = X if board.count % 2 == 0 else O
+    if board.has_won(1 - player):
+        return -WIN_SCORE, None
+    if board.has_won(player):
+        return WIN_SCORE, None
+    if board.is_full():
+        return 0, None
+    return engine.analyze(board, player)
+
+
+def make_engine(max_depth=None, time_limit=DEFAULT_AI_TIME_LIMIT):
+    return TablebaseEngine(NegamaxEngine(max_depth, time_limit))
+
+
+_worker_engine = None
+
+
+def _init_worker(max_depth, time_limit) -> None:
+    global _worker_engine
+    _worker_engine = make_engine(max_depth, time_limit)
+
+
+def _analyze_chunk(positions: list) -> list:
+    '''
+    Worker entry point.
+    Args:
+        positions: (width, height, win_length, x_mask, o_mask) tuples.
+    Returns:
+        A list of (score, move) tuples.
+    '''
+    # Keep the transposition table from growing for the life of the server.
+    _worker_engine.clear()
+    return [analyze_position(_worker_engine, BitBoard(w, h, k, (x_mask, o_mask))) for w, h, k, x_mask, o_mask in positions]
+
+
+class LRUCache:
+    '''
+    Dict with a maximum size. Once full, the least recently used entry is evicted.
+    '''
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+
+    def get(self, key):
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class _Request:
+    '''
+    One batch. results is filled in as positions are answered. pending counts the searches still running.
+    '''
+
+    __slots__ = ('results', 'pending', 'error', 'started')
+
+    def __init__(self, size):
+        self.results = [None] * size
+        self.pending = 0
+        self.error = None
+        self.started = time.perf_counter()
+
+
+class _AnalysisClient:
+    '''
+    Per-client state kept by the AnalysisServer. Responses are sent in request order.
+    '''
+
+    __slots__ = ('sock', 'address', 'inbuf', 'outbuf', 'writing', 'requests')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.writing = False
+        self.requests = collections.deque()
+
+
+class AnalysisServer:
+    '''
+    Answers batches of positions for any number of local clients.
+    '''
+
+    def __init__(self, port=ANALYSIS_PORT, host='127.0.0.1', processes=None, cache_size=DEFAULT_CACHE_SIZE,
+                 max_depth=None, time_limit=DEFAULT_AI_TIME_LIMIT):
+        '''
+        Args:
+            port, host: the address to listen on. Only local clients can connect by default.
+            processes: the number of worker processes. None uses every core. With 0 every search runs in the
+                server process and blocks other clients while it runs.
+            cache_size: the maximum number of cached results.
+            max_depth, time_limit: the search limits per position for boards the tablebase does not cover.
+        '''
+        self._port = port
+        self._selector = selectors.DefaultSelector()
+        self._clients = set()
+        self.cache = LRUCache(cache_size)
+        self.metrics = Metrics()
+        self._engine = make_engine(max_depth, time_limit)
+
+        self._processes = os.cpu_count() if processes is None else processes
+        self._pool = None
+        if self._processes > 0:
+            self._pool = multiprocessing.Pool(self._processes, _init_worker, (max_depth, time_limit))
+
+        # Worker results are handed over from the pool's result thread and the event loop is woken through a socket pair.
+        self._finished = collections.deque()
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+        self._selector.register(self._wake_reader, selectors.EVENT_READ, self._collect_results)
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._socket.listen()
+        self._socket.setblocking(False)
+        self._selector.register(self._socket, selectors.EVENT_READ, self._accept)
+
+    @property
+    def client_count(self) -> int:
+        return len(self._clients)
+
+    def serve_forever(self) -> None:
+        dlogger.log_info('Analysis server listening on port %s with %s worker processes.', self._port, self._processes)
+        try:
+            while True:
+                self.run_once()
+        finally:
+            self.close()
+
+    def run_once(self, timeout=None) -> None:
+        '''
+        Wait until at least one socket is ready (or timeout seconds pass) and service every ready socket.
+        '''
+        for key, mask in self._selector.select(timeout):
+            if isinstance(key.data, _AnalysisClient):
+                self._service_client(key.data, mask)
+            else:
+                key.data()
+
+    def close(self) -> None:
+        for client in list(self._clients):
+            self._drop(client)
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+        for sock in (self._socket, self._wake_reader):
+            self._selector.unregister(sock)
+            sock.close()
+        self._wake_writer.close()
+        self._selector.close()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                sock, address = self._socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = _AnalysisClient(sock, address)
+            self._clients.add(client)
+            self._selector.register(sock, selectors.EVENT_READ, client)
+            dlogger.log_info('Analysis client %s connected.', address)
+
+    def _service_client(self, client: _AnalysisClient, mask: int) -> None:
+        if mask & selectors.EVENT_READ:
+            try:
+                data = client.sock.recv(RECV_BYTES)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                data = b''
+            if data == b'':
+                self._drop(client)
+                return
+            if data:
+                client.inbuf += data
+                self._read_requests(client)
+
+        if mask & selectors.EVENT_WRITE and client in self._clients:
+            self._flush(client)
+
+    def _read_requests(self, client: _AnalysisClient) -> None:
+        buf = client.inbuf
+        offset = 0
+        while client in self._clients and len(buf) - offset >= FRAME_HEADER_BYTES:
+            try:
+                _, length = decode_frame_header(bytes(buf[offset:offset + FRAME_HEADER_BYTES]))
+            except ValueError as e:
+                dlogger.log_warning('%s from %s. Dropping client.', e, client.address)
+                self._drop(client)
+                return
+            if length > MAX_RECEIVE_FRAME_BYTES:
+                dlogger.log_warning('Frame of %s bytes from %s. Dropping client.', length, client.address)
+                self._drop(client)
+                return
+            end = offset + FRAME_HEADER_BYTES + length
+            if end > len(buf):
+                break
+            try:
+                body = str(buf[offset + FRAME_HEADER_BYTES:end], 'utf-8')
+            except UnicodeDecodeError:
+                request = _Request(0)
+                request.error = 'Request is not valid UTF-8.'
+                client.requests.append(request)
+            else:
+                self._start_request(client, body)
+            offset = end
+        if offset:
+            del buf[:offset]
+        self._send_finished(client)
+
+    def _start_request(self, client: _AnalysisClient, body: str) -> None:
+        '''
+        Answer what the cache can and start searches for the rest.
+        '''
+        lines = body.splitlines()
+        request = _Request(len(lines))
+        client.requests.append(request)
+        try:
+            boards = [decode_position(line, MAX_CELLS) for line in lines]
+        except ValueError as e:
+            request.error = str(e)
+            return
+
+        # Positions to search, by cache key. Symmetric copies of a position in the batch are searched once.
+        missing = {}
+        for index, board in enumerate(boards):
+            h, symmetry = board.canonical()
+            key = (board.geometry, h)
+            cached = self.cache.get(key)
+            if cached is not None:
+                request.results[index] = self._orient(board, symmetry, cached)
+            elif key in missing:
+                missing[key][2].append((index, symmetry))
+            else:
+                missing[key] = (board, symmetry, [(index, symmetry)])
+        self.metrics.inc('analysis_positions', len(boards))
+        self.metrics.inc('analysis_cache_hits', len(boards) - sum(len(entry[2]) for entry in missing.values()))
+        self.metrics.inc('analysis_cache_misses', len(missing))
+        if not missing:
+            return
+
+        searches = [(key,) + entry for key, entry in missing.items()]
+        if self._pool is not None:
+            # Tablebase lookups are instant. Everything else goes to the workers so the event loop stays free.
+            inline = [search for search in searches if Tablebase.supports(search[1])]
+            searches = [search for search in searches if not Tablebase.supports(search[1])]
+        else:
+            inline = searches
+            searches = []
+        if inline:
+            self._engine.clear()
+            self._finish_searches(request, inline, [analyze_position(self._engine, search[1]) for search in inline])
+        if not searches:
+            return
+
+        chunk_size = -(-len(searches) // self._processes)
+        for start in range(0, len(searches), chunk_size):
+            chunk = searches[start:start + chunk_size]
+            positions = [(b.width, b.height, b.geometry.win_length, b.masks[X], b.masks[O]) for _, b, _, _ in chunk]
+            request.pending += 1
+            self._pool.apply_async(_analyze_chunk, (positions,),
+                                   callback=functools.partial(self._searches_done, client, request, chunk),
+                                   error_callback=functools.partial(self._searches_done, client, request, None))
+
+    @staticmethod
+    def _orient(board: BitBoard, symmetry: int, result: tuple) -> tuple:
+        '''
+        Map a cached (score, canonical move) back onto board.
+        '''
+        score, move = result
+        if move is None:
+            return result
+        return score, board.geometry.inverse_symmetries[symmetry][move]
+
+    def _finish_searches(self, request: _Request, searches: list, results: list) -> None:
+        for (key, board, symmetry, targets), (score, move) in zip(searches, results):
+            canonical_move = None if move is None else board.geometry.symmetries[symmetry][move]
+            self.cache.put(key, (score, canonical_move))
+            for index, target_symmetry in targets:
+                request.results[index] = self._orient(board, target_symmetry, (score, canonical_move))
+
+    def _searches_done(self, client, request, chunk, results) -> None:
+        '''
+        Called on the pool's result thread. chunk is None if the worker raised, and results is the exception.
+        '''
+        self._finished.append((client, request, chunk, results))
+        try:
+            self._wake_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            # The loop is already due to wake up, or the server is closing.
+            pass
+
+    def _collect_results(self) -> None:
+        try:
+            while self._wake_reader.recv(RECV_BYTES):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        clients = set()
+        while self._finished:
+            client, request, chunk, results = self._finished.popleft()
+            request.pending -= 1
+            if chunk is None:
+                request.error = f'Analysis failed: {results!r}'
+            else:
+                self._finish_searches(request, chunk, results)
+            clients.add(client)
+        for client in clients:
+            if client in self._clients:
+                self._send_finished(client)
+
+    def _send_finished(self, client: _AnalysisClient) -> None:
+        '''
+        Send the responses of finished requests, stopping at the first one still being searched.
+        '''
+        while client.requests and client.requests[0].pending == 0:
+            request = client.requests.popleft()
+            if request.error is not None:
+                body = ERROR_PREFIX + request.error
+            else:
+                body = '\n'.join(f'{score},{"-" if move is None else move}' for score, move in request.results)
+            self.metrics.observe('analysis_request_seconds', time.perf_counter() - request.started)
+            self._queue_frame(client, encode_frame(body))
+
+    def _queue_frame(self, client: _AnalysisClient, frame) -> None:
+        was_empty = not client.outbuf
+        client.outbuf += frame
+        if was_empty:
+            self._flush(client)
+
+    def _flush(self, client: _AnalysisClient) -> None:
+        try:
+            sent = client.sock.send(client.outbuf)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._drop(client)
+            return
+        del client.outbuf[:sent]
+        # Only watch for writability while there is data waiting to go out.
+        writing = bool(client.outbuf)
+        if writing != client.writing:
+            client.writing = writing
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if writing else selectors.EVENT_READ
+            self._selector.modify(client.sock, events, client)
+
+    def _drop(self, client: _AnalysisClient) -> None:
+        if client not in self._clients:
+            return
+        dlogger.log_info('Analysis client %s disconnected.', client.address)
+        self._clients.discard(client)
+        self._selector.unregister(client.sock)
+        client.sock.close()
+
+
+class AnalysisClient:
+    '''
+    Blocking client for an AnalysisServer.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=ANALYSIS_PORT):
+        self.connection = Connection(host, port)
+        self.connection.tcp_connect()
+        if not self.connection.is_connected():
+            raise ConnectionError(f'Could not connect to the analysis server at {host}:{port}.')
+
+    def analyze(self, boards) -> list:
+        '''
+        Analyse a batch of positions in one round trip.
+        Args:
+            boards: BitBoards, or Boards whose bitboard is analysed.
+        Returns:
+            A list with a (score, move) tuple per position, see analyze_position().
+        Raises:
+            ValueError if the server rejects the batch.
+        '''
+        lines = [encode_position(getattr(board, 'bitboard', board)) for board in boards]
+        if not lines:
+            return []
+        if not self.connection.dynamic_send('\n'.join(lines)) or not self.connection.dynamic_receive():
+            raise ConnectionError('Lost the connection to the analysis server.')
+        body = self.connection.get_recvd_messages().pop(0)
+        if body.startswith(ERROR_PREFIX):
+            raise ValueError(body[len(ERROR_PREFIX):])
+        results = []
+        for line in body.split('\n'):
+            score, move = line.split(',')
+            results.append((int(score), None if move == '-' else int(move)))
+        return results
+
+    def close(self) -> None:
+        self.connection.close_socket()
+
+    def __enter__(self) -> 'AnalysisClient':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Serve position analysis to local clients.')
+    parser.add_argument('--port', type=int, default=ANALYSIS_PORT)
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, 0 to search in the server process')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE)
+    parser.add_argument('--max-depth', type=int, default=None)
+    parser.add_argument('--time-limit', type=float, default=DEFAULT_AI_TIME_LIMIT, help='search seconds per position')
+    args = parser.parse_args()
+    AnalysisServer(args.port, processes=args.processes, cache_size=args.cache_size,
+                   max_depth=args.max_depth, time_limit=args.time_limit).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
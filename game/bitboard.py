@@ -0,0 +1,308 @@
+'''
+Bitboard representation of an m,n,k game position (tic-tac-toe is 3,3,3).
+Each player owns one integer mask where bit (row * width + col) is set if that player occupies the cell.
+Win, draw and legal move checks become bitwise operations against precomputed masks.
+Each position also has a 64 bit Zobrist hash: the XOR of one random key per occupied (cell, player).
+Placing or removing a piece updates it with a single XOR.
+Positions can be written as text with encode_position, e.g. 3x3/3:X...O.... for the analysis server and spectators.
+'''
+
+import random
+from functools import lru_cache
+
+X = 0
+O = 1
+
+SYMBOLS = ('X', 'O')
+
+# Row and column steps for the four line directions: horizontal, vertical and both diagonals.
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+_X_BITS = str.maketrans('XO.', '100')
+_O_BITS = str.maketrans('XO.', '010')
+_NOT_CELLS = str.maketrans('', '', 'XO.')
+
+
+class Geometry:
+    '''
+    Precomputed tables for a board size and win length.
+    Shared by every BitBoard with the same dimensions, so get one through get_geometry().
+    '''
+
+    def __init__(self, width: int, height: int, win_length: int) -> None:
+        if width < 1 or height < 1:
+            raise ValueError('Board width and height must be at least 1.')
+        if not 1 <= win_length <= max(width, height):
+            raise ValueError(f'Win length {win_length} does not fit on a {width}x{height} board.')
+
+        self.width = width
+        self.height = height
+        self.win_length = win_length
+        self.cells = width * height
+        self.full_mask = (1 << self.cells) - 1
+        self.win_masks = tuple(self._build_win_masks())
+
+        # Winning line masks through each cell. There are at most 4 * win_length of them.
+        self.cell_masks = tuple(
+            tuple(mask for mask in self.win_masks if (mask >> index) & 1) for index in range(self.cells)
+        )
+
+        # Number of winning lines through each cell. Cells on more lines are better moves.
+        self.centrality = tuple(len(masks) for masks in self.cell_masks)
+        self.move_order = tuple(sorted(range(self.cells), key=lambda index: -self.centrality[index]))
+
+        # The keys come from a generator seeded with the dimensions, so hashes are the same in every process and run.
+        rng = random.Random(f'zobrist {width}x{height}/{win_length}')
+        self.zobrist = tuple(tuple(rng.getrandbits(64) for _ in range(self.cells)) for _ in SYMBOLS)
+        # XORed into a position hash to tell apart the same position with different players to move.
+        self.player_keys = (0, rng.getrandbits(64))
+
+        # Cell permutations that map the board onto itself, identity first: cell i moves to cell perm[i].
+        self.symmetries = tuple(self._build_symmetries())
+        self.inverse_symmetries = tuple(tuple(perm.index(index) for index in range(self.cells)) for perm in self.symmetries)
+        # symmetric_zobrist[s][player][index] is the key of the piece at index after applying symmetry s.
+        self.symmetric_zobrist = tuple(
+            tuple(tuple(keys[perm[index]] for index in range(self.cells)) for keys in self.zobrist)
+            for perm in self.symmetries
+        )
+
+    def index(self, row: int, col: int) -> int:
+        return row * self.width + col
+
+    def contains(self, row: int, col: int) -> bool:
+        return 0 <= row < self.height and 0 <= col < self.width
+
+    def _build_symmetries(self) -> list:
+        '''
+        Returns the rotations and reflections of the board: 8 for a square board, 4 otherwise.
+        '''
+        width, height = self.width, self.height
+        transforms = [
+            lambda row, col: (row, col),
+            lambda row, col: (row, width - 1 - col),
+            lambda row, col: (height - 1 - row, col),
+            lambda row, col: (height - 1 - row, width - 1 - col),
+        ]
+        if width == height:
+            transforms += [
+                lambda row, col: (col, row),
+                lambda row, col: (col, width - 1 - row),
+                lambda row, col: (width - 1 - col, row),
+                lambda row, col: (width - 1 - col, width - 1 - row),
+            ]
+        return [
+            tuple(self.index(*transform(*divmod(index, width))) for index in range(self.cells))
+            for transform in transforms
+        ]
+
+    def _build_win_masks(self) -> list:
+        masks = []
+        k = self.win_length
+        for row in range(self.height):
+            for col in range(self.width):
+                for dr, dc in DIRECTIONS:
+                    end_row = row + dr * (k - 1)
+                    end_col = col + dc * (k - 1)
+                    if not self.contains(end_row, end_col):
+                        continue
+                    mask = 0
+                    for step in range(k):
+                        mask |= 1 << self.index(row + dr * step, col + dc * step)
+                    masks.append(mask)
+        return masks
+
+
+@lru_cache(maxsize=None)
+def get_geometry(width: int = 3, height: int = 3, win_length: int = 3) -> Geometry:
+    return Geometry(width, height, win_length)
+
+
+class BitBoard:
+    '''
+    Bitboard core for an m,n,k game.
+    self.masks holds one integer per player, indexed by X and O.
+    self.count is the number of occupied cells, used for draw detection.
+    self.zobrist is the Zobrist hash of the position, kept up to date by place() and remove().
+    '''
+
+    __slots__ = ('geometry', 'masks', 'occupied', 'count', 'zobrist')
+
+    def __init__(self, width: int = 3, height: int = 3, win_length: int = 3, masks=(0, 0)) -> None:
+        self.geometry = get_geometry(width, height, win_length)
+        self.masks = list(masks)
+        self.occupied = masks[X] | masks[O]
+        self.count = bin(self.occupied).count('1')
+        self.zobrist = self.symmetric_zobrist(0)
+
+    @property
+    def width(self) -> int:
+        return self.geometry.width
+
+    @property
+    def height(self) -> int:
+        return self.geometry.height
+
+    @property
+    def cells(self) -> int:
+        return self.geometry.cells
+
+    def copy(self) -> 'BitBoard':
+        board = BitBoard.__new__(BitBoard)
+        board.geometry = self.geometry
+        board.masks = self.masks[:]
+        board.occupied = self.occupied
+        board.count = self.count
+        board.zobrist = self.zobrist
+        return board
+
+    def key(self) -> tuple:
+        '''
+        Returns a hashable key uniquely identifying the position on this geometry.
+        '''
+        return (self.masks[X], self.masks[O])
+
+    def symmetric_zobrist(self, symmetry: int) -> int:
+        '''
+        Returns the Zobrist hash of the position after applying geometry.symmetries[symmetry].
+        Computed from the masks in O(pieces).
+        '''
+        keys = self.geometry.symmetric_zobrist[symmetry]
+        h = 0
+        for player in (X, O):
+            player_keys = keys[player]
+            mask = self.masks[player]
+            while mask:
+                low = mask & -mask
+                h ^= player_keys[low.bit_length() - 1]
+                mask ^= low
+        return h
+
+    def canonical_zobrist(self) -> int:
+        '''
+        Returns the smallest Zobrist hash among the symmetric images of the position,
+        so rotated and reflected copies of a position hash the same.
+        '''
+        return self.canonical()[0]
+
+    def canonical(self) -> tuple:
+        '''
+        Returns:
+            A tuple (hash, symmetry) where hash is canonical_zobrist() and symmetry is the index in
+            geometry.symmetries of the image with that hash. geometry.symmetries[symmetry][move] maps a move
+            into the canonical orientation and geometry.inverse_symmetries[symmetry] maps it back.
+        '''
+        return min((self.symmetric_zobrist(s), s) for s in range(len(self.geometry.symmetries)))
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, BitBoard) and self.geometry is other.geometry and self.masks == other.masks
+
+    def is_empty(self, index: int) -> bool:
+        return not (self.occupied >> index) & 1
+
+    def place(self, index: int, player: int) -> None:
+        '''
+        Place player's piece on the cell at index.
+        The caller is responsible for making sure the cell is empty.
+        '''
+        bit = 1 << index
+        self.masks[player] |= bit
+        self.occupied |= bit
+        self.count += 1
+        self.zobrist ^= self.geometry.zobrist[player][index]
+
+    def remove(self, index: int, player: int) -> None:
+        '''
+        Undo a placement made with place().
+        '''
+        bit = 1 << index
+        self.masks[player] &= ~bit
+        self.occupied &= ~bit
+        self.count -= 1
+        self.zobrist ^= self.geometry.zobrist[player][index]
+
+    def legal_moves_mask(self) -> int:
+        return self.geometry.full_mask & ~self.occupied
+
+    def legal_moves(self) -> list:
+        occupied = self.occupied
+        return [index for index in self.geometry.move_order if not (occupied >> index) & 1]
+
+    def has_won_at(self, index: int, player: int) -> bool:
+        '''
+        Checks whether the piece at index completes a line for player.
+        Only the windows on the four lines through index are tested, so this costs O(win_length).
+        '''
+        mask = self.masks[player]
+        for win in self.geometry.cell_masks[index]:
+            if mask & win == win:
+                return True
+        return False
+
+    def has_won(self, player: int) -> bool:
+        '''
+        Checks every winning line on the board. Prefer has_won_at() when the last move is known.
+        '''
+        mask = self.masks[player]
+        for win in self.geometry.win_masks:
+            if mask & win == win:
+                return True
+        return False
+
+    def winner(self):
+        '''
+        Returns X or O if that player has a complete line, None otherwise.
+        '''
+        if self.has_won(X):
+            return X
+        if self.has_won(O):
+            return O
+        return None
+
+    def is_full(self) -> bool:
+        return self.count == self.geometry.cells
+
+    def symbol_at(self, index: int) -> str:
+        bit = 1 << index
+        if self.masks[X] & bit:
+            return SYMBOLS[X]
+        if self.masks[O] & bit:
+            return SYMBOLS[O]
+        return ' '
+
+
+def encode_position(board: BitBoard) -> str:
+    '''
+    Returns:
+        The position as text: width x height / win length : the cells in row order, each X, O or '.'.
+    '''
+    cells = ''.join(board.symbol_at(index) for index in range(board.cells)).replace(' ', '.')
+    return f'{board.width}x{board.height}/{board.geometry.win_length}:{cells}'
+
+
+def decode_position(text: str, max_cells=None) -> BitBoard:
+    '''
+    Parse a position written by encode_position.
+    Args:
+        text: the encoded position.
+        max_cells: the largest board accepted, checked before the board is built. None means no limit.
+    Raises:
+        ValueError if text is not a position from a legal game.
+    '''
+    try:
+        dimensions, cells = text.split(':')
+        size, win_length = dimensions.split('/')
+        width, height = size.split('x')
+        width, height, win_length = int(width), int(height), int(win_length)
+    except ValueError:
+        raise ValueError(f'Invalid position {text!r}.') from None
+    if max_cells is not None and width * height > max_cells:
+        raise ValueError(f'Boards are limited to {max_cells} cells.')
+    if len(cells) != width * height or cells.translate(_NOT_CELLS):
+        raise ValueError(f'Invalid cells in position {text!r}.')
+    # Cell 0 is the lowest bit, so the string is reversed before reading it as a binary number.
+    x_mask = int(cells[::-1].translate(_X_BITS), 2)
+    o_mask = int(cells[::-1].translate(_O_BITS), 2)
+    board = BitBoard(width, height, win_length, (x_mask, o_mask))
+    if not 0 <= bin(x_mask).count('1') - bin(o_mask).count('1') <= 1:
+        raise ValueError(f'Position {text!r} cannot happen in a game.')
+    return board
@@ -1,16 +1,39 @@
-from game.player import Player
+from game.player import Player, default_engine
+from game.bitboard import BitBoard, SYMBOLS, encode_position
 import debug.inputter as inputter
 from lan.multiplayer_game import MultiplayerGame
-from globals import MULTIPLAYER_PORT
+from globals import MULTIPLAYER_PORT, SPECTATOR_PORT
 import random
-from cls import cls
+from game.renderer import TerminalRenderer
+import game.record as record
 
 class Board(MultiplayerGame):
-
-    def __init__(self, mode=MultiplayerGame.LOCAL) -> None:
-        self.grid = [[' ' for _ in range(3)] for _ in range(3)]
+    GAME_NAME = 'tictactoe'
+
+    def __init__(self, mode=MultiplayerGame.LOCAL, width=3, height=3, win_length=3, input_source=None, headless=False, recorder=None) -> None:
+        '''
+        Args:
+            mode: LOCAL or LAN.
+            width, height: the board dimensions.
+            win_length: the number of pieces in a row needed to win.
+            input_source: where local moves are read from, e.g. an inputter.ScriptedInput.
+                Defaults to the inputter module's default source.
+            headless: draw nothing. print() and turn messages become no-ops.
+            recorder: a game.record.GameWriter every move is appended to.
+        '''
+        self.bitboard = BitBoard(width, height, win_length)
+        # (position hash, canonical hash) of the last canonical_hash() call.
+        self._canonical_cache = (None, None)
+        self.width = width
+        self.height = height
+        self.win_length = win_length
+        self._last_move = None
         self.winner = None
+        self.cat = False
         self.mode = mode
+        self.input_source = input_source
+        self.renderer = TerminalRenderer(headless=headless)
+        self.recorder = recorder
 
         self.player_x = Player()
         self.player_x.set_as_x()
@@ -22,36 +45,86 @@ class Board(MultiplayerGame):
 
         if mode == MultiplayerGame.LAN:
             self._port = MULTIPLAYER_PORT
+            self._spectator_port = SPECTATOR_PORT
             self._setup_lan()
 
-    
-    def _determine_player_roles(self):
-        local_role = random.choice(('x', 'o'))
-        if local_role == 'x':
-            self.player_x.set_mode(MultiplayerGame.LOCAL)
-            self.player_o.set_mode(MultiplayerGame.LAN)
-        else:
-            self.player_x.set_mode(MultiplayerGame.LAN)
-            self.player_o.set_mode(MultiplayerGame.LOCAL)
 
+    def reset(self) -> None:
+        '''
+        Clear the board for a new game. Players, their modes and any LAN connection are kept.
+        '''
+        if self.recorder is not None and self.recorder.in_game():
+            self.recorder.end_game(record.RESULT_UNFINISHED)
+        if self.mode == MultiplayerGame.LAN:
+            self.end_game()
+        self.bitboard = BitBoard(self.width, self.height, self.win_length)
+        self._last_move = None
+        self.winner = None
+        self.cat = False
+        self.turn = self.player_x
+        self.renderer.reset()
+        if self.mode == MultiplayerGame.LAN:
+            self.update_spectators(encode_position(self.bitboard))
+
+
+    def rematch(self) -> None:
+        '''
+        Start another game against the same opponent.
+        In LAN mode the open connection is reused: no discovery or reconnection happens.
+        Both players swap X and O locally so they take turns going first. No message is exchanged,
+        so this also works when neither side is the host, e.g. through a MatchServer.
+        '''
+        local_was_x = self.player_x.mode == MultiplayerGame.LOCAL
+        self.reset()
+        if self.mode != MultiplayerGame.LAN:
+            return
+        self._set_local_role('o' if local_was_x else 'x')
+
+
+    @property
+    def grid(self) -> list:
+        '''
+        Read-only view of the bitboard as a list of rows of symbols.
+        Use _place() to modify the board.
+        '''
+        return [[self.bitboard.symbol_at(row * self.width + col) for col in range(self.width)] for row in range(self.height)]
+
+    
+    def _determine_player_roles(self, local_role=None):
+        '''
+        Pick the host's role and send it to the client.
+        Args:
+            local_role: 'x' or 'o'. Chosen at random if None.
+        '''
+        if local_role is None:
+            local_role = random.choice(('x', 'o'))
+        self._set_local_role(local_role)
         self.send_to_peer(local_role)
         
 
     def _retrieve_role(self) -> None:
         role = self.receive_from_peer()
-        if role == 'x':
-            self.player_x.set_mode(MultiplayerGame.LAN)
-            self.player_o.set_mode(MultiplayerGame.LOCAL)
-        else:
+        self._set_local_role('o' if role == 'x' else 'x')
+
+
+    def _set_local_role(self, local_role: str) -> None:
+        '''
+        Args:
+            local_role: 'x' or 'o', the symbol the local player plays. The peer gets the other one.
+        '''
+        if local_role == 'x':
             self.player_x.set_mode(MultiplayerGame.LOCAL)
             self.player_o.set_mode(MultiplayerGame.LAN)
+        else:
+            self.player_x.set_mode(MultiplayerGame.LAN)
+            self.player_o.set_mode(MultiplayerGame.LOCAL)
 
 
 
     def _setup_lan(self) -> None:
         print('Searching for existing games...')
 
-        hosts = self.search_for_hosts()
+        hosts = self.search_for_hosts(first_response=True)
         if len(hosts) > 0:
             print('Found game. Connecting...')
             self.connect_to_host(hosts[0])
@@ -69,16 +142,7 @@ class Board(MultiplayerGame):
 
 
     def print(self) -> None:
-        cls()
-        for i in range(3):
-            for k in range(3):
-                print(' ' + self.grid[i][k], end=' ')
-                if k < 2:
-                    print('|', end='')
-            if i < 2:
-                print('\n---+---+---')
-            else:
-                print()
+        self.renderer.render(self.grid)
 
 
     def next_turn(self) -> None:
@@ -86,12 +150,11 @@ class Board(MultiplayerGame):
             self._next_turn_local()
         elif self.turn.mode == MultiplayerGame.LAN:
             self._next_turn_lan()
-
-        self.cat = True
-        for i in range(3):
-            for k in range(3):
-                if self.grid[i][k] == ' ':
-                    self.cat = False
+        elif self.turn.mode == Player.AI:
+            self._next_turn_ai()
+        if self.mode == MultiplayerGame.LAN:
+            # Spectators get the whole position every turn, so the latest message is all a new spectator needs.
+            self.update_spectators(encode_position(self.bitboard))
 
 
     def _switch_turn(self) -> None:
@@ -102,63 +165,162 @@ class Board(MultiplayerGame):
 
 
     def _next_turn_local(self) -> None:
-        print(f'{self.turn.symbol}\'s turn')
+        self.renderer.message(f'{self.turn.symbol}\'s turn')
         while True:
             try:
-                row, col = inputter.get_input('row, col: ').split(',')
+                row, col = self._get_input('row, col: ').split(',')
                 row = int(row)
                 col = int(col)
-                if self.grid[row][col] != ' ':
-                    print('Invalid move')
+                if not self.is_legal(row, col):
+                    self.renderer.message('Invalid move')
                     continue
-                self.grid[row][col] = self.turn.symbol
                 break
             except ValueError:
-                print('Invalid input')
-            except IndexError:
-                print('Invalid move')
+                self.renderer.message('Invalid input')
+
+        self.play_move(row, col)
 
         if self.mode == MultiplayerGame.LAN:
             self.send_to_peer(f'{row},{col}')
 
-        if self.check_winner():
+        if self.winner:
             self.print_winner()
 
-        self._switch_turn()
+
+    def _get_input(self, prompt: str) -> str:
+        if self.input_source is not None:
+            return self.input_source.get_input(prompt)
+        return inputter.get_input(prompt)
+
+
+    def _next_turn_ai(self) -> None:
+        self.renderer.message(f'{self.turn.symbol}\'s turn')
+        move = self.turn.engine.choose_move(self.bitboard, SYMBOLS.index(self.turn.symbol))
+        row, col = divmod(move, self.width)
+        self.play_move(row, col)
+
+        if self.mode == MultiplayerGame.LAN:
+            self.send_to_peer(f'{row},{col}')
+
+        if self.winner:
+            self.print_winner()
+
+
+    def hint(self) -> tuple:
+        '''
+        Returns the best move (row, col) for the player whose turn it is.
+        3x3 games are answered from the tablebase, other sizes by a short search.
+        '''
+        if self.is_over():
+            raise ValueError('The game is already over.')
+        engine = self.turn.engine if self.turn.engine is not None else default_engine()
+        move = engine.choose_move(self.bitboard, SYMBOLS.index(self.turn.symbol))
+        return divmod(move, self.width)
 
 
     def print_winner(self) -> None:
         self.print()
-        print(f'{self.winner} wins!')
+        self.renderer.message(f'{self.winner} wins!')
 
 
     def check_winner(self) -> bool:
-        for i in range(3):
-            if self.grid[i][0] != ' ' and self.grid[i][0] == self.grid[i][1] == self.grid[i][2]:
-                self.winner = self.grid[i][0]
-                return True
-            if self.grid[0][i] != ' ' and self.grid[0][i] == self.grid[1][i] == self.grid[2][i]:
-                self.winner = self.grid[0][i]
-                return True
-        if self.grid[0][0] != ' ' and self.grid[0][0] == self.grid[1][1] == self.grid[2][2]:
-            self.winner = self.grid[0][0]
-            return True
-        if self.grid[0][2] != ' ' and self.grid[0][2] == self.grid[1][1] == self.grid[2][0]:
-            self.winner = self.grid[0][2]
-            return True
-        return False
+        '''
+        Checks whether the last move won the game.
+        Only the lines through the last placed piece are scanned.
+        '''
+        if self._last_move is None:
+            return False
+        index, player = self._last_move
+        if not self.bitboard.has_won_at(index, player):
+            return False
+        self.winner = SYMBOLS[player]
+        return True
+
+
+    def position_hash(self) -> int:
+        '''
+        Returns the 64 bit Zobrist hash of the pieces on the board.
+        Equal positions on the same board size and win length always have equal hashes, in any process.
+        '''
+        return self.bitboard.zobrist
+
+
+    def canonical_hash(self) -> int:
+        '''
+        Returns a hash that is the same for a position and all its rotations and reflections.
+        Use it to treat symmetric positions as one, e.g. when caching analysis.
+        Computed when asked for, and kept until the position changes.
+        '''
+        zobrist, canonical = self._canonical_cache
+        if zobrist != self.bitboard.zobrist:
+            zobrist = self.bitboard.zobrist
+            canonical = self.bitboard.canonical_zobrist()
+            self._canonical_cache = (zobrist, canonical)
+        return canonical
+
+
+    def is_legal(self, row: int, col: int) -> bool:
+        return self.bitboard.geometry.contains(row, col) and self.bitboard.is_empty(row * self.width + col)
+
+
+    def is_over(self) -> bool:
+        return self.winner is not None or self.cat
+
+
+    def play_move(self, row: int, col: int) -> bool:
+        '''
+        Play a move for the player whose turn it is.
+        This is the headless play path: it does no printing, input or networking.
+        Args:
+            row, col: the cell to play.
+        Returns:
+            True if the move ended the game, False otherwise.
+        '''
+        if self.is_over():
+            raise ValueError('The game is already over.')
+        if not self.is_legal(row, col):
+            raise ValueError(f'Invalid move {row},{col}.')
+
+        self._place(row, col)
+        self.check_winner()
+        self.cat = self.winner is None and self.bitboard.is_full()
+        if self.recorder is not None:
+            self._record_move(row * self.width + col)
+        self._switch_turn()
+        return self.is_over()
+
+
+    def _record_move(self, index: int) -> None:
+        # The game is started on the first move, once LAN roles are known.
+        if not self.recorder.in_game():
+            self.recorder.begin_game(self.width, self.height, self.win_length,
+                                     self.mode, self.player_x.mode, self.player_o.mode)
+        self.recorder.record_move(index)
+        if self.winner is not None:
+            self.recorder.end_game(record.RESULT_X if self.winner == SYMBOLS[0] else record.RESULT_O)
+        elif self.cat:
+            self.recorder.end_game(record.RESULT_DRAW)
+
+
+    def _place(self, row: int, col: int) -> None:
+        '''
+        Place the current player's symbol at row, col.
+        '''
+        index = row * self.width + col
+        player = SYMBOLS.index(self.turn.symbol)
+        self.bitboard.place(index, player)
+        self._last_move = (index, player)
+
 
     def _next_turn_lan(self) -> None:
-        print(f'{self.turn.symbol}\'s turn')
-        print('Waiting on opponent...')
+        self.renderer.message(f'{self.turn.symbol}\'s turn')
+        self.renderer.message('Waiting on opponent...')
 
         opponent_turn = self.receive_from_peer()
         opponent_turn = opponent_turn.split(',')
         row = int(opponent_turn[0])
         col = int(opponent_turn[1])
-        self.grid[row][col] = self.turn.symbol
-
-        if self.check_winner():
-            self.print_winner()
+        self.play_move(row, col)
 
-        self._switch_turn()
\ No newline at end of file
+        if self.winner:
+            self.print_winner()
\ No newline at end of file
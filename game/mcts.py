@@ -0,0 +1,395 @@
+'''
+Monte Carlo tree search engine for boards too large to search exhaustively.
+Every iteration walks down the tree choosing children by UCT (upper confidence bounds applied to trees),
+adds the children of the leaf it reaches, plays a random game from there and backs the result up the path.
+Game results are also proven up the tree (MCTS-Solver): a node is a proven win for the player to move if one of
+its moves wins, and a proven loss or draw once every move is proven. Proven wins are always played, proven losses
+are never searched or played while another move is left, and the search stops early once the root is proven.
+The tree is kept in flat lists indexed by node number, with the children of a node stored next to each other.
+The part of the tree below the position reached on the next turn is kept and searched further.
+With processes > 1, worker processes search their own trees from the same root for the same time budget
+(root parallelization) and their root visit counts are added to this process's.
+'''
+
+import math
+import multiprocessing
+import random
+import time
+
+from game.bitboard import BitBoard
+
+DEFAULT_TIME_LIMIT = 1.0
+DEFAULT_EXPLORATION = math.sqrt(2)
+# A kept tree larger than this is discarded instead of searched further.
+DEFAULT_MAX_NODES = 1000000
+
+# Node results, proven either by the game ending or by the results of all the node's children.
+# X and O wins are stored as the player index (0 or 1).
+ONGOING = -1
+DRAW = 2
+
+
+def _search_worker(task: tuple) -> list:
+    '''
+    Worker entry point. Searches a fresh tree for the given time.
+    Returns:
+        root_stats() of the worker's tree.
+    '''
+    width, height, win_length, masks, player, time_limit, iterations, exploration, seed = task
+    engine = MCTSEngine(time_limit, iterations, exploration=exploration, seed=seed)
+    engine._search(BitBoard(width, height, win_length, masks), player)
+    return engine.root_stats()
+
+
+class MCTSEngine:
+    '''
+    Picks moves with Monte Carlo tree search under a wall clock budget.
+    Has the same choose_move() and clear() methods as NegamaxEngine, so Players and
+    TablebaseEngine can use it, e.g. Player(Player.AI, engine=MCTSEngine(time_limit=0.5)).
+    '''
+
+    def __init__(self, time_limit=DEFAULT_TIME_LIMIT, iterations=None, processes=1,
+                 exploration=DEFAULT_EXPLORATION, seed=None, max_nodes=DEFAULT_MAX_NODES) -> None:
+        '''
+        Args:
+            time_limit: the wall clock budget per move in seconds. None means no limit.
+            iterations: the maximum number of iterations per move in each process. None means no limit.
+            processes: the number of processes searching each move, including this one.
+            exploration: the UCT exploration constant. Higher values spread visits over more moves.
+            seed: seed for the random games, so searches with an iteration limit can be repeated.
+            max_nodes: the largest tree kept from one move to the next.
+        '''
+        if time_limit is None and iterations is None:
+            raise ValueError('MCTSEngine needs a time limit or an iteration limit.')
+        self.time_limit = time_limit
+        self.iterations = iterations
+        self.processes = processes
+        self.exploration = exploration
+        self.max_nodes = max_nodes
+        self._rng = random.Random(seed)
+        self._pool = None
+        # Iterations that went into the last move, over all processes.
+        self.last_iterations = 0
+        self.clear()
+
+    def clear(self) -> None:
+        '''
+        Discard the search tree.
+        '''
+        self._root_masks = None
+        self._root_player = None
+        self._geometry = None
+        self._reset_tree()
+
+    def _reset_tree(self) -> None:
+        self._parent = [-1]
+        self._move = [-1]
+        self._first_child = [0]
+        self._child_count = [0]
+        self._visits = [0]
+        # Sum of the results for the player who made the move leading to the node: 1 for a win, 0.5 for a draw.
+        self._wins = [0.0]
+        self._result = [ONGOING]
+
+    @property
+    def node_count(self) -> int:
+        return len(self._parent)
+
+    def close(self) -> None:
+        '''
+        Stop the worker processes.
+        '''
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __getstate__(self) -> dict:
+        # Only the settings are sent. Pools cannot be pickled, and the tree is only useful to this process.
+        return {key: value for key, value in self.__dict__.items() if not key.startswith('_') or key == '_rng'}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._pool = None
+        self.clear()
+
+    def choose_move(self, board: BitBoard, player: int) -> int:
+        '''
+        Find the best move for player.
+        Args:
+            board: the position to search. It is not modified.
+            player: the player to move, X or O.
+        Returns:
+            The index of the chosen cell, the root move with the most visits.
+        '''
+        if not board.legal_moves():
+            raise ValueError('No legal moves.')
+
+        pending = None
+        if self.processes > 1:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.processes - 1)
+            tasks = [(board.width, board.height, board.geometry.win_length, tuple(board.masks), player,
+                      self.time_limit, self.iterations, self.exploration, self._rng.getrandbits(32))
+                     for _ in range(self.processes - 1)]
+            pending = self._pool.map_async(_search_worker, tasks)
+
+        self._search(board, player)
+
+        visits = {}
+        results = {}
+        for stats in [self.root_stats()] + (pending.get() if pending is not None else []):
+            for move, count, _, outcome in stats:
+                visits[move] = visits.get(move, 0) + count
+                if outcome != ONGOING:
+                    results[move] = outcome
+        self.last_iterations = sum(visits.values())
+
+        for move, outcome in results.items():
+            if outcome == player:
+                return move
+        # Moves proven to lose are only played when every move loses.
+        candidates = [move for move in visits if results.get(move) != 1 - player] or list(visits)
+        return max(candidates, key=visits.get)
+
+    def root_stats(self) -> list:
+        '''
+        Returns:
+            A (move, visits, wins, result) tuple for every child of the root. wins is from the point of view of
+            the player to move. result is the proven result of the move, or ONGOING if it is not proven.
+        '''
+        first = self._first_child[0]
+        return [(self._move[child], self._visits[child], self._wins[child], self._result[child])
+                for child in range(first, first + self._child_count[0])]
+
+    def _search(self, board: BitBoard, player: int) -> None:
+        self._set_root(board, player)
+        deadline = None if self.time_limit is None else time.perf_counter() + self.time_limit
+        board = board.copy()
+        count = 0
+        while self.iterations is None or count < self.iterations:
+            # Checking the clock every iteration costs little next to a random game.
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+            if self._result[0] != ONGOING:
+                # The root is proven, so more iterations cannot change the move.
+                break
+            self._iterate(board, player)
+            count += 1
+
+    def _set_root(self, board: BitBoard, player: int) -> None:
+        '''
+        Make the root the node for board, keeping its subtree if the position follows from the last root.
+        '''
+        node = self._find_node(board, player)
+        if node is None:
+            self._reset_tree()
+        elif node != 0:
+            self._keep_subtree(node)
+        if self.node_count > self.max_nodes:
+            self._reset_tree()
+        self._root_masks = tuple(board.masks)
+        self._root_player = player
+        self._geometry = board.geometry
+
+    def _find_node(self, board: BitBoard, player: int):
+        '''
+        Follow the pieces added since the last root down the tree.
+        Returns:
+            The node for board, or None if it is not in the tree.
+        '''
+        if self._root_masks is None or board.geometry is not self._geometry:
+            return None
+        added = []
+        for old, new in zip(self._root_masks, board.masks):
+            if old & ~new:
+                # A piece was removed, so this is a different game.
+                return None
+            added.append(new & ~old)
+
+        node = 0
+        to_move = self._root_player
+        while added[0] or added[1]:
+            first = self._first_child[node]
+            for child in range(first, first + self._child_count[node]):
+                bit = 1 << self._move[child]
+                if added[to_move] & bit:
+                    added[to_move] &= ~bit
+                    node = child
+                    break
+            else:
+                return None
+            to_move = 1 - to_move
+        return node if to_move == player else None
+
+    def _keep_subtree(self, root: int) -> None:
+        '''
+        Rebuild the tree with only root and its descendants, so the lists do not grow from move to move.
+        Children stay next to each other because each block of siblings is copied in one go.
+        '''
+        parent, move, first_child, child_count = [-1], [-1], [0], [0]
+        visits, wins, result = [self._visits[root]], [self._wins[root]], [self._result[root]]
+        queue = [(root, 0)]
+        for old, new in queue:
+            count = self._child_count[old]
+            if not count:
+                continue
+            first = self._first_child[old]
+            first_child[new] = len(parent)
+            child_count[new] = count
+            for child in range(first, first + count):
+                queue.append((child, len(parent)))
+                parent.append(new)
+                move.append(self._move[child])
+                first_child.append(0)
+                child_count.append(0)
+                visits.append(self._visits[child])
+                wins.append(self._wins[child])
+                result.append(self._result[child])
+        self._parent, self._move, self._first_child, self._child_count = parent, move, first_child, child_count
+        self._visits, self._wins, self._result = visits, wins, result
+
+    def _iterate(self, board: BitBoard, player: int) -> None:
+        '''
+        One select, expand, play out and back up pass. board is the root position and is restored afterwards.
+        '''
+        node = 0
+        path = [0]
+        to_move = player
+        child_count = self._child_count
+        result = self._result
+        try:
+            while child_count[node] and result[node] == ONGOING:
+                node = self._select(node, to_move)
+                board.place(self._move[node], to_move)
+                path.append(node)
+                to_move = 1 - to_move
+
+            if result[node] == ONGOING:
+                self._expand(node, board, to_move)
+                node = self._select(node, to_move)
+                board.place(self._move[node], to_move)
+                path.append(node)
+                to_move = 1 - to_move
+
+            if result[node] != ONGOING:
+                winner = result[node]
+                self._prove(path, player)
+            else:
+                winner = self._play_out(board, to_move)
+        finally:
+            # Undo the moves along the path, last move first.
+            undo_player = to_move
+            for n in reversed(path[1:]):
+                undo_player = 1 - undo_player
+                board.remove(self._move[n], undo_player)
+
+        # The root player made the move into path[1], the opponent into path[2] and so on.
+        visits = self._visits
+        wins = self._wins
+        visits[0] += 1
+        mover = player
+        for n in path[1:]:
+            visits[n] += 1
+            if winner == mover:
+                wins[n] += 1.0
+            elif winner == DRAW:
+                wins[n] += 0.5
+            mover = 1 - mover
+
+    def _select(self, node: int, to_move: int) -> int:
+        '''
+        Returns the child with the highest upper confidence bound. Unvisited children come first.
+        A move proven to win for to_move is always chosen, and moves proven to lose are skipped.
+        '''
+        visits = self._visits
+        wins = self._wins
+        result = self._result
+        first = self._first_child[node]
+        scale = self.exploration * math.sqrt(math.log(max(visits[node], 1)))
+        best = first
+        best_value = -1.0
+        for child in range(first, first + self._child_count[node]):
+            if result[child] == to_move:
+                return child
+            if result[child] == 1 - to_move:
+                continue
+            child_visits = visits[child]
+            if not child_visits:
+                return child
+            value = wins[child] / child_visits + scale / math.sqrt(child_visits)
+            if value > best_value:
+                best_value = value
+                best = child
+        return best
+
+    def _prove(self, path: list, player: int) -> None:
+        '''
+        Prove the nodes above the proven last node of path, stopping at the first one that cannot be proven yet.
+        player is the player to move at the root, path[0].
+        '''
+        result = self._result
+        for depth in range(len(path) - 2, -1, -1):
+            node = path[depth]
+            to_move = player if depth % 2 == 0 else 1 - player
+            first = self._first_child[node]
+            unproven = draw = False
+            outcome = 1 - to_move
+            for child in range(first, first + self._child_count[node]):
+                child_result = result[child]
+                if child_result == to_move:
+                    outcome = to_move
+                    break
+                if child_result == ONGOING:
+                    unproven = True
+                elif child_result == DRAW:
+                    draw = True
+            else:
+                if unproven:
+                    return
+                if draw:
+                    outcome = DRAW
+            result[node] = outcome
+
+    def _expand(self, node: int, board: BitBoard, to_move: int) -> None:
+        '''
+        Add a child for every legal move, in BitBoard.legal_moves() order, and record which ones end the game.
+        '''
+        moves = board.legal_moves()
+        self._first_child[node] = len(self._parent)
+        self._child_count[node] = len(moves)
+        fills_board = board.count + 1 == board.cells
+        for move in moves:
+            bit = 1 << move
+            board.masks[to_move] |= bit
+            if board.has_won_at(move, to_move):
+                outcome = to_move
+            else:
+                outcome = DRAW if fills_board else ONGOING
+            board.masks[to_move] &= ~bit
+            self._parent.append(node)
+            self._move.append(move)
+            self._first_child.append(0)
+            self._child_count.append(0)
+            self._visits.append(0)
+            self._wins.append(0.0)
+            self._result.append(outcome)
+
+    def _play_out(self, board: BitBoard, to_move: int) -> int:
+        '''
+        Play random moves until the game ends, without changing board.
+        Returns:
+            The winning player, or DRAW.
+        '''
+        masks = board.masks[:]
+        cell_masks = board.geometry.cell_masks
+        moves = board.legal_moves()
+        self._rng.shuffle(moves)
+        for move in moves:
+            mask = masks[to_move] | (1 << move)
+            masks[to_move] = mask
+            for win in cell_masks[move]:
+                if mask & win == win:
+                    return to_move
+            to_move = 1 - to_move
+        return DRAW
@@ -1,10 +1,27 @@
+from game.ai import NegamaxEngine
+from game.tablebase import TablebaseEngine
+
+# Per move search budget for AI players created without an engine. Keeps large boards responsive.
+DEFAULT_AI_TIME_LIMIT = 1.0
+
+def default_engine():
+    '''
+    Perfect play from the tablebase on 3x3 boards, and a NegamaxEngine limited to
+    DEFAULT_AI_TIME_LIMIT seconds per move on other boards.
+    '''
+    return TablebaseEngine(NegamaxEngine(time_limit=DEFAULT_AI_TIME_LIMIT))
+
 class Player:
     LOCAL = 0
     LAN = 1
+    AI = 2
 
-    def __init__(self, mode=LOCAL) -> None:
+    def __init__(self, mode=LOCAL, engine=None) -> None:
         self.symbol = None
         self.mode = mode
+        self.engine = engine
+        if mode == Player.AI and engine is None:
+            self.engine = default_engine()
 
     def set_as_x(self) -> None:
         self.symbol = 'X'
@@ -12,5 +29,13 @@ class Player:
     def set_as_o(self) -> None:
         self.symbol = 'O'
 
-    def set_mode(self, mode) -> None:
-        self.mode = mode
\ No newline at end of file
+    def set_mode(self, mode, engine=None) -> None:
+        '''
+        Set how this player's moves are chosen.
+        An AI player without an engine gets default_engine().
+        '''
+        self.mode = mode
+        if engine is not None:
+            self.engine = engine
+        elif mode == Player.AI and self.engine is None:
+            self.engine = default_engine()
\ No newline at end of file
@@ -0,0 +1,299 @@
+'''
+Compact binary game records.
+
+A journal file holds one record per game, appended as the game is played:
+    12 byte header: magic, version, width, height, win length, game mode, player X mode,
+                    player O mode, result, move count
+    moves: cell indices. Boards of up to 16 cells pack two moves per byte, the earlier move in the low 4 bits.
+           Boards of up to 256 cells use one byte per move.
+           Larger boards use two bytes per move, a little-endian unsigned short ('<H').
+An index file next to the journal holds one 8 byte journal offset per game,
+so any game can be read in O(1) through a memory map.
+'''
+
+import mmap
+import os
+import struct
+
+from game.bitboard import get_geometry
+
+RECORD_MAGIC = b'GR'
+RECORD_VERSION = 1
+RECORD_HEADER = struct.Struct('<2sBBBBBBBBH')
+INDEX_ENTRY = struct.Struct('<Q')
+
+RESULT_DRAW = 0
+RESULT_X = 1
+RESULT_O = 2
+RESULT_UNFINISHED = 3
+
+# Offsets of the fields patched while a game is in progress.
+_RESULT_OFFSET = 9
+_MOVE_COUNT_OFFSET = 10
+_RESULT_AND_COUNT = struct.Struct('<BH')
+
+
+def index_path(journal_path: str) -> str:
+    return journal_path + '.idx'
+
+
+def moves_size(cells: int, move_count: int) -> int:
+    '''
+    Returns the number of bytes used by move_count moves on a board with cells cells.
+    '''
+    if cells <= 16:
+        return (move_count + 1) // 2
+    if cells <= 256:
+        return move_count
+    return 2 * move_count
+
+
+def encode_moves(cells: int, moves) -> bytes:
+    if cells <= 16:
+        packed = bytearray(moves_size(cells, len(moves)))
+        for i, move in enumerate(moves):
+            packed[i // 2] |= move << (4 * (i % 2))
+        return bytes(packed)
+    if cells <= 256:
+        return bytes(moves)
+    return struct.pack(f'<{len(moves)}H', *moves)
+
+
+def decode_moves(cells: int, data, move_count: int) -> list:
+    if cells <= 16:
+        return [(data[i // 2] >> (4 * (i % 2))) & 0xF for i in range(move_count)]
+    if cells <= 256:
+        return list(data[:move_count])
+    return list(struct.unpack_from(f'<{move_count}H', data))
+
+
+class GameRecord:
+    '''
+    One recorded game. moves holds cell indices (row * width + col) in the order they were played, X first.
+    '''
+
+    __slots__ = ('width', 'height', 'win_length', 'mode', 'player_x_mode', 'player_o_mode', 'result', 'moves')
+
+    def __init__(self, width, height, win_length, mode, player_x_mode, player_o_mode, result, moves):
+        self.width = width
+        self.height = height
+        self.win_length = win_length
+        self.mode = mode
+        self.player_x_mode = player_x_mode
+        self.player_o_mode = player_o_mode
+        self.result = result
+        self.moves = moves
+
+    @classmethod
+    def decode(cls, data, offset: int = 0) -> tuple:
+        '''
+        Decode the record at offset.
+        Returns:
+            A tuple (record, offset of the next record).
+        '''
+        magic, version, width, height, win_length, mode, x_mode, o_mode, result, count = RECORD_HEADER.unpack_from(data, offset)
+        if magic != RECORD_MAGIC or version != RECORD_VERSION:
+            raise ValueError(f'No game record at offset {offset}.')
+        start = offset + RECORD_HEADER.size
+        end = start + moves_size(width * height, count)
+        moves = decode_moves(width * height, data[start:end], count)
+        return cls(width, height, win_length, mode, x_mode, o_mode, result, moves), end
+
+    def replay(self):
+        '''
+        Returns a headless Board with every recorded move played.
+        '''
+        from game.board import Board
+
+        board = Board(width=self.width, height=self.height, win_length=self.win_length, headless=True)
+        for move in self.moves:
+            board.play_move(*divmod(move, self.width))
+        return board
+
+    def key(self, canonical: bool = True) -> tuple:
+        '''
+        Returns a hashable key identifying the game: the board size and win length,
+        and the Zobrist hash of the position after every move.
+        Args:
+            canonical: give games that are rotations or reflections of each other the same key.
+        '''
+        geometry = get_geometry(self.width, self.height, self.win_length)
+        best = None
+        for keys in geometry.symmetric_zobrist if canonical else geometry.symmetric_zobrist[:1]:
+            h = 0
+            hashes = []
+            for ply, move in enumerate(self.moves):
+                h ^= keys[ply % 2][move]
+                hashes.append(h)
+            # The smallest sequence over all symmetries is the same for every symmetric copy of the game.
+            if best is None or hashes < best:
+                best = hashes
+        return self.width, self.height, self.win_length, tuple(best)
+
+    def __repr__(self) -> str:
+        return f'GameRecord({self.width}x{self.height}/{self.win_length}, result={self.result}, moves={self.moves})'
+
+
+class GameWriter:
+    '''
+    Appends games to a journal and its index.
+    Moves are written as they are played. The header's result and move count are patched in place,
+    so an interrupted game is still readable, with RESULT_UNFINISHED.
+    One writer records one game at a time.
+    '''
+
+    def __init__(self, path: str):
+        self._journal = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        self._index = open(index_path(path), 'ab')
+        self._offset = None
+        self._cells = 0
+        self._moves = []
+
+    def begin_game(self, width, height, win_length, mode=0, player_x_mode=0, player_o_mode=0) -> None:
+        if self._offset is not None:
+            self.end_game(RESULT_UNFINISHED)
+        self._cells = width * height
+        self._moves = []
+        self._offset = self._journal.seek(0, os.SEEK_END)
+        self._journal.write(RECORD_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, width, height, win_length,
+                                               mode, player_x_mode, player_o_mode, RESULT_UNFINISHED, 0))
+        self._index.write(INDEX_ENTRY.pack(self._offset))
+        self._index.flush()
+
+    def in_game(self) -> bool:
+        return self._offset is not None
+
+    def record_move(self, index: int) -> None:
+        self._moves.append(index)
+        count = len(self._moves)
+        start = self._offset + RECORD_HEADER.size
+        if self._cells <= 16:
+            # The last byte holds this move and possibly the one before it.
+            byte_index = (count - 1) // 2
+            self._journal.seek(start + byte_index)
+            self._journal.write(encode_moves(self._cells, self._moves[2 * byte_index:]))
+        else:
+            self._journal.seek(start + moves_size(self._cells, count - 1))
+            self._journal.write(encode_moves(self._cells, [index]))
+        self._journal.seek(self._offset + _RESULT_OFFSET)
+        self._journal.write(_RESULT_AND_COUNT.pack(RESULT_UNFINISHED, count))
+        self._journal.flush()
+
+    def end_game(self, result: int) -> None:
+        if self._offset is None:
+            return
+        self._journal.seek(self._offset + _RESULT_OFFSET)
+        self._journal.write(_RESULT_AND_COUNT.pack(result, len(self._moves)))
+        self._journal.flush()
+        self._offset = None
+
+    def write_game(self, record: GameRecord) -> None:
+        '''
+        Append a complete game in one go.
+        '''
+        self.begin_game(record.width, record.height, record.win_length,
+                        record.mode, record.player_x_mode, record.player_o_mode)
+        self._moves = list(record.moves)
+        self._journal.write(encode_moves(self._cells, self._moves))
+        self.end_game(record.result)
+
+    def close(self) -> None:
+        if self._offset is not None:
+            self.end_game(RESULT_UNFINISHED)
+        self._journal.close()
+        self._index.close()
+
+    def __enter__(self) -> 'GameWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class GameArchive:
+    '''
+    Random access to a journal through its index. Both files are memory mapped, so
+    archive[i] reads only the bytes of game i.
+    '''
+
+    def __init__(self, path: str):
+        self._journal_file = open(path, 'rb')
+        self._index_file = open(index_path(path), 'rb')
+        self._journal = self._map(self._journal_file)
+        self._index = self._map(self._index_file)
+
+    @staticmethod
+    def _map(f):
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self._index) // INDEX_ENTRY.size
+
+    def __getitem__(self, i: int) -> GameRecord:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Game index out of range.')
+        offset, = INDEX_ENTRY.unpack_from(self._index, i * INDEX_ENTRY.size)
+        return GameRecord.decode(self._journal, offset)[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self) -> None:
+        for mapped in (self._journal, self._index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        self._journal_file.close()
+        self._index_file.close()
+
+    def __enter__(self) -> 'GameArchive':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def unique_games(records, canonical: bool = True):
+    '''
+    Skip games that were already seen, e.g. unique_games(GameArchive(path)).
+    Args:
+        records: an iterable of GameRecord objects.
+        canonical: also skip rotations and reflections of games already seen.
+    Yields:
+        The first record of every distinct game.
+    '''
+    seen = set()
+    for record in records:
+        key = record.key(canonical)
+        if key not in seen:
+            seen.add(key)
+            yield record
+
+
+def iter_games(path: str, chunk_size: int = 1 << 16):
+    '''
+    Stream every game in a journal in order without the index or loading the whole file.
+    Yields:
+        GameRecord objects.
+    '''
+    with open(path, 'rb') as f:
+        buf = b''
+        offset = 0
+        while True:
+            chunk = f.read(chunk_size)
+            buf = buf[offset:] + chunk
+            offset = 0
+            while len(buf) - offset >= RECORD_HEADER.size:
+                width, height = buf[offset + 3], buf[offset + 4]
+                count = struct.unpack_from('<H', buf, offset + _MOVE_COUNT_OFFSET)[0]
+                end = offset + RECORD_HEADER.size + moves_size(width * height, count)
+                if end > len(buf):
+                    break
+                record, offset = GameRecord.decode(buf, offset)
+                yield record
+            if not chunk:
+                return
@@ -0,0 +1,92 @@
+'''
+Terminal renderer for the board.
+Each frame is built in a buffer and written with a single write.
+On an ANSI terminal only the cells that changed since the last frame are repainted, using cursor positioning,
+so no clear-screen process is spawned per move. Headless renderers draw nothing.
+'''
+
+import os
+import sys
+
+CLEAR_SCREEN = '\x1b[2J\x1b[H'
+CLEAR_TO_END = '\x1b[J'
+
+
+def move_cursor(line: int, column: int) -> str:
+    '''
+    ANSI sequence moving the cursor to a 1-based line and column.
+    '''
+    return f'\x1b[{line};{column}H'
+
+
+class TerminalRenderer:
+    '''
+    Draws a grid of symbols like:
+         X | O |
+        ---+---+---
+    '''
+
+    def __init__(self, stream=None, headless=False, ansi=None):
+        '''
+        Args:
+            stream: the text stream to draw on. Defaults to sys.stdout.
+            headless: draw nothing at all.
+            ansi: whether the stream understands ANSI escape codes. Defaults to stream.isatty().
+                Without ANSI support every frame is written in full.
+        '''
+        self.headless = headless
+        self._stream = stream if stream is not None else sys.stdout
+        if ansi is None:
+            isatty = getattr(self._stream, 'isatty', None)
+            ansi = bool(isatty and isatty())
+        self._ansi = ansi
+        if ansi and os.name == 'nt':
+            # Enables ANSI escape code handling in the Windows console.
+            os.system('')
+        self._last_grid = None
+
+    def reset(self) -> None:
+        '''
+        Forget the last frame so the next render() redraws everything.
+        '''
+        self._last_grid = None
+
+    def render(self, grid) -> None:
+        if self.headless:
+            return
+        if not self._ansi:
+            self._write(self._full_frame(grid))
+            return
+
+        if self._last_grid is None or len(grid) != len(self._last_grid) or len(grid[0]) != len(self._last_grid[0]):
+            frame = CLEAR_SCREEN + self._full_frame(grid)
+        else:
+            parts = []
+            for i, row in enumerate(grid):
+                for k, symbol in enumerate(row):
+                    if symbol != self._last_grid[i][k]:
+                        parts.append(move_cursor(2 * i + 1, 4 * k + 2) + symbol)
+            # Put the cursor under the board and clear the messages from the last turn.
+            parts.append(move_cursor(2 * len(grid), 1) + CLEAR_TO_END)
+            frame = ''.join(parts)
+        self._last_grid = [list(row) for row in grid]
+        self._write(frame)
+
+    def message(self, text: str) -> None:
+        '''
+        Write a line of text below the board.
+        '''
+        if not self.headless:
+            self._write(text + '\n')
+
+    def _full_frame(self, grid) -> str:
+        width = len(grid[0])
+        separator = '+'.join(['---'] * width)
+        lines = []
+        for row in grid:
+            lines.append('|'.join(f' {symbol} ' for symbol in row))
+        return ('\n' + separator + '\n').join(lines) + '\n'
+
+    def _write(self, text: str) -> None:
+        self._stream.write(text)
+        self._stream.flush()
@@ -0,0 +1,151 @@
+'''
+Headless batch simulator.
+Plays many games at once with NumPy. Boards are stored as an (N, cells) int8 array where
+0 is empty, 1 is X and -1 is O. Every step of a game (legal moves, move selection and win
+detection) is a vectorized operation over all unfinished games, so there is no per-game Python loop.
+Requires NumPy.
+'''
+
+import time
+
+import numpy as np
+
+from game.bitboard import get_geometry
+
+EMPTY = 0
+X_VALUE = 1
+O_VALUE = -1
+
+
+class SimulationStats:
+    '''
+    Aggregate outcome statistics for a set of simulated games.
+    '''
+
+    def __init__(self) -> None:
+        self.games = 0
+        self.x_wins = 0
+        self.o_wins = 0
+        self.draws = 0
+        self.total_moves = 0
+        self.elapsed = 0.0
+
+    def add(self, outcomes, lengths) -> None:
+        self.games += len(outcomes)
+        self.x_wins += int(np.count_nonzero(outcomes == X_VALUE))
+        self.o_wins += int(np.count_nonzero(outcomes == O_VALUE))
+        self.draws += int(np.count_nonzero(outcomes == EMPTY))
+        self.total_moves += int(lengths.sum())
+
+    @property
+    def mean_length(self) -> float:
+        return self.total_moves / self.games if self.games else 0.0
+
+    @property
+    def games_per_second(self) -> float:
+        return self.games / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'games': self.games,
+            'x_wins': self.x_wins,
+            'o_wins': self.o_wins,
+            'draws': self.draws,
+            'mean_length': self.mean_length,
+            'elapsed': self.elapsed,
+            'games_per_second': self.games_per_second,
+        }
+
+    def __repr__(self) -> str:
+        return f'SimulationStats({self.as_dict()})'
+
+
+class BatchSimulator:
+    '''
+    Simulates batches of m,n,k games.
+    A policy chooses moves for a player. It is either None for uniform random play,
+    an array of per-cell weights with shape (cells,) or a callable taking (boards, value)
+    and returning weights with shape (N, cells). Illegal cells are never chosen.
+    '''
+
+    def __init__(self, width=3, height=3, win_length=3, seed=None) -> None:
+        self.geometry = get_geometry(width, height, win_length)
+        self._rng = np.random.default_rng(seed)
+        self._cell_windows = self._build_cell_windows()
+
+    def _build_cell_windows(self):
+        '''
+        Builds a (cells, max windows, win_length) array holding the cell indices of every winning
+        window through each cell. Cells on fewer windows are padded by repeating their first window.
+        '''
+        geometry = self.geometry
+        windows = []
+        for masks in geometry.cell_masks:
+            cell_windows = [[i for i in range(geometry.cells) if (mask >> i) & 1] for mask in masks]
+            windows.append(cell_windows)
+        max_windows = max(len(cell_windows) for cell_windows in windows)
+        for cell_windows in windows:
+            cell_windows.extend([cell_windows[0]] * (max_windows - len(cell_windows)))
+        return np.array(windows, dtype=np.intp)
+
+    def run_batch(self, n: int, policy_x=None, policy_o=None) -> tuple:
+        '''
+        Play n games to completion.
+        Returns:
+            A tuple (boards, outcomes, lengths). outcomes holds X_VALUE, O_VALUE or EMPTY for a draw.
+        '''
+        cells = self.geometry.cells
+        boards = np.zeros((n, cells), dtype=np.int8)
+        outcomes = np.zeros(n, dtype=np.int8)
+        lengths = np.zeros(n, dtype=np.int16)
+
+        active = np.arange(n)
+        value = X_VALUE
+        for ply in range(cells):
+            if active.size == 0:
+                break
+            policy = policy_x if value == X_VALUE else policy_o
+            moves = self._select_moves(boards[active], value, policy)
+            boards[active, moves] = value
+            lengths[active] = ply + 1
+
+            # Only the windows through the move just played can have been completed.
+            lines = boards[active[:, None, None], self._cell_windows[moves]]
+            won = (lines == value).all(axis=2).any(axis=1)
+            outcomes[active[won]] = value
+            active = active[~won]
+            value = -value
+
+        return boards, outcomes, lengths
+
+    def simulate(self, n_games: int, policy_x=None, policy_o=None, batch_size=1 << 16) -> SimulationStats:
+        '''
+        Play n_games in batches of at most batch_size and aggregate the results.
+        '''
+        stats = SimulationStats()
+        start = time.perf_counter()
+        remaining = n_games
+        while remaining > 0:
+            n = min(batch_size, remaining)
+            _, outcomes, lengths = self.run_batch(n, policy_x, policy_o)
+            stats.add(outcomes, lengths)
+            remaining -= n
+        stats.elapsed = time.perf_counter() - start
+        return stats
+
+    def _select_moves(self, boards, value: int, policy):
+        legal = boards == EMPTY
+        if policy is None:
+            scores = self._rng.random(boards.shape)
+            scores[~legal] = -1.0
+            return scores.argmax(axis=1)
+
+        weights = policy(boards, value) if callable(policy) else np.broadcast_to(policy, boards.shape)
+        # Gumbel-max trick: sampling proportional to the weights in one argmax.
+        with np.errstate(divide='ignore'):
+            scores = np.log(np.asarray(weights, dtype=np.float64)) + self._rng.gumbel(size=boards.shape)
+        scores[~legal] = -np.inf
+        # Fall back to the first legal cell when every legal cell has zero weight.
+        stuck = np.isneginf(scores).all(axis=1)
+        scores[stuck] = np.where(legal[stuck], 0.0, -np.inf)
+        return scores.argmax(axis=1)
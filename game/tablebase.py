@@ -0,0 +1,288 @@
+'''
+Precomputed perfect play for standard 3x3 tic-tac-toe.
+Every position reachable from the empty board is solved once and written to a table on disk.
+A position is looked up by the base 3 code of its canonical form, the smallest code among its 8 rotations
+and reflections, so only 765 positions are solved. Each 2 byte entry holds the value for the player to move,
+the best move in the canonical orientation and the number of plies until the game ends with perfect play.
+Only the solved positions are stored: a header, the sorted 2 byte codes, then the entries in the same order.
+The table is memory mapped and a lookup is a binary search of the codes, with no game tree search.
+
+Usage (from the repository root):
+    python -m game.tablebase [path]    Generate the table.
+'''
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+
+from game.ai import NegamaxEngine, WIN_SCORE
+from game.bitboard import BitBoard, get_geometry
+
+TABLE_MAGIC = b'TTTB'
+TABLE_VERSION = 2
+# Magic, version and the number of positions stored.
+TABLE_HEADER = struct.Struct('<4sBI')
+TABLE_KEY = struct.Struct('<H')
+TABLE_ENTRY = struct.Struct('<H')
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tablebase.bin')
+
+# Values for the player to move.
+LOSS = 1
+DRAW = 2
+WIN = 3
+
+NO_MOVE = 0xF
+
+_GEOMETRY = get_geometry(3, 3, 3)
+
+# MASK_TRANSFORMS[s][mask] is mask with every cell moved by symmetry s of the board geometry.
+MASK_TRANSFORMS = [
+    tuple(sum(1 << perm[i] for i in range(9) if (mask >> i) & 1) for mask in range(512))
+    for perm in _GEOMETRY.symmetries
+]
+
+# BASE3[mask] is the base 3 number with a 1 digit for every set bit, so a position's code is
+# BASE3[x_mask] + 2 * BASE3[o_mask].
+BASE3 = tuple(sum(3 ** i for i in range(9) if (mask >> i) & 1) for mask in range(512))
+
+
+def canonical(x_mask: int, o_mask: int) -> tuple:
+    '''
+    Returns:
+        A tuple (code, symmetry) where code is the smallest code among the symmetric positions
+        and symmetry is the index in Geometry.symmetries that produces it.
+    '''
+    best_code = None
+    best_symmetry = 0
+    for s, transform in enumerate(MASK_TRANSFORMS):
+        code = BASE3[transform[x_mask]] + 2 * BASE3[transform[o_mask]]
+        if best_code is None or code < best_code:
+            best_code = code
+            best_symmetry = s
+    return best_code, best_symmetry
+
+
+def encode_entry(value: int, move: int, distance: int) -> int:
+    return (value << 8) | (distance << 4) | move
+
+
+def decode_entry(entry: int) -> tuple:
+    '''
+    Returns:
+        A tuple (value, move, distance).
+    '''
+    return entry >> 8, entry & 0xF, (entry >> 4) & 0xF
+
+
+def _has_won(mask: int) -> bool:
+    return any(mask & win == win for win in _GEOMETRY.win_masks)
+
+
+def generate() -> dict:
+    '''
+    Solve every position reachable from the empty board.
+    Returns:
+        A dict of encoded entries keyed by canonical code.
+    '''
+    table = {}
+
+    def solve(x_mask, o_mask):
+        code, s = canonical(x_mask, o_mask)
+        if code in table:
+            return decode_entry(table[code])
+        x_mask, o_mask = MASK_TRANSFORMS[s][x_mask], MASK_TRANSFORMS[s][o_mask]
+        x_to_move = bin(x_mask).count('1') == bin(o_mask).count('1')
+        previous = o_mask if x_to_move else x_mask
+        occupied = x_mask | o_mask
+
+        if _has_won(previous):
+            result = (LOSS, NO_MOVE, 0)
+        elif occupied == _GEOMETRY.full_mask:
+            result = (DRAW, NO_MOVE, 0)
+        else:
+            result = None
+            for move in _GEOMETRY.move_order:
+                bit = 1 << move
+                if occupied & bit:
+                    continue
+                if x_to_move:
+                    child_value, _, child_distance = solve(x_mask | bit, o_mask)
+                else:
+                    child_value, _, child_distance = solve(x_mask, o_mask | bit)
+                value = WIN + LOSS - child_value if child_value != DRAW else DRAW
+                candidate = (value, move, child_distance + 1)
+                if result is None or _better(candidate, result):
+                    result = candidate
+        table[code] = encode_entry(*result)
+        return result
+
+    solve(0, 0)
+    return table
+
+
+def _better(a: tuple, b: tuple) -> bool:
+    '''
+    Compares two (value, move, distance) choices for the player to move.
+    Wins are taken as soon as possible and losses put off as long as possible.
+    '''
+    if a[0] != b[0]:
+        return a[0] > b[0]
+    if a[0] == WIN:
+        return a[2] < b[2]
+    if a[0] == LOSS:
+        return a[2] > b[2]
+    return False
+
+
+def write_tablebase(path: str = DEFAULT_PATH) -> None:
+    table = generate()
+    codes = sorted(table)
+    data = b''.join((
+        TABLE_HEADER.pack(TABLE_MAGIC, TABLE_VERSION, len(codes)),
+        struct.pack(f'<{len(codes)}H', *codes),
+        struct.pack(f'<{len(codes)}H', *(table[code] for code in codes)),
+    ))
+    # Write to a temporary file first so readers never map a partial table.
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+class Tablebase:
+    '''
+    Read-only view of a generated table.
+    '''
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        '''
+        Raises:
+            ValueError if the file is not a tablebase of the current version, e.g. one written by an older version.
+        '''
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < TABLE_HEADER.size:
+            self._map.close()
+            raise ValueError(f'{path} is not a version {TABLE_VERSION} tablebase.')
+        magic, version, count = TABLE_HEADER.unpack_from(self._map)
+        if (magic != TABLE_MAGIC or version != TABLE_VERSION
+                or len(self._map) != TABLE_HEADER.size + count * (TABLE_KEY.size + TABLE_ENTRY.size)):
+            self._map.close()
+            raise ValueError(f'{path} is not a version {TABLE_VERSION} tablebase.')
+        # The codes are searched on every lookup, so they are copied into an array once.
+        self._codes = array('H')
+        self._codes.frombytes(self._map[TABLE_HEADER.size:TABLE_HEADER.size + count * TABLE_KEY.size])
+        if sys.byteorder == 'big':
+            self._codes.byteswap()
+        self._entries_offset = TABLE_HEADER.size + count * TABLE_KEY.size
+
+    @staticmethod
+    def supports(board: BitBoard) -> bool:
+        return board.geometry is _GEOMETRY
+
+    def lookup(self, board: BitBoard) -> tuple:
+        '''
+        Args:
+            board: a 3x3 position with X to move if both players have the same number of pieces, O otherwise.
+        Returns:
+            A tuple (value, move, distance) for the player to move. move is a cell index of board,
+            or None if the game is over.
+        '''
+        if not self.supports(board):
+            raise ValueError('The tablebase only covers 3x3 boards with a win length of 3.')
+        code, s = canonical(board.masks[0], board.masks[1])
+        i = bisect_left(self._codes, code)
+        if i == len(self._codes) or self._codes[i] != code:
+            raise ValueError('Position is not reachable in a legal game.')
+        entry, = TABLE_ENTRY.unpack_from(self._map, self._entries_offset + i * TABLE_ENTRY.size)
+        value, move, distance = decode_entry(entry)
+        if move == NO_MOVE:
+            return value, None, distance
+        return value, _GEOMETRY.inverse_symmetries[s][move], distance
+
+    def best_move(self, board: BitBoard):
+        return self.lookup(board)[1]
+
+    def evaluate(self, board: BitBoard) -> int:
+        '''
+        Returns the value for the player to move on the same scale as NegamaxEngine.evaluate().
+        '''
+        value, _, distance = self.lookup(board)
+        if value == WIN:
+            return WIN_SCORE - distance
+        if value == LOSS:
+            return -(WIN_SCORE - distance)
+        return 0
+
+    def close(self) -> None:
+        self._map.close()
+
+
+@lru_cache(maxsize=None)
+def get_tablebase(path: str = DEFAULT_PATH) -> Tablebase:
+    '''
+    Returns the shared Tablebase for path, generating the file first if it does not exist
+    or was written by another version.
+    '''
+    if not os.path.exists(path):
+        write_tablebase(path)
+    try:
+        return Tablebase(path)
+    except ValueError:
+        write_tablebase(path)
+        return Tablebase(path)
+
+
+class TablebaseEngine:
+    '''
+    Engine with the same interface as NegamaxEngine that answers 3x3 positions from the tablebase.
+    Other board sizes are passed to a fallback engine.
+    '''
+
+    def __init__(self, fallback=None, path: str = DEFAULT_PATH) -> None:
+        '''
+        Args:
+            fallback: the engine used for boards the tablebase does not cover. Defaults to a NegamaxEngine.
+            path: the table file, generated on first use if missing.
+        '''
+        self.fallback = fallback if fallback is not None else NegamaxEngine()
+        self._path = path
+
+    def _covers(self, board: BitBoard, player: int) -> bool:
+        # The table stores positions for the player who moves next in a normal game.
+        return Tablebase.supports(board) and player == (board.count % 2)
+
+    def clear(self) -> None:
+        self.fallback.clear()
+
+    def choose_move(self, board: BitBoard, player: int) -> int:
+        if self._covers(board, player):
+            move = get_tablebase(self._path).best_move(board)
+            if move is None:
+                raise ValueError('No legal moves.')
+            return move
+        return self.fallback.choose_move(board, player)
+
+    def analyze(self, board: BitBoard, player: int) -> tuple:
+        if self._covers(board, player):
+            tablebase = get_tablebase(self._path)
+            move = tablebase.best_move(board)
+            if move is None:
+                raise ValueError('No legal moves.')
+            return tablebase.evaluate(board), move
+        return self.fallback.analyze(board, player)
+
+    def evaluate(self, board: BitBoard, player: int) -> int:
+        if self._covers(board, player):
+            return get_tablebase(self._path).evaluate(board)
+        return self.fallback.evaluate(board, player)
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH
+    write_tablebase(path)
+    print(f'Wrote {path}')
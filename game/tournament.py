@@ -0,0 +1,213 @@
+'''
+Self-play tournament runner.
+Plays round-robin matches between player strategies on a pool of worker processes.
+Workers drive Board through its headless play_move() path and send back one small tuple per batch of games.
+'''
+
+import argparse
+import itertools
+import multiprocessing
+import random
+import time
+
+from game.ai import NegamaxEngine
+from game.bitboard import SYMBOLS
+from game.board import Board
+
+
+class RandomStrategy:
+    '''
+    Plays a uniformly random legal move.
+    '''
+
+    def __init__(self) -> None:
+        self._rng = random.Random()
+
+    def reset(self, seed=None) -> None:
+        self._rng.seed(seed)
+
+    def choose_move(self, board: Board) -> tuple:
+        move = self._rng.choice(board.bitboard.legal_moves())
+        return divmod(move, board.width)
+
+
+class ScriptedStrategy:
+    '''
+    Plays the first legal move from a fixed list of (row, col) moves.
+    Falls back to a random legal move once the script has nothing legal left.
+    '''
+
+    def __init__(self, moves) -> None:
+        self.moves = [tuple(move) for move in moves]
+        self._fallback = RandomStrategy()
+
+    def reset(self, seed=None) -> None:
+        self._fallback.reset(seed)
+
+    def choose_move(self, board: Board) -> tuple:
+        for row, col in self.moves:
+            if board.is_legal(row, col):
+                return row, col
+        return self._fallback.choose_move(board)
+
+
+class AIStrategy:
+    '''
+    Plays the move chosen by a NegamaxEngine.
+    The engine's transposition table is kept between games in the same worker.
+    '''
+
+    def __init__(self, max_depth=None, time_limit=None) -> None:
+        self.engine = NegamaxEngine(max_depth, time_limit)
+
+    def reset(self, seed=None) -> None:
+        pass
+
+    def choose_move(self, board: Board) -> tuple:
+        move = self.engine.choose_move(board.bitboard, SYMBOLS.index(board.turn.symbol))
+        return divmod(move, board.width)
+
+
+def play_game(strategy_x, strategy_o, width=3, height=3, win_length=3) -> tuple:
+    '''
+    Play a single headless game.
+    Returns:
+        A tuple (winner, moves) where winner is 'X', 'O' or None for a draw.
+    '''
+    board = Board(width=width, height=height, win_length=win_length)
+    moves = 0
+    while not board.is_over():
+        strategy = strategy_x if board.turn is board.player_x else strategy_o
+        row, col = strategy.choose_move(board)
+        board.play_move(row, col)
+        moves += 1
+    return board.winner, moves
+
+
+def _play_batch(task: tuple) -> tuple:
+    '''
+    Worker entry point. Plays a batch of games between two strategies.
+    Returns:
+        (name_x, name_o, x_wins, o_wins, draws, moves)
+    '''
+    name_x, name_o, strategy_x, strategy_o, games, seed, dimensions = task
+    strategy_x.reset(seed)
+    strategy_o.reset(None if seed is None else seed + 1)
+
+    x_wins = o_wins = draws = moves = 0
+    for _ in range(games):
+        winner, length = play_game(strategy_x, strategy_o, *dimensions)
+        moves += length
+        if winner == 'X':
+            x_wins += 1
+        elif winner == 'O':
+            o_wins += 1
+        else:
+            draws += 1
+    return name_x, name_o, x_wins, o_wins, draws, moves
+
+
+class TournamentResult:
+    '''
+    Aggregated tournament results.
+    self.table maps (name, opponent) to [wins, draws, losses] for name, counting games with either symbol.
+    '''
+
+    def __init__(self, names) -> None:
+        self.names = list(names)
+        self.table = {(a, b): [0, 0, 0] for a in self.names for b in self.names if a != b}
+        self.games = 0
+        self.moves = 0
+        self.elapsed = 0.0
+
+    def add_batch(self, name_x, name_o, x_wins, o_wins, draws, moves) -> None:
+        x_row = self.table[(name_x, name_o)]
+        o_row = self.table[(name_o, name_x)]
+        x_row[0] += x_wins
+        x_row[1] += draws
+        x_row[2] += o_wins
+        o_row[0] += o_wins
+        o_row[1] += draws
+        o_row[2] += x_wins
+        self.games += x_wins + o_wins + draws
+        self.moves += moves
+
+    @property
+    def games_per_second(self) -> float:
+        return self.games / self.elapsed if self.elapsed else 0.0
+
+    def totals(self, name) -> list:
+        '''
+        Returns [wins, draws, losses] for name against every opponent.
+        '''
+        totals = [0, 0, 0]
+        for (a, _), row in self.table.items():
+            if a == name:
+                for i in range(3):
+                    totals[i] += row[i]
+        return totals
+
+    def format_table(self) -> str:
+        lines = [f'{"player":<12}{"opponent":<12}{"wins":>8}{"draws":>8}{"losses":>8}']
+        for (a, b), (wins, draws, losses) in sorted(self.table.items()):
+            lines.append(f'{a:<12}{b:<12}{wins:>8}{draws:>8}{losses:>8}')
+        lines.append(f'{self.games} games in {self.elapsed:.2f}s ({self.games_per_second:.0f} games/s)')
+        return '\n'.join(lines)
+
+
+def run_tournament(strategies: dict, games_per_pair=100, batch_size=50, width=3, height=3, win_length=3,
+                   processes=None, seed=None, progress=None) -> TournamentResult:
+    '''
+    Play a round-robin tournament where every strategy plays every other strategy as both X and O.
+    Args:
+        strategies: maps a name to a strategy object. Strategies must be picklable.
+        games_per_pair: the number of games for each ordered (X, O) pairing.
+        batch_size: the number of games a worker plays before reporting back.
+        width, height, win_length: the board to play on.
+        processes: the number of worker processes. None uses every core.
+        seed: base seed for random strategies. None gives different games every run.
+        progress: optional callable receiving the TournamentResult after every finished batch.
+    Returns:
+        A TournamentResult.
+    '''
+    dimensions = (width, height, win_length)
+    tasks = []
+    for name_x, name_o in itertools.permutations(strategies, 2):
+        remaining = games_per_pair
+        while remaining > 0:
+            games = min(batch_size, remaining)
+            task_seed = None if seed is None else seed + 2 * len(tasks)
+            tasks.append((name_x, name_o, strategies[name_x], strategies[name_o], games, task_seed, dimensions))
+            remaining -= games
+
+    result = TournamentResult(strategies)
+    start = time.perf_counter()
+    with multiprocessing.Pool(processes) as pool:
+        for batch in pool.imap_unordered(_play_batch, tasks):
+            result.add_batch(*batch)
+            result.elapsed = time.perf_counter() - start
+            if progress is not None:
+                progress(result)
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Run a self-play tournament.')
+    parser.add_argument('--games', type=int, default=1000, help='games per ordered pairing')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    strategies = {
+        'random': RandomStrategy(),
+        'center': ScriptedStrategy([(1, 1), (0, 0), (0, 2), (2, 0), (2, 2)]),
+        'ai': AIStrategy(),
+    }
+    result = run_tournament(strategies, args.games, args.batch_size, processes=args.processes, seed=args.seed)
+    print(result.format_table())
+
+
+if __name__ == '__main__':
+    main()
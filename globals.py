@@ -1,4 +1,6 @@
 from debug.dlogger import dLog
 
 dlogger = dLog(dLog.LOGLEVEL_QUIET)
-MULTIPLAYER_PORT = 12380
\ No newline at end of file
+MULTIPLAYER_PORT = 12380
+ANALYSIS_PORT = 12382
+SPECTATOR_PORT = 12383
\ No newline at end of file
@@ -0,0 +1,183 @@
+'''
+asyncio versions of Connection and ClientHandler.
+Receiving awaits the stream directly, so a coroutine wakes exactly when data arrives instead of polling with timeouts.
+Many games and background tasks can share one event loop.
+'''
+
+import asyncio
+
+from globals import dlogger
+from lan.connection import (Connection, FRAME_HEADER_BYTES, MAX_RECEIVE_FRAME_BYTES, PING_MSG, PONG_FRAME, encode_frame,
+                            decode_frame_header, is_control_frame)
+
+
+class AsyncConnection:
+    '''
+    A TCP connection to a peer built on asyncio streams.
+    Uses the same dynamic message framing as Connection, so it can talk to either kind of peer.
+    '''
+
+    def __init__(self, ip=None, port=None, reader=None, writer=None):
+        self._ip = ip
+        self._port = port
+        self._reader = reader
+        self._writer = writer
+        # Set by start_reader(). Messages read in the background wait here for dynamic_receive().
+        self._inbox = None
+        self._reader_task = None
+
+    @classmethod
+    def from_connection(cls, connection: Connection) -> 'AsyncConnection':
+        '''
+        Create an unconnected AsyncConnection to the same address as a Connection, e.g. one returned by check_lan_servers.
+        '''
+        return cls(ip=connection._ip, port=connection._port)
+
+    async def tcp_connect(self) -> bool:
+        '''
+        Open the TCP connection if it is not already open.
+        Returns:
+            True if connected, False if the connection was refused.
+        '''
+        if self._writer is not None:
+            dlogger.log_warning('A stream already exists for this AsyncConnection object.')
+            return True
+        try:
+            dlogger.log_info('Attempting to connect to %s at port %s...', self._ip, self._port)
+            self._reader, self._writer = await asyncio.open_connection(self._ip, self._port)
+            dlogger.log_info('Connected to %s at port %s.', self._ip, self._port)
+            return True
+        except ConnectionRefusedError:
+            dlogger.log_error('Connection refused from %s at port %s.', self._ip, self._port)
+            return False
+
+    def is_connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def dynamic_send(self, msg: str) -> bool:
+        '''
+        Sends a dynamic length msg as a single frame in one write.
+        Returns True if sent, False otherwise.
+        '''
+        if not self.is_connected():
+            dlogger.log_error('No stream exists for this AsyncConnection object.')
+            return False
+        self._writer.write(encode_frame(msg))
+        await self._writer.drain()
+        return True
+
+    def start_reader(self) -> None:
+        '''
+        Read from the stream in a background task from now on, so PINGs from a Heartbeat on the peer are
+        answered even while nothing is waiting in dynamic_receive().
+        '''
+        self._inbox = asyncio.Queue()
+        self._reader_task = asyncio.ensure_future(self._read_forever())
+
+    async def _read_forever(self) -> None:
+        while True:
+            msg = await self._read_frame()
+            await self._inbox.put(msg)
+            if msg is None:
+                return
+
+    async def dynamic_receive(self):
+        '''
+        Wait for the next dynamic length msg. Control messages in SPECIAL_CASE_MSGS are skipped.
+        Returns:
+            The message, or None if the peer closed the connection.
+        '''
+        if self._inbox is not None:
+            return await self._inbox.get()
+        return await self._read_frame()
+
+    async def _read_frame(self):
+        if self._reader is None:
+            dlogger.log_error('No stream exists for this AsyncConnection object.')
+            return None
+        while True:
+            try:
+                flags, length = decode_frame_header(await self._reader.readexactly(FRAME_HEADER_BYTES))
+                if length > MAX_RECEIVE_FRAME_BYTES:
+                    raise ValueError(f'Frame of {length} bytes from {self._ip} is too large.')
+                body = await self._reader.readexactly(length)
+                msg = body.decode('utf-8')
+            except ValueError as e:
+                # Also covers UnicodeDecodeError. The stream cannot be trusted after a bad frame.
+                dlogger.log_warning('%s', e)
+                if self._writer is not None:
+                    self._writer.close()
+                return None
+            except (asyncio.IncompleteReadError, ConnectionError):
+                dlogger.log_info('Connection to %s at port %s closed.', self._ip, self._port)
+                return None
+            if not is_control_frame(flags, msg):
+                return msg
+            if msg == PING_MSG and self.is_connected():
+                self._writer.write(PONG_FRAME)
+
+    async def close(self) -> None:
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except ConnectionError:
+                pass
+            self._writer = None
+
+
+class AsyncClientHandler:
+    '''
+    Accepts clients with an asyncio server.
+    Every client gets a reader task that puts its messages on a shared queue,
+    so receive() wakes as soon as any client sends something.
+    '''
+
+    def __init__(self, port):
+        self._port = port
+        self._server = None
+        self._clients = []
+        self._inbox = asyncio.Queue()
+        self._client_connected = asyncio.Event()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._on_client, port=self._port)
+        dlogger.log_info('Async host listening on port %s.', self._port)
+
+    async def _on_client(self, reader, writer) -> None:
+        address = writer.get_extra_info('peername')
+        client = AsyncConnection(ip=address[0], port=address[1], reader=reader, writer=writer)
+        self._clients.append(client)
+        self._client_connected.set()
+        while True:
+            msg = await client.dynamic_receive()
+            await self._inbox.put(msg)
+            if msg is None:
+                break
+        self._clients.remove(client)
+
+    def has_clients(self) -> bool:
+        return len(self._clients) > 0
+
+    async def wait_for_client(self) -> None:
+        await self._client_connected.wait()
+
+    async def send_all_clients(self, msg: str) -> None:
+        await asyncio.gather(*(client.dynamic_send(msg) for client in self._clients))
+
+    async def receive(self) -> str:
+        '''
+        Wait for the next message from any client.
+        Returns None when a client disconnects.
+        '''
+        return await self._inbox.get()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for client in list(self._clients):
+            await client.close()
@@ -1,11 +1,65 @@
 # Global packages/builtins
 import socket
+import struct
 import time
 
 # Package modules
 from globals import dlogger
 from lan.connection import Connection
 
+# A response to a broadcast is a single self-describing datagram:
+# magic, version, host load, game name length, payload length, then the game name and payload in UTF-8.
+RESPONSE_MAGIC = b'PYMR'
+RESPONSE_VERSION = 1
+RESPONSE_HEADER = struct.Struct('!4sBHBH')
+MAX_RESPONSE_BYTES = RESPONSE_HEADER.size + 0xFF + 0xFFFF
+
+DEFAULT_GAME_NAME = 'PYMULT'
+
+
+def encode_response(message: str, game: str = DEFAULT_GAME_NAME, load: int = 0) -> bytes:
+    '''
+    Build the datagram sent in response to a broadcast.
+    Args:
+        message: the payload for the searching client.
+        game: the name of the game being hosted.
+        load: how busy the host is, e.g. its number of connected clients. Clamped to 65535.
+    '''
+    game_bytes = game.encode('utf-8')
+    payload = message.encode('utf-8')
+    if len(game_bytes) > 0xFF or len(payload) > 0xFFFF:
+        raise ValueError('Game name or payload too long for a broadcast response.')
+    header = RESPONSE_HEADER.pack(RESPONSE_MAGIC, RESPONSE_VERSION, min(load, 0xFFFF), len(game_bytes), len(payload))
+    return header + game_bytes + payload
+
+
+def decode_response(datagram: bytes) -> dict:
+    '''
+    Parse a datagram built by encode_response.
+    Returns:
+        A dict with the keys version, load, game and message.
+    Raises:
+        ValueError if the datagram is not a valid response.
+    '''
+    if len(datagram) < RESPONSE_HEADER.size:
+        raise ValueError('Response too short.')
+    magic, version, load, game_len, payload_len = RESPONSE_HEADER.unpack_from(datagram)
+    if magic != RESPONSE_MAGIC:
+        raise ValueError('Response has the wrong magic.')
+    if version != RESPONSE_VERSION:
+        raise ValueError(f'Unsupported response version {version}.')
+    if len(datagram) != RESPONSE_HEADER.size + game_len + payload_len:
+        raise ValueError('Response length does not match its header.')
+    game_start = RESPONSE_HEADER.size
+    payload_start = game_start + game_len
+    return {
+        'version': version,
+        'load': load,
+        'game': datagram[game_start:payload_start].decode('utf-8'),
+        'message': datagram[payload_start:].decode('utf-8'),
+    }
+
+
 class BroadcastResponder(Connection):
     def __init__(self, port):
         '''
@@ -16,7 +70,7 @@ class BroadcastResponder(Connection):
         Returns:
             A Connection object.
         '''
-        dlogger.log_info('Creating socket to receive UDP broadcasts on port ' + str(port))
+        dlogger.log_info('Creating socket to receive UDP broadcasts on port %s', port)
 
         super().__init__(port=port)
 
@@ -46,7 +100,7 @@ class BroadcastResponder(Connection):
 
         # Bind to the port
         self._socket.bind(('', self._port))
-        dlogger.log_info('Broadcast socket bound to port ' + str(self._port))
+        dlogger.log_info('Broadcast socket bound to port %s', self._port)
 
         # Set timeout to be very very small
         self._socket.settimeout(0.01)
@@ -65,45 +119,48 @@ class BroadcastResponder(Connection):
         dlogger.log_info('Broadcast socket set.')
 
 
-    def respond_to_broadcast(self, message='') -> bool:
+    def respond_to_broadcast(self, message='', game=DEFAULT_GAME_NAME, load=0) -> bool:
         '''
         Listens for a very short period of time for a broadcast message.
         If a broadcast message is received, the message is sent back to the sender.
-        First message structure: 'PYMULT_SERVER_RESPONSE(1--)'
-        The second message contains a message the number of bytes in length as shown in the first message.
+        The response is a single datagram built by encode_response.
         The response message is sent on port + 1 to prevent conjestion.
         Args:
             message: The message to send back to the sender.
+            game: The name of the game being hosted.
+            load: How busy this host is, e.g. its number of connected clients.
         Returns:
             True if a message was received, False otherwise.
         '''
-        dlogger.log_debug('Listening for broadcast on port ' + str(self._port))
+        dlogger.log_debug('Listening for broadcast on port %s', self._port)
 
         # Briefly listen for a broadcast message.
         try:
             self._update_recent_request_addrs()
             msg, addr = self._socket.recvfrom(16)  # The broadcast message SHOULD contain exactly 16 bytes.
+            self.metrics.inc('broadcasts_received')
 
             # Make sure the message is not on the list of recently received messages.
             self._check_recent_request_addrs(addr)
 
-            dlogger.log_info('Received packet from ' + str(addr))
-            dlogger.log_info('Message: ' + str(msg))
+            dlogger.log_info('Received packet from %s', addr)
+            dlogger.log_info('Message: %s', msg)
 
             ip = addr[0]
 
             # In order for the broadcast to be valid, the first message must be 'PYMULT_BROADCAST'
             if msg != b'PYMULT_BROADCAST':
                 dlogger.log_warning('Invalid broadcast message received. Ignoring.')
+                self.metrics.inc('invalid_broadcasts')
                 return False
 
             dlogger.log_info('Sending response to broadcast.')
-            # Send both messages back to the sender on the port + 1.
-            identifier = f'PYMULT_SERVER_RESPONSE({len(message):<3})'
-            fullmsg = identifier + message
-            self._sender_socket.sendto(identifier.encode('utf-8'), (ip, self._port + 1))
-            self._sender_socket.sendto(message.encode('utf-8'), (ip, self._port + 1))
-            dlogger.log_info(f'Sent {fullmsg} as response to broadcast.')
+            # Send the response back to the sender on the port + 1.
+            response = encode_response(message, game, load)
+            self._sender_socket.sendto(response, (ip, self._port + 1))
+            self.metrics.inc('responses_sent')
+            self.metrics.inc('bytes_sent', len(response))
+            dlogger.log_info('Sent %s (%s, load %s) as response to broadcast.', message, game, load)
 
             return True
         except socket.timeout:
@@ -111,6 +168,7 @@ class BroadcastResponder(Connection):
             return False
         except RecentRequestAddr:
             dlogger.log_info('Broadcast message from recently received address. Ignoring.')
+            self.metrics.inc('duplicate_broadcasts_dropped')
             return False
 
 
@@ -1,9 +1,58 @@
 # Global packages/builtins
+import collections
+import select
 import socket
+import time
 
 # Package modules
 from globals import dlogger
-from lan.connection import Connection
+from lan.connection import Connection, encode_frame
+
+# What broadcast_to_spectators does with a spectator whose outbound queue is full.
+SLOW_SPECTATOR_DISCONNECT = 0   # Close the spectator's connection.
+SLOW_SPECTATOR_DROP_FRAMES = 1  # Skip the new frame for that spectator only.
+SLOW_SPECTATOR_BLOCK = 2        # Wait up to block_timeout for the queue to drain, then disconnect.
+
+DEFAULT_SPECTATOR_QUEUE_BYTES = 256 * 1024
+
+
+class Spectator:
+    """
+    A watcher connection with a bounded outbound queue.
+    The socket is non-blocking. Queued frames are shared with every other spectator and sent as the socket allows.
+    """
+
+    __slots__ = ('sock', 'address', 'queue', 'queued_bytes', 'offset')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.queue = collections.deque()
+        self.queued_bytes = 0
+        # Bytes of the first queued frame that were already sent.
+        self.offset = 0
+
+    def flush(self) -> bool:
+        """
+        Send as much of the queue as the socket accepts without blocking.
+        Returns:
+            bool: False if the connection was lost, True otherwise.
+        """
+        while self.queue:
+            frame = self.queue[0]
+            try:
+                sent = self.sock.send(frame[self.offset:])
+            except (BlockingIOError, InterruptedError):
+                return True
+            except OSError:
+                return False
+            self.offset += sent
+            self.queued_bytes -= sent
+            if self.offset < len(frame):
+                return True
+            self.queue.popleft()
+            self.offset = 0
+        return True
 
 
 class ClientHandler(Connection):
@@ -11,13 +60,27 @@ class ClientHandler(Connection):
     ClientHandler is a class that handles the connection to clients.
     """
 
-    def __init__(self, port, socket_accept_delay=0.01):
+    def __init__(self, port, socket_accept_delay=0.01, spectator_queue_bytes=DEFAULT_SPECTATOR_QUEUE_BYTES,
+                 slow_spectator_policy=SLOW_SPECTATOR_DISCONNECT, block_timeout=1.0, spectator_port=None):
         """
         Initialize the ClientHandler.
+        Args:
+            port: the TCP port to listen on.
+            socket_accept_delay: how long accept_clients waits for a connection. 0 means it never waits.
+            spectator_queue_bytes: the most bytes queued for one spectator.
+            slow_spectator_policy: one of the SLOW_SPECTATOR_* constants.
+            block_timeout: how long one broadcast may wait for full queues to drain under SLOW_SPECTATOR_BLOCK.
+            spectator_port: the TCP port spectators connect to. None means spectators are not accepted.
         """
         super().__init__(port=port)
         self._clients = []
+        self._spectators = []
         self._socket_accept_delay = socket_accept_delay
+        self._spectator_queue_bytes = spectator_queue_bytes
+        self._slow_spectator_policy = slow_spectator_policy
+        self._block_timeout = block_timeout
+        self._spectator_port = spectator_port
+        self._spectator_socket = None
 
         self._init_socket()
         self._clients = []
@@ -31,6 +94,15 @@ class ClientHandler(Connection):
         self._socket.listen(5)
         self._socket.settimeout(self._socket_accept_delay)
 
+        if self._spectator_port is not None:
+            # Spectators get their own listen socket, so a spectator can never be accepted as a player.
+            # It never blocks: accept_spectators is called from the game loop.
+            self._spectator_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._spectator_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._spectator_socket.bind(('', self._spectator_port))
+            self._spectator_socket.listen(5)
+            self._spectator_socket.setblocking(False)
+
     def accept_clients(self):
         """
         Accept clients and add them to the list of clients.
@@ -41,24 +113,27 @@ class ClientHandler(Connection):
         try:
             while True:
                 client_sock, address = self._socket.accept()
-                client = Connection(ip=address[0], port=address[1], socket=client_sock)
+                # Clients share the handler's metrics so traffic is reported in one place.
+                client = Connection(ip=address[0], port=address[1], socket=client_sock, metrics=self.metrics)
                 self._clients.append(client)
                 self._clients[-1].settimeout(0.01)
+                self._clients[-1].set_nodelay()
                 num_clients += 1
-        except socket.timeout:
+        except (socket.timeout, BlockingIOError):
             pass
+        self.metrics.inc('clients_accepted', num_clients)
         return num_clients
 
     def receive_tcp_all_clients(self) -> bool:
         """
-        Receive all messages from all clients.
+        Receive all messages that have already arrived from all clients, without waiting.
         Stores all messages in a list attribute.
         Retrieve the messages by calling the get_msgs() method.
         Returns:
             bool: True if a message was received, False otherwise.
         """
         len_before = len(self._recvd_msgs)
-        dlogger.log_debug(f'Receiving messages from all clients.')
+        dlogger.log_debug('Receiving messages from all clients.')
         for client in self._clients:
             client.receive_tcp_all()
             # Add each message to the list of messages
@@ -68,19 +143,160 @@ class ClientHandler(Connection):
         return len(self._recvd_msgs) > len_before
 
 
+    def wait_for_messages(self, timeout: float) -> bool:
+        """
+        Wait until a client has data to read, or timeout seconds pass.
+        Returns:
+            bool: True if a client is ready, False on timeout.
+        """
+        if not self._clients:
+            time.sleep(timeout)
+            return False
+        clients = list(self._clients)
+        # Registering as a waiter first means a Heartbeat cannot buffer a frame after the check below.
+        for client in clients:
+            client.add_waiter(1)
+        try:
+            if any(client.has_buffered_frame() for client in clients):
+                return True
+            return bool(select.select(clients, [], [], timeout)[0])
+        finally:
+            for client in clients:
+                client.add_waiter(-1)
+
+
     def send_tcp_all_clients(self, msg: str):
         '''
         Send a message to all connected clients
         Args:
             msg: the message to send
+        Returns:
+            True if every client was sent the message, False otherwise.
         '''
-        dlogger.log_debug(f'Sending {msg} to all clients.')
+        dlogger.log_debug('Sending %s to all clients.', msg)
+        frame = encode_frame(msg)
+        sent = True
         for client in self._clients:
-            client.dynamic_send(msg)
+            sent = client.send_frame(frame) and sent
+        return sent
+
 
+    def get_clients(self):
+        return list(self._clients)
+
+    def drop_closed_clients(self):
+        """
+        Close and forget clients whose connection was lost.
+        Returns:
+            int: the number of clients dropped.
+        """
+        closed = [client for client in self._clients if client.closed]
+        for client in closed:
+            dlogger.log_info('Client %s at port %s disconnected.', client._ip, client._port)
+            client.close_socket()
+            self._clients.remove(client)
+        return len(closed)
 
     def has_clients(self):
         """
         Return True if there are clients connected, False otherwise.
         """
-        return len(self._clients) > 0
\ No newline at end of file
+        return len(self._clients) > 0
+
+    # Spectators
+
+    def accept_spectators(self):
+        """
+        Accept the connections waiting on the spectator port without blocking.
+        Returns:
+            int: the number of spectators that were added.
+        """
+        if self._spectator_socket is None:
+            return 0
+        num_spectators = 0
+        try:
+            while True:
+                client_sock, address = self._spectator_socket.accept()
+                client_sock.setblocking(False)
+                client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self._spectators.append(Spectator(client_sock, address))
+                num_spectators += 1
+        except (BlockingIOError, InterruptedError):
+            pass
+        self.metrics.inc('spectators_accepted', num_spectators)
+        return num_spectators
+
+    def spectator_count(self):
+        return len(self._spectators)
+
+    def broadcast_to_spectators(self, msg: str):
+        """
+        Queue a message for every spectator and send what can be sent without blocking.
+        The frame is encoded once and the same buffer is queued for every spectator.
+        Spectators whose queue is full are handled by the slow spectator policy.
+        Returns:
+            int: the number of spectators the message was queued for.
+        """
+        frame = memoryview(encode_frame(msg))
+        # One deadline for the whole broadcast, so blocking on many slow spectators is still bounded.
+        deadline = time.monotonic() + self._block_timeout
+        queued = 0
+        for spectator in list(self._spectators):
+            # A frame is always accepted into an empty queue, however large.
+            if spectator.queued_bytes and spectator.queued_bytes + len(frame) > self._spectator_queue_bytes:
+                if not self._make_room(spectator, len(frame), deadline):
+                    continue
+            spectator.queue.append(frame)
+            spectator.queued_bytes += len(frame)
+            queued += 1
+        self.metrics.inc('spectator_frames_queued', queued)
+        self.flush_spectators()
+        return queued
+
+    def flush_spectators(self):
+        """
+        Send queued frames to every spectator without blocking. Call this regularly, e.g. once per game loop.
+        Spectators whose connection was lost are removed.
+        """
+        for spectator in list(self._spectators):
+            if not spectator.flush():
+                self._drop_spectator(spectator, 'connection lost')
+
+    def _make_room(self, spectator, size, deadline) -> bool:
+        """
+        Apply the slow spectator policy to a spectator whose queue cannot take size more bytes.
+        Returns:
+            bool: True if the frame should still be queued.
+        """
+        if self._slow_spectator_policy == SLOW_SPECTATOR_DROP_FRAMES:
+            self.metrics.inc('spectator_frames_dropped')
+            return False
+        if self._slow_spectator_policy == SLOW_SPECTATOR_BLOCK:
+            while spectator.queued_bytes and spectator.queued_bytes + size > self._spectator_queue_bytes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                select.select([], [spectator.sock], [], remaining)
+                if not spectator.flush():
+                    break
+            else:
+                return True
+        self._drop_spectator(spectator, 'too slow')
+        return False
+
+    def _drop_spectator(self, spectator, reason):
+        dlogger.log_info('Dropping spectator %s: %s.', spectator.address, reason)
+        self._spectators.remove(spectator)
+        spectator.sock.close()
+        self.metrics.inc('spectators_dropped')
+
+    def close_spectators(self):
+        """
+        Close every spectator connection and stop listening for new ones.
+        """
+        for spectator in list(self._spectators):
+            spectator.sock.close()
+        self._spectators = []
+        if self._spectator_socket is not None:
+            self._spectator_socket.close()
+            self._spectator_socket = None
@@ -1,11 +1,64 @@
+import select
 import socket
+import struct
+import threading
+import time
 
 from globals import dlogger
+from lan.metrics import Metrics
 
-SPECIAL_CASE_MSGS = ['!CON!']
+# Keepalive control messages, see lan/heartbeat.py. Every Connection answers a PING with a PONG.
+PING_MSG = '!PING!'
+PONG_MSG = '!PONG!'
 
-DYNAMIC_HEADER = '!DYNAMIC!(99999)'
-DYNAMIC_HEADER_BYTES = len(DYNAMIC_HEADER)
+SPECIAL_CASE_MSGS = ['!CON!', PING_MSG, PONG_MSG]
+
+# Every message is sent as one frame: a fixed size binary header followed by the UTF-8 body.
+# Header layout: magic byte, flags byte, 4 byte big-endian body length.
+FRAME_MAGIC = 0xA7
+FRAME_FLAG_CONTROL = 0x01
+FRAME_HEADER = struct.Struct('!BBI')
+FRAME_HEADER_BYTES = FRAME_HEADER.size
+MAX_FRAME_BYTES = 0xFFFFFFFF
+# Largest frame a receiver accepts. A peer announcing a bigger one is disconnected, so a bad header cannot make
+# the receiver buffer gigabytes. Game messages are tiny.
+MAX_RECEIVE_FRAME_BYTES = 4 * 1024 * 1024
+
+# Initial size of each Connection's receive buffer. It grows to fit larger frames.
+RECV_BUFFER_BYTES = 64 * 1024
+
+
+def encode_frame(msg: str) -> bytes:
+    '''
+    Encode a message as a single frame.
+    Messages in SPECIAL_CASE_MSGS are flagged as control frames.
+    '''
+    body = msg.encode('utf-8')
+    if len(body) > MAX_FRAME_BYTES:
+        raise ValueError(f'Message of {len(body)} bytes is too long to frame.')
+    flags = FRAME_FLAG_CONTROL if msg in SPECIAL_CASE_MSGS else 0
+    return FRAME_HEADER.pack(FRAME_MAGIC, flags, len(body)) + body
+
+
+def decode_frame_header(header: bytes) -> tuple:
+    '''
+    Decode a frame header.
+    Returns:
+        A tuple (flags, body_length).
+    Raises:
+        ValueError if the header does not start with FRAME_MAGIC.
+    '''
+    magic, flags, length = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC:
+        raise ValueError(f'Invalid frame header {bytes(header)!r}.')
+    return flags, length
+
+
+PONG_FRAME = encode_frame(PONG_MSG)
+
+
+def is_control_frame(flags: int, msg: str) -> bool:
+    return bool(flags & FRAME_FLAG_CONTROL) or msg in SPECIAL_CASE_MSGS
 
 '''
 The connection class is used for communicating between players.
@@ -14,12 +67,34 @@ The main protocol for communications is TCP, however UDP is used to find LAN gam
 
 class Connection:
 
-    def __init__(self, ip=None, port=None, socket=None):
+    def __init__(self, ip=None, port=None, socket=None, metrics=None):
         self._ip = ip
         self._port = port
         self._socket = socket
         self._msgs = []
         self._recvd_msgs = []
+        # Metadata from the broadcast response, for Connections returned by check_lan_servers.
+        self.server_info = None
+        # Traffic counters. Connections can share one Metrics object, e.g. all clients of a ClientHandler.
+        self.metrics = Metrics() if metrics is None else metrics
+        # Set once the peer closes the connection or the socket fails.
+        self.closed = False
+        # Received bytes not yet parsed are kept in self._rbuf[self._rstart:self._rend].
+        self._rbuf = bytearray(RECV_BUFFER_BYTES)
+        self._rview = memoryview(self._rbuf)
+        self._rstart = 0
+        self._rend = 0
+        # The receive lock guards the buffer. It is not held while waiting for data, so a Heartbeat thread can
+        # service the connection while the game thread waits. The send lock keeps frames from interleaving.
+        self._recv_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        # Number of threads waiting for data in _read. They handle control frames themselves.
+        self._waiters = 0
+        # Set by allow_background_service(). Until then receivers wait inside recv with the lock held, which is faster.
+        self._background_service = False
+        # time.monotonic() of the last bytes received and the last PONG received.
+        self.last_received = time.monotonic()
+        self.last_pong = None
 
     def add_message(self, message):
         self._msgs.append(message)
@@ -30,12 +105,13 @@ class Connection:
         '''
         if self._socket is None:
             try:
-                dlogger.log_info(f'Attempting to connect to {self._ip} at port {self._port}...')
+                dlogger.log_info('Attempting to connect to %s at port %s...', self._ip, self._port)
                 self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self._socket.connect((self._ip, self._port))
-                dlogger.log_info(f'Connected to {self._ip} at port {self._port}.')
+                self.set_nodelay()
+                dlogger.log_info('Connected to %s at port %s.', self._ip, self._port)
             except ConnectionRefusedError:
-                dlogger.log_error(f'Connection refused from {self._ip} at port {self._port}. This is likely because the TCP port on the server is not open.')
+                dlogger.log_error('Connection refused from %s at port %s. This is likely because the TCP port on the server is not open.', self._ip, self._port)
                 self._socket = None
         else:
             dlogger.log_warning('A socket already exists for this Connection object.')
@@ -45,48 +121,50 @@ class Connection:
 
     def receive_tcp(self, bytes: int) -> bool:
         '''
-        Receive bytes from the open tcp socket.
+        Receive exactly bytes raw bytes from the open tcp socket.
         Bytes are automatically converted into a string.
         String will be saved to end of self._recvd_msgs
+        A short read is kept in the receive buffer until the rest arrives, so the stream is never cut mid-message.
         Args:
             bytes: the number of bytes to receive.
         Returns:
             True if the message was received, False if not.
         '''
-        if self._socket is not None:
-            try:
-                dlogger.log_debug(f'Attempting to receive {bytes} bytes from TCP socket {self._ip} at port {self._port}...')
-                self._recvd_msgs.append(self._socket.recv(bytes).decode('utf-8'))
+        if self._socket is None:
+            dlogger.log_error('No socket exists for this Connection object.')
+            return False
 
-                if len(self._recvd_msgs[-1]) == 0:
+        dlogger.log_debug('Attempting to receive %s bytes from TCP socket %s at port %s...', bytes, self._ip, self._port)
+        with self._recv_lock:
+            self._reserve(bytes)
+            while self._rend - self._rstart < bytes:
+                if not self._read(wait=True):
                     dlogger.log_debug('No TCP message received.')
-                    self._recvd_msgs.pop()
                     return False
-
-                dlogger.log_debug(f'Received {self._recvd_msgs[-1]} from TCP socket {self._ip} at port {self._port}.')
-                return True
-
-            except socket.timeout:
-                dlogger.log_debug('No TCP message received.')
-                return False
-
-            except Exception as e:
-                dlogger.log_error(f'Error receiving {bytes} bytes from TCP socket {self._ip} at port {self._port}.')
-                dlogger.log_error(str(e))
-                return False
-        else:
-            dlogger.log_error('No socket exists for this Connection object.')
-            return False    
+            self._recvd_msgs.append(str(self._rview[self._rstart:self._rstart + bytes], 'utf-8'))
+            self._consume(bytes)
+        dlogger.log_debug('Received %s from TCP socket %s at port %s.', self._recvd_msgs[-1], self._ip, self._port)
+        return True
         
 
-    def receive_tcp_all(self):
+    def receive_tcp_all(self) -> bool:
         '''
-        Receive all msgs from a Connection and append them to self._recvd_msgs.
-        Args:
-            bytes: the number of bytes to receive.
+        Receive every message that has already arrived and append them to self._recvd_msgs.
+        Returns as soon as the socket has no more data, without waiting for the timeout.
+        Returns:
+            True if a message was received, False otherwise.
         '''
-        while self.dynamic_receive():
-            pass
+        if self._socket is None:
+            dlogger.log_error('No socket exists for this Connection object.')
+            return False
+        len_before = len(self._recvd_msgs)
+        with self._recv_lock:
+            while True:
+                while self._pop_frame():
+                    pass
+                if not self._read(wait=False):
+                    break
+        return len(self._recvd_msgs) > len_before
 
 
     def get_recvd_messages(self):
@@ -105,13 +183,22 @@ class Connection:
             True if the message was sent, False if not.
         '''
         if self._socket is not None:
-            dlogger.log_info(f'Attempting to send {message} to TCP socket {self._ip} at port {self._port}...')
-            self._socket.sendall(message.encode('utf-8'))
+            dlogger.log_info('Attempting to send %s to TCP socket %s at port %s...', message, self._ip, self._port)
+            data = message.encode('utf-8')
+            self._socket.sendall(data)
+            self.metrics.inc('bytes_sent', len(data))
             return True
         else:
             dlogger.log_error('No socket exists for this Connection object.')
             return False
 
+    def set_nodelay(self):
+        '''
+        Disable Nagle's algorithm so small frames are sent immediately.
+        '''
+        if self._socket is not None:
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
     def settimeout(self, timeout: int):
         '''
         Set the timeout for the socket.
@@ -124,57 +211,260 @@ class Connection:
             dlogger.log_error('No socket exists for this Connection object.')
 
     
-    # TCP Dynamic sending and receiving
-    def dynamic_receive(self) -> bool:
+    def fileno(self) -> int:
         '''
-        Receive a dynamic amount of bytes.
-        This is done by having 2 msgs. One msg is the header and specifies the length of the next msg.
+        The socket's file descriptor, so Connections can be passed to select().
         '''
-        is_special_case = True
+        return self._socket.fileno()
 
-        while is_special_case:
-            dlogger.log_debug('Receiving dynamic message...')
-            msg1_success = self.receive_tcp(DYNAMIC_HEADER_BYTES)
+    def has_buffered_frame(self) -> bool:
+        '''
+        Returns True if a complete frame is waiting in the receive buffer.
+        '''
+        return self._buffered_frame_flags() is not None
 
-            if not msg1_success:
-                return False
-            
-            msg1 = self._recvd_msgs[-1]
 
-            if not DYNAMIC_HEADER[:9] in msg1:
-                dlogger.log_warning(f'Dynamic receive was called, however {msg1} is not a dynamic message header.')
-                self._recvd_msgs.pop()
-                return False
-            
-            msg2_len = int(msg1[10:15])
+    # Receive buffer
+
+    def _reserve(self, size: int) -> None:
+        '''
+        Make sure size bytes starting at self._rstart fit in the buffer, and that there is free space after self._rend.
+        Unparsed bytes are moved to the front. The buffer only grows when it is full, and then doubles,
+        so a large frame makes it grow as its bytes arrive.
+        '''
+        if self._rstart and (self._rstart + size > len(self._rbuf) or self._rend == len(self._rbuf)):
+            pending = self._rend - self._rstart
+            # memoryview assignment handles the overlapping copy.
+            self._rview[:pending] = self._rview[self._rstart:self._rend]
+            self._rstart = 0
+            self._rend = pending
+        if size > len(self._rbuf) or self._rend == len(self._rbuf):
+            # A bytearray cannot be resized while a memoryview of it exists.
+            self._rview.release()
+            self._rbuf.extend(bytes(max(size, 2 * len(self._rbuf)) - len(self._rbuf)))
+            self._rview = memoryview(self._rbuf)
 
-            msg2_success = self.receive_tcp(msg2_len)
+    def _consume(self, size: int) -> None:
+        self._rstart += size
+        if self._rstart == self._rend:
+            self._rstart = self._rend = 0
 
-            if not msg2_success:
-                dlogger.log_warning('2nd half of dynamic message failed to receive.')
-                self._recvd_msgs.pop()
-                self._recvd_msgs.pop()
+    def _read(self, wait: bool) -> bool:
+        '''
+        Read whatever the socket has into the free end of the buffer with a single recv_into.
+        Must be called with the receive lock held.
+        The lock is released while waiting if another thread may call service().
+        Args:
+            wait: wait up to the socket timeout for data. Otherwise return at once if nothing has arrived.
+        Returns:
+            True if any bytes were read, or if another thread read them while this one waited.
+        '''
+        if wait and self._background_service:
+            self._waiters += 1
+            self._recv_lock.release()
+            try:
+                ready = select.select([self._socket], [], [], self._socket.gettimeout())[0]
+            except (OSError, ValueError):
+                # The socket was closed by another thread.
+                ready = True
+            finally:
+                self._recv_lock.acquire()
+                self._waiters -= 1
+            if not ready:
+                return False
+            if self.closed:
                 return False
-            
-            self._recvd_msgs.pop(-2)
-            is_special_case = self._recvd_msgs[-1] in SPECIAL_CASE_MSGS
-            if is_special_case:
-                self._recvd_msgs.pop()
+            if not select.select([self._socket], [], [], 0)[0]:
+                # Another thread took the data first. The caller checks the buffer again.
+                return True
+        elif not wait and not select.select([self._socket], [], [], 0)[0]:
+            return False
+        self._reserve(0)
+        try:
+            received = self._socket.recv_into(self._rview[self._rend:])
+        except (socket.timeout, BlockingIOError):
+            return False
+        except OSError as e:
+            dlogger.log_error('Error receiving from TCP socket %s at port %s.', self._ip, self._port)
+            dlogger.log_error('%s', e)
+            self.closed = True
+            return False
+        if not received:
+            dlogger.log_info('TCP socket %s at port %s was closed by the peer.', self._ip, self._port)
+            self.closed = True
+            return False
+        self._rend += received
+        self.last_received = time.monotonic()
+        self.metrics.inc('reads')
+        return True
+
+    def _pop_frame(self) -> bool:
+        '''
+        Parse one complete frame from the buffer. Its message is appended to self._recvd_msgs,
+        unless it is a control frame (see SPECIAL_CASE_MSGS), which is consumed and skipped.
+        Returns:
+            True if a frame was parsed, False if the buffer holds no complete frame.
+        '''
+        available = self._rend - self._rstart
+        if available < FRAME_HEADER_BYTES:
+            return False
+        try:
+            flags, length = decode_frame_header(self._rview[self._rstart:self._rstart + FRAME_HEADER_BYTES])
+        except ValueError as e:
+            # The stream is out of sync. Drop what was buffered.
+            dlogger.log_warning('%s', e)
+            self._rstart = self._rend = 0
+            return False
+        if length > MAX_RECEIVE_FRAME_BYTES:
+            self._drop_peer(f'announced a frame of {length} bytes')
+            return False
+        if available < FRAME_HEADER_BYTES + length:
+            self.metrics.inc('partial_reads')
+            return False
 
+        start = self._rstart + FRAME_HEADER_BYTES
+        try:
+            msg = str(self._rview[start:start + length], 'utf-8')
+        except UnicodeDecodeError:
+            self._drop_peer('sent a frame that is not valid UTF-8')
+            return False
+        self._consume(FRAME_HEADER_BYTES + length)
+        self.metrics.inc('frames_received')
+        self.metrics.inc('bytes_received', FRAME_HEADER_BYTES + length)
+        if is_control_frame(flags, msg):
+            self.metrics.inc('control_frames_received')
+            if msg == PING_MSG:
+                self.send_frame(PONG_FRAME)
+            elif msg == PONG_MSG:
+                self.last_pong = time.monotonic()
+        else:
+            self._recvd_msgs.append(msg)
         return True
-        
+
+    def _drop_peer(self, reason: str) -> None:
+        dlogger.log_warning('Peer %s at port %s %s. Disconnecting.', self._ip, self._port, reason)
+        self.metrics.inc('protocol_errors')
+        self._rstart = self._rend = 0
+        self.shutdown()
+
+    def _buffered_frame_flags(self):
+        '''
+        Returns the flags of the first buffered frame, or None if no complete frame is buffered.
+        '''
+        start, end = self._rstart, self._rend
+        if end - start < FRAME_HEADER_BYTES:
+            return None
+        magic, flags, length = FRAME_HEADER.unpack_from(self._rview, start)
+        if magic != FRAME_MAGIC or end - start < FRAME_HEADER_BYTES + length:
+            return None
+        return flags
+
+    def allow_background_service(self) -> None:
+        '''
+        Let another thread call service() while this one receives. Call it before starting that thread.
+        '''
+        self._background_service = True
+
+    def add_waiter(self, delta: int) -> None:
+        '''
+        Register (delta=1) or unregister (delta=-1) a thread that waits on this connection with select()
+        and then receives. Background servicing is paused while a waiter is registered.
+        '''
+        with self._recv_lock:
+            self._waiters += delta
+
+    def wait_readable(self, timeout: float) -> bool:
+        '''
+        Wait up to timeout seconds for data on the socket.
+        Returns False at once if the connection is closed or another thread is already waiting to receive.
+        '''
+        if self._socket is None or self.closed or self._waiters:
+            return False
+        try:
+            return bool(select.select([self._socket], [], [], timeout)[0])
+        except (OSError, ValueError):
+            return False
+
+    def service(self) -> None:
+        '''
+        Read whatever has arrived without waiting and handle control frames at the front of the buffer.
+        Game messages are left buffered for the game thread. Used by background threads such as Heartbeat.
+        Does nothing while another thread is waiting to receive, since that thread reads and answers control frames.
+        '''
+        if self._socket is None or self.closed:
+            return
+        with self._recv_lock:
+            if self._waiters:
+                return
+            while self._read(wait=False):
+                pass
+            while (self._buffered_frame_flags() or 0) & FRAME_FLAG_CONTROL:
+                self._pop_frame()
+
+
+    # TCP Dynamic sending and receiving
+    def dynamic_receive(self) -> bool:
+        '''
+        Receive one message and append it to self._recvd_msgs.
+        Frames already in the receive buffer are returned without touching the socket.
+        Otherwise waits up to the socket timeout for data. A partial frame is kept for the next call.
+        Control frames (see SPECIAL_CASE_MSGS) are consumed and skipped.
+        Returns:
+            True if a message was received, False otherwise.
+        '''
+        if self._socket is None:
+            dlogger.log_error('No socket exists for this Connection object.')
+            return False
+
+        len_before = len(self._recvd_msgs)
+        with self._recv_lock:
+            while True:
+                while self._pop_frame():
+                    if len(self._recvd_msgs) > len_before:
+                        return True
+                if not self._read(wait=True):
+                    return False
+
     def dynamic_send(self, msg):
         '''
-        Sends a dynamic length msg.
+        Sends a dynamic length msg as a single frame with one sendall call.
         Returns True if sent, False otherwise.
         '''
-        msg1 = f'!DYNAMIC!({len(msg):<5})'
-        msg2 = msg
+        return self.send_frame(encode_frame(msg))
 
-        if self.send_tcp(msg1):
-            self.send_tcp(msg2)
-            return True
-        return False
+    def send_frame(self, frame):
+        '''
+        Send an already encoded frame, so one encoding can be shared by many connections.
+        Returns True if sent, False otherwise.
+        '''
+        if self._socket is None:
+            dlogger.log_error('No socket exists for this Connection object.')
+            return False
+        try:
+            with self._send_lock:
+                self._socket.sendall(frame)
+        except OSError as e:
+            dlogger.log_error('Error sending frame to TCP socket %s at port %s.', self._ip, self._port)
+            dlogger.log_error('%s', e)
+            self.closed = True
+            return False
+        self.metrics.inc('frames_sent')
+        self.metrics.inc('bytes_sent', len(frame))
+        return True
+
+    def is_connected(self) -> bool:
+        return self._socket is not None and not self.closed
+
+    def shutdown(self) -> None:
+        '''
+        Mark the connection closed and shut the socket down, waking any thread waiting to receive.
+        '''
+        self.closed = True
+        if self._socket is not None:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
     def close_socket(self):
         self._socket.close()
@@ -0,0 +1,136 @@
+'''
+Background LAN discovery.
+A LanDiscovery runs on its own thread, periodically broadcasting for servers and keeping a registry
+of the hosts that answered. Asking for hosts returns immediately from the registry.
+Hosts that stop answering are dropped after a TTL.
+'''
+
+import socket
+import threading
+import time
+
+from globals import dlogger
+from lan.connection import Connection
+from lan.lan import send_discovery_broadcast, receive_server_response
+
+
+class LanDiscovery:
+    '''
+    Discovers LAN servers in the background.
+    Binds port + 1 for responses, so it cannot run at the same time as check_lan_servers on the same port.
+    '''
+
+    def __init__(self, port, ttl=5.0, broadcast_interval=1.0):
+        '''
+        Args:
+            port: the port servers listen for broadcasts on.
+            ttl: seconds after its last response before a host is forgotten.
+            broadcast_interval: seconds between broadcasts.
+        '''
+        self._port = port
+        self._ttl = ttl
+        self._broadcast_interval = broadcast_interval
+
+        # Maps a host ip to (Connection, time of last response).
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._host_found = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            dlogger.log_warning('LanDiscovery is already running.')
+            return
+        self._stop.clear()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self._sock_recv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock_recv.bind(('', self._port + 1))
+        self._thread = threading.Thread(target=self._run, name='LanDiscovery', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._sock.close()
+        self._sock_recv.close()
+
+    def __enter__(self) -> 'LanDiscovery':
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def get_hosts(self) -> list:
+        '''
+        Returns a new Connection for every host that answered within the TTL. Never blocks on the network.
+        '''
+        with self._lock:
+            self._expire()
+            return [self._copy(connection) for connection, _ in self._hosts.values()]
+
+    def wait_for_host(self, timeout=None):
+        '''
+        First responder wins: return as soon as any host is known.
+        Args:
+            timeout: the maximum number of seconds to wait. None waits forever.
+        Returns:
+            A Connection for the host, or None if no host answered in time.
+        '''
+        with self._host_found:
+            self._expire()
+            if not self._hosts:
+                self._host_found.wait_for(lambda: self._hosts, timeout)
+            if not self._hosts:
+                return None
+            # Prefer the most recently seen host.
+            connection, _ = max(self._hosts.values(), key=lambda entry: entry[1])
+            return self._copy(connection)
+
+    def _copy(self, connection: Connection) -> Connection:
+        '''
+        Every caller gets its own Connection, since connecting one opens a socket on it.
+        '''
+        copy = Connection(ip=connection._ip, port=connection._port)
+        for message in connection._msgs:
+            copy.add_message(message)
+        copy.server_info = connection.server_info
+        return copy
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        for ip in [ip for ip, (_, seen) in self._hosts.items() if now - seen > self._ttl]:
+            dlogger.log_info('Host %s expired from discovery registry.', ip)
+            del self._hosts[ip]
+
+    def _run(self) -> None:
+        next_broadcast = 0.0
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now >= next_broadcast:
+                try:
+                    send_discovery_broadcast(self._sock, self._port)
+                except OSError as e:
+                    dlogger.log_warning('Discovery broadcast failed: %s', e)
+                next_broadcast = now + self._broadcast_interval
+
+            # Wake up at least every 0.1 seconds to check for stop().
+            self._sock_recv.settimeout(max(0.0, min(next_broadcast - time.monotonic(), 0.1)) or 0.001)
+            try:
+                connection = receive_server_response(self._sock_recv, self._port)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if not self._stop.is_set():
+                    dlogger.log_warning('Discovery receive failed: %s', e)
+                continue
+            if connection is None:
+                continue
+            with self._host_found:
+                self._hosts[connection._ip] = (connection, time.monotonic())
+                self._host_found.notify_all()
@@ -0,0 +1,114 @@
+'''
+Keepalive for a Connection, run on a background thread so it works while the game thread is blocked, e.g. on input().
+The thread sends a PING control frame every interval, and the peer's Connection answers with a PONG.
+Any bytes from the peer count as a sign of life. If nothing arrives for timeout seconds the connection is shut down,
+which wakes a thread blocked receiving on it, and the disconnected event is set.
+Both peers need to run a Heartbeat, otherwise a peer that is not reading its socket cannot answer.
+'''
+
+import threading
+import time
+
+from globals import dlogger
+from lan.connection import Connection, encode_frame, PING_MSG
+
+PING_FRAME = encode_frame(PING_MSG)
+
+DEFAULT_INTERVAL = 0.5
+DEFAULT_TIMEOUT = 2.0
+
+
+class Heartbeat:
+
+    def __init__(self, connection: Connection, interval=DEFAULT_INTERVAL, timeout=DEFAULT_TIMEOUT, on_disconnect=None):
+        '''
+        Args:
+            connection: the connection to keep alive.
+            interval: seconds between pings.
+            timeout: seconds of silence from the peer before it is declared lost.
+                The loss is reported within timeout + interval.
+            on_disconnect: called with the connection from the heartbeat thread when the peer is lost.
+        '''
+        self.connection = connection
+        self.interval = interval
+        self.timeout = timeout
+        self.on_disconnect = on_disconnect
+        self.disconnected = threading.Event()
+        # Round trip time of the last answered ping, in seconds.
+        self.rtt = None
+        self._ping_sent = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='Heartbeat', daemon=True)
+
+    def start(self) -> 'Heartbeat':
+        self.connection.allow_background_service()
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self) -> None:
+        connection = self.connection
+        connection.last_received = time.monotonic()
+        while not self._stop.is_set():
+            connection.service()
+            self._update_rtt()
+
+            silence = time.monotonic() - connection.last_received
+            if connection.closed:
+                self._lost(silence, timed_out=False)
+                return
+            if silence > self.timeout:
+                self._lost(silence, timed_out=True)
+                return
+
+            self._ping_sent = time.monotonic()
+            if not connection.send_frame(PING_FRAME):
+                self._lost(silence, timed_out=False)
+                return
+            connection.metrics.inc('heartbeats_sent')
+            self._wait_for_next_ping()
+
+    def _wait_for_next_ping(self) -> None:
+        '''
+        Sleep until the next ping is due, servicing the connection as soon as data arrives.
+        This reads our PONG promptly and answers the peer's PINGs promptly, so both sides measure an accurate RTT.
+        '''
+        deadline = time.monotonic() + self.interval
+        while not self._stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if not self.connection.wait_readable(remaining):
+                self._stop.wait(remaining)
+                return
+            self.connection.service()
+            self._update_rtt()
+
+    def _update_rtt(self) -> None:
+        last_pong = self.connection.last_pong
+        if self._ping_sent is not None and last_pong is not None and last_pong >= self._ping_sent:
+            self.rtt = last_pong - self._ping_sent
+            self.connection.metrics.observe('heartbeat_rtt', self.rtt)
+            self._ping_sent = None
+
+    def _lost(self, silence: float, timed_out: bool) -> None:
+        '''
+        Args:
+            silence: seconds since the peer was last heard from.
+            timed_out: True if the peer went silent, False if the connection was closed or failed.
+                Only silent peers count as heartbeat_timeouts.
+        '''
+        if timed_out:
+            dlogger.log_warning('Peer %s lost after %.2fs of silence.', self.connection._ip, silence)
+            self.connection.metrics.inc('heartbeat_timeouts')
+        else:
+            dlogger.log_info('Connection to peer %s closed.', self.connection._ip)
+            self.connection.metrics.inc('heartbeat_peer_closed')
+        self.connection.shutdown()
+        self.disconnected.set()
+        if self.on_disconnect is not None:
+            self.on_disconnect(self.connection)
@@ -1,23 +1,74 @@
 import socket
+import time
 
 from globals import dlogger
 from lan.connection import Connection
+from lan.broadcast_responder import MAX_RESPONSE_BYTES, decode_response
 
-def check_lan_servers(port: int) -> tuple:
+BROADCAST_MESSAGE = b'PYMULT_BROADCAST'
+
+
+def send_discovery_broadcast(sock, port: int, count: int = 3) -> None:
+    '''
+    Broadcast the discovery message on port.
+    Args:
+        sock: a UDP socket with SO_BROADCAST set.
+        port: the port servers listen for broadcasts on.
+        count: how many times to send the broadcast, in case some are lost.
+    '''
+    for _ in range(count):
+        sock.sendto(BROADCAST_MESSAGE, ('255.255.255.255', port))
+
+
+def receive_server_response(sock_recv, port: int):
+    '''
+    Receive one server response from sock_recv.
+    Each response is a single datagram, so responses from any number of servers can arrive in any order.
+    Args:
+        sock_recv: the UDP socket bound to port + 1.
+        port: the port servers were contacted on.
+    Returns:
+        A Connection for the server, or None if the response was invalid.
+        The server's message is added to the Connection and its metadata is stored in server_info.
+    Raises:
+        socket.timeout if nothing arrives before the socket times out.
+    '''
+    datagram, addr = sock_recv.recvfrom(MAX_RESPONSE_BYTES)
+    dlogger.log_info('Received packet from %s', addr)
+
+    try:
+        info = decode_response(datagram)
+    except (ValueError, UnicodeDecodeError) as e:
+        dlogger.log_warning('Invalid response received (%s). Ignoring.', e)
+        return None
+
+    connection = Connection(ip=addr[0], port=port)
+    connection.add_message(info['message'])
+    connection.server_info = info
+    dlogger.log_info('Response: %s', info)
+    return connection
+
+
+def check_lan_servers(port: int, first_response: bool = False, timeout: float = 1.0, accept=None) -> list:
     '''
     Checks for LAN servers on the specified port.
     Any servers on LAN will respond with their IP address and any other data sent by the server will be returned as well.
     WARNING: Current implementation of this function is single threaded.
     Do NOT use in a part of the application where looping must be fast.
+    Use lan.discovery.LanDiscovery for a non-blocking alternative.
     A received message will come from port + 1.
     Args:
         port: The port to check for servers.
+        first_response: If True, return as soon as the first valid response arrives.
+        timeout: How long to wait for responses in seconds.
+        accept: called with each server's Connection. Servers it returns False for are skipped,
+            and do not end the search when first_response is True.
     Returns:
-        A touple of Connections, one for each server found.
+        A list of Connections, one for each server found.
     '''
-    dlogger.log_warning('Function check_lan_servers does not run asnychronously and will take multiple seconds to return. Do not use where fast frame output is required.')
+    dlogger.log_warning('Function check_lan_servers does not run asnychronously and may take up to a second to return. Do not use where fast frame output is required.')
 
-    dlogger.log_info('Sending broadcast packet on port ' + str(port))
+    dlogger.log_info('Sending broadcast packet on port %s', port)
     # Create a UDP socket
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
@@ -28,50 +79,36 @@ def check_lan_servers(port: int) -> tuple:
     sock_recv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock_recv.bind(('', port + 1))
 
-    # Broadcast UDP packets 3 times with a delay of 1 second between each
-    for _ in range(3):
-        sock.sendto(b'PYMULT_BROADCAST', ('255.255.255.255', port))
+    # Broadcast UDP packets 3 times
+    send_discovery_broadcast(sock, port)
 
-    # Wait for 1 seconds for a response
-    sock_recv.settimeout(1)
+    # Wait up to timeout seconds for responses
+    deadline = time.monotonic() + timeout
     connections = []
+    seen = set()
     try:
         # Continuously receive packets until timeout
         while True:
-            msg1, addr1 = sock_recv.recvfrom(27)  # The first message contains exactly 27 bytes.
-            dlogger.log_info('Received packet from ' + str(addr1))
-            dlogger.log_info('Identifier: ' + str(msg1))
-
-            # Make sure the message is valid
-            if not(len(msg1) == 27 and 'PYMULT_SERVER_RESPONSE' in msg1.decode('utf-8')):
-                dlogger.log_warning('Invalid message received. Ignoring.')
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock_recv.settimeout(remaining)
+            connection = receive_server_response(sock_recv, port)
+            # The broadcast is sent more than once, so a server may answer more than once.
+            if connection is None or connection._ip in seen:
                 continue
-
-            # Determine the size of the next message.
-            msg2_size = int(msg1.decode('utf-8')[23:26])
-            dlogger.log_info('Message size: ' + str(msg2_size))
-
-            # Receive the next message.
-            msg2, addr2 = sock_recv.recvfrom(msg2_size)
-
-            # If both messages came from different addresses, close socket and retry from the beginning.
-            if addr1 != addr2:
-                dlogger.log_warning('A message from one server was interrupted by another. Please retry checking LAN servers.')
-                sock.close()
-                sock_recv.close()
-                connections.append(Connection.interrupted_server())
+            if accept is not None and not accept(connection):
+                continue
+            seen.add(connection._ip)
+            connections.append(connection)
+            if first_response:
                 break
 
-            connections.append(Connection(ip=addr1[0], port=port))
-            connections[-1].add_message(msg2.decode('utf-8'))
-            dlogger.log_info('Message: ' + str(msg2))
-
-
     except socket.timeout:
         if len(connections) == 0:
-            dlogger.log_info('No more servers found on port ' + str(port))
+            dlogger.log_info('No more servers found on port %s', port)
 
     # Close the socket
     sock.close()
     sock_recv.close()
-    return connections
\ No newline at end of file
+    return connections
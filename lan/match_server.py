@@ -0,0 +1,243 @@
+'''
+Dedicated game server that hosts many matches in one process.
+Clients connect exactly as they would to a host created by MultiplayerGame.create_host.
+The server pairs clients from a matchmaking queue, tells each one its opponent's role
+and then forwards every frame only to the sender's match partner.
+All sockets are non-blocking and driven by a selectors event loop, so idle clients cost nothing.
+Run with: python -m lan.match_server
+'''
+
+import argparse
+import collections
+import random
+import selectors
+import socket
+
+from globals import dlogger, MULTIPLAYER_PORT
+from lan.broadcast_responder import BroadcastResponder
+from lan.connection import FRAME_HEADER_BYTES, MAX_RECEIVE_FRAME_BYTES, decode_frame_header, encode_frame
+
+RECV_BYTES = 65536
+# Frames from a client that is not matched yet wait in its input buffer, so the buffer is capped at one frame
+# of the largest size a Connection accepts.
+MAX_INBUF_BYTES = FRAME_HEADER_BYTES + MAX_RECEIVE_FRAME_BYTES
+
+
+class _ServerClient:
+    '''
+    Per-client state kept by the MatchServer.
+    '''
+
+    __slots__ = ('sock', 'address', 'inbuf', 'outbuf', 'partner', 'writing')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.partner = None
+        self.writing = False
+
+
+class MatchServer:
+    '''
+    Hosts concurrent two player matches over TCP.
+    '''
+
+    def __init__(self, port, backlog=1024, respond_to_broadcasts=True):
+        '''
+        Args:
+            port: the TCP port to listen on. Broadcasts are answered on the same port number over UDP.
+            backlog: the listen backlog.
+            respond_to_broadcasts: whether to answer check_lan_servers broadcasts.
+        '''
+        self._port = port
+        self._selector = selectors.DefaultSelector()
+        self._waiting = collections.deque()
+        self._clients = set()
+        self.matches_started = 0
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('', port))
+        self._socket.listen(backlog)
+        self._socket.setblocking(False)
+        self._selector.register(self._socket, selectors.EVENT_READ, self._accept)
+
+        self._broadcast_responder = None
+        if respond_to_broadcasts:
+            self._broadcast_responder = BroadcastResponder(port)
+            self._selector.register(self._broadcast_responder._socket, selectors.EVENT_READ, self._answer_broadcast)
+
+    @property
+    def client_count(self) -> int:
+        return len(self._clients)
+
+    @property
+    def waiting_count(self) -> int:
+        return len(self._waiting)
+
+    def serve_forever(self) -> None:
+        dlogger.log_info('Match server listening on port %s.', self._port)
+        try:
+            while True:
+                self.run_once()
+        finally:
+            self.close()
+
+    def run_once(self, timeout=None) -> None:
+        '''
+        Wait until at least one socket is ready (or timeout seconds pass) and service every ready socket.
+        '''
+        for key, mask in self._selector.select(timeout):
+            if isinstance(key.data, _ServerClient):
+                self._service_client(key.data, mask)
+            else:
+                key.data()
+
+    def close(self) -> None:
+        for client in list(self._clients):
+            self._drop(client, close_partner=False)
+        self._selector.unregister(self._socket)
+        self._socket.close()
+        if self._broadcast_responder is not None:
+            self._selector.unregister(self._broadcast_responder._socket)
+            self._broadcast_responder.close_socket()
+        self._selector.close()
+
+    def _answer_broadcast(self) -> None:
+        self._broadcast_responder.respond_to_broadcast('ping', 'tictactoe', self.client_count)
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                sock, address = self._socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = _ServerClient(sock, address)
+            self._clients.add(client)
+            self._selector.register(sock, selectors.EVENT_READ, client)
+            self._waiting.append(client)
+            dlogger.log_info('Client %s connected. %s waiting for a match.', address, len(self._waiting))
+            self._match_waiting()
+
+    def _match_waiting(self) -> None:
+        '''
+        Pair waiting clients. Each client is sent its opponent's role, which is what MultiplayerGame._retrieve_role expects.
+        '''
+        while len(self._waiting) >= 2:
+            first = self._waiting.popleft()
+            second = self._waiting.popleft()
+            first.partner = second
+            second.partner = first
+            first_role, second_role = random.choice((('x', 'o'), ('o', 'x')))
+            self._queue_frame(first, encode_frame(second_role))
+            self._queue_frame(second, encode_frame(first_role))
+            self.matches_started += 1
+            dlogger.log_info('Matched %s with %s.', first.address, second.address)
+            # Anything sent before the match started can now be routed.
+            self._route_frames(first)
+            self._route_frames(second)
+
+    def _service_client(self, client: _ServerClient, mask: int) -> None:
+        if mask & selectors.EVENT_READ:
+            try:
+                data = client.sock.recv(RECV_BYTES)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                data = b''
+            if data == b'':
+                self._drop(client)
+                return
+            if data:
+                client.inbuf += data
+                self._route_frames(client)
+                if len(client.inbuf) > MAX_INBUF_BYTES and client in self._clients:
+                    dlogger.log_warning('%s buffered more than %s bytes. Dropping client.', client.address, MAX_INBUF_BYTES)
+                    self._drop(client)
+                    return
+
+        if mask & selectors.EVENT_WRITE and client.sock.fileno() != -1:
+            self._flush(client)
+
+    def _route_frames(self, client: _ServerClient) -> None:
+        '''
+        Forward every complete frame in the client's input buffer to its partner without re-encoding it.
+        '''
+        if client.partner is None:
+            return
+        buf = client.inbuf
+        offset = 0
+        while client.partner is not None and len(buf) - offset >= FRAME_HEADER_BYTES:
+            try:
+                _, length = decode_frame_header(bytes(buf[offset:offset + FRAME_HEADER_BYTES]))
+            except ValueError as e:
+                dlogger.log_warning('%s from %s. Dropping client.', e, client.address)
+                self._drop(client)
+                return
+            if length > MAX_RECEIVE_FRAME_BYTES:
+                dlogger.log_warning('Frame of %s bytes from %s. Dropping client.', length, client.address)
+                self._drop(client)
+                return
+            end = offset + FRAME_HEADER_BYTES + length
+            if end > len(buf):
+                break
+            self._queue_frame(client.partner, buf[offset:end])
+            offset = end
+        if offset:
+            del buf[:offset]
+
+    def _queue_frame(self, client: _ServerClient, frame) -> None:
+        was_empty = not client.outbuf
+        client.outbuf += frame
+        if was_empty:
+            self._flush(client)
+
+    def _flush(self, client: _ServerClient) -> None:
+        try:
+            sent = client.sock.send(client.outbuf)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._drop(client)
+            return
+        del client.outbuf[:sent]
+        # Only watch for writability while there is data waiting to go out.
+        writing = bool(client.outbuf)
+        if writing != client.writing:
+            client.writing = writing
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if writing else selectors.EVENT_READ
+            self._selector.modify(client.sock, events, client)
+
+    def _drop(self, client: _ServerClient, close_partner=True) -> None:
+        '''
+        Close a client. A match cannot continue without both players, so the partner is closed too.
+        '''
+        if client not in self._clients:
+            return
+        dlogger.log_info('Client %s disconnected.', client.address)
+        self._clients.discard(client)
+        if client in self._waiting:
+            self._waiting.remove(client)
+        self._selector.unregister(client.sock)
+        client.sock.close()
+        partner = client.partner
+        client.partner = None
+        if partner is not None and close_partner:
+            partner.partner = None
+            self._drop(partner)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Host many tic-tac-toe matches in one process.')
+    parser.add_argument('--port', type=int, default=MULTIPLAYER_PORT)
+    parser.add_argument('--no-broadcast', action='store_true', help='do not answer LAN discovery broadcasts')
+    args = parser.parse_args()
+    MatchServer(args.port, respond_to_broadcasts=not args.no_broadcast).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
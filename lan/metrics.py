@@ -0,0 +1,171 @@
+'''
+Lightweight counters and histograms for the lan package.
+Connection, ClientHandler, BroadcastResponder and MultiplayerGame each keep a Metrics object.
+Call snapshot() for a plain dict, or use a MetricsDumper to append snapshots to a file periodically.
+'''
+
+import bisect
+import json
+import threading
+import time
+
+# Histogram bucket upper bounds in seconds: 10us doubling up to about 42s.
+DEFAULT_BUCKETS = tuple(0.00001 * 2 ** i for i in range(23))
+
+
+class Counter:
+    '''
+    Not thread safe on its own. Update it through Metrics.inc, which holds the Metrics lock.
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1) -> None:
+        self.value += amount
+
+
+class Histogram:
+    '''
+    Counts observations in fixed buckets. Percentiles are reported as bucket upper bounds.
+    Not thread safe on its own. Update it through Metrics.observe, which holds the Metrics lock.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._bounds = tuple(buckets)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value) -> None:
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        if self.count == 0:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self._counts):
+            seen += count
+            if seen >= target:
+                return self._bounds[i] if i < len(self._bounds) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+        }
+
+
+class Metrics:
+    '''
+    A named collection of counters and histograms, created on first use.
+    One lock guards every update, since Heartbeat threads and the game thread update the same metrics.
+    '''
+
+    def __init__(self):
+        self._created = time.monotonic()
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name) -> Counter:
+        counter = self._counters.get(name)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(name, Counter())
+        return counter
+
+    def histogram(self, name) -> Histogram:
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram())
+        return histogram
+
+    def inc(self, name, amount=1) -> None:
+        with self._lock:
+            counter = self._counters.get(name)
+            if counter is None:
+                counter = self._counters[name] = Counter()
+            counter.inc(amount)
+
+    def observe(self, name, value) -> None:
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self) -> dict:
+        '''
+        Returns every metric as plain data. Counters include their average rate per second since creation.
+        '''
+        uptime = time.monotonic() - self._created
+        with self._lock:
+            return {
+                'uptime': uptime,
+                'counters': {
+                    name: {'value': counter.value, 'rate': counter.value / uptime if uptime else 0.0}
+                    for name, counter in self._counters.items()
+                },
+                'histograms': {name: histogram.snapshot() for name, histogram in self._histograms.items()},
+            }
+
+
+class MetricsDumper:
+    '''
+    Appends a JSON line with a snapshot of every source to a file at a fixed interval, on a background thread.
+    '''
+
+    def __init__(self, path, sources: dict, interval=10.0):
+        '''
+        Args:
+            path: the file to append snapshots to.
+            sources: maps a name to a Metrics object.
+            interval: seconds between snapshots.
+        '''
+        self._path = path
+        self._sources = sources
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='MetricsDumper', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        '''
+        Stop the thread after writing one last snapshot.
+        '''
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self) -> None:
+        record = {
+            'time': time.time(),
+            'metrics': {name: metrics.snapshot() for name, metrics in list(self._sources.items())},
+        }
+        with open(self._path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            self.dump()
+        self.dump()
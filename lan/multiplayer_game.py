@@ -5,74 +5,437 @@ This multiplayer style is only meant for turn-based cli games.
 In the future, I might work on adding support for multithreading.
 '''
 
+import asyncio
+import collections
+import secrets
 import time
 
-from lan.connection import Connection
+from lan.connection import Connection, encode_frame
+from lan.async_connection import AsyncConnection, AsyncClientHandler
 from lan.lan import check_lan_servers
 from lan.broadcast_responder import BroadcastResponder
 from lan.client_handler import ClientHandler
+from lan.heartbeat import Heartbeat
+from lan.spectator_service import SpectatorService, SPECTATE_MESSAGE
+from lan.metrics import Metrics
 
 from globals import dlogger
 
+# Session handshake messages. They are not game messages and do not get sequence numbers.
+# The host sends SESSION_PREFIX + token when a client first connects. A MatchServer does not, and its clients play
+# without resume.
+# A reconnecting client sends RESUME_PREFIX + 'token,n' where n is the number of game messages it has received.
+# The host answers RESUMED_PREFIX + m, with m the number it has received, followed by the messages the client missed.
+# The client then sends the messages the host missed.
+SESSION_PREFIX = '!SESSION!'
+RESUME_PREFIX = '!RESUME!'
+RESUMED_PREFIX = '!RESUMED!'
+
+# How long either side keeps trying to resume a dropped session, in seconds.
+RESUME_TIMEOUT = 30.0
+
 class MultiplayerGame:
     LOCAL = 0
     LAN = 1
 
-    def search_for_hosts(self) -> list:
+    # Sent in broadcast responses so searching clients can tell games apart.
+    GAME_NAME = 'PYMULT'
+
+    # TCP port the host accepts spectators on. None means no spectators.
+    _spectator_port = None
+
+    # Keepalive settings in seconds. A silent peer is detected within HEARTBEAT_TIMEOUT + HEARTBEAT_INTERVAL.
+    # Set HEARTBEAT_INTERVAL to None to turn heartbeats off.
+    HEARTBEAT_INTERVAL = 0.5
+    HEARTBEAT_TIMEOUT = 2.0
+
+    @property
+    def metrics(self) -> Metrics:
+        '''
+        Game level metrics: time blocked in receive_from_peer and the round trip from sending a move to receiving the reply.
+        '''
+        if getattr(self, '_metrics', None) is None:
+            self._metrics = Metrics()
+        return self._metrics
+
+    def _record_sent(self) -> None:
+        self._last_sent = time.perf_counter()
+
+    def _record_received(self, started: float) -> None:
+        now = time.perf_counter()
+        self.metrics.observe('receive_blocked', now - started)
+        last_sent = getattr(self, '_last_sent', None)
+        if last_sent is not None:
+            self.metrics.observe('move_round_trip', now - last_sent)
+            self._last_sent = None
+
+    def _init_session(self):
+        '''
+        Session state: the token, the game messages sent that the peer may not have yet,
+        and the number of game messages received, counted as they are queued in self._pending_msgs
+        so the count sent in the resume handshake includes messages not yet returned by receive_from_peer.
+        Message n has sequence number n + 1. self._sent_log starts at message self._sent_base.
+        '''
+        if getattr(self, '_sent_log', None) is None:
+            self._session_token = None
+            self._sent_log = []
+            self._sent_base = 0
+            self._trim_at = None
+            self._received_count = 0
+            self._pending_msgs = collections.deque()
+
+    def _queue_received(self, msgs: list) -> None:
+        '''
+        Queue game messages for receive_from_peer. They count as received from here on.
+        '''
+        self._pending_msgs.extend(msgs)
+        self._received_count += len(msgs)
+
+    def end_game(self) -> None:
+        '''
+        Call between games on the same connection, e.g. on a rematch.
+        The messages of the finished game are dropped from the resume log as soon as a message of the next game
+        arrives from the peer. The peer only sends that after it has received every message of the finished game.
+        '''
+        self._init_session()
+        self._trim_at = self._sent_base + len(self._sent_log)
+
+    def _missed_messages(self, peer_count: int) -> list:
+        '''
+        Returns the messages sent after the first peer_count, which the peer has not received.
+        '''
+        if peer_count < self._sent_base:
+            dlogger.log_warning('Peer is missing %s messages that are no longer kept.', self._sent_base - peer_count)
+        return self._sent_log[max(0, peer_count - self._sent_base):]
+
+    def _start_heartbeats(self) -> None:
+        '''
+        Start a Heartbeat for every peer connection, replacing any from before a resume.
+        A lost peer's connection is shut down, which makes receive_from_peer and send_to_peer resume the session.
+        '''
+        self.stop_heartbeats()
+        if self.HEARTBEAT_INTERVAL is None:
+            return
+        connections = self._connection.get_clients() if self._host else [self._connection]
+        self._heartbeats = [
+            Heartbeat(connection, self.HEARTBEAT_INTERVAL, self.HEARTBEAT_TIMEOUT).start() for connection in connections
+        ]
+
+    def stop_heartbeats(self) -> None:
+        for heartbeat in getattr(self, '_heartbeats', []):
+            heartbeat.stop()
+        self._heartbeats = []
+
+    def get_rtt(self):
+        '''
+        Returns the last heartbeat round trip time to the peer in seconds, or None if not measured yet.
+        '''
+        for heartbeat in getattr(self, '_heartbeats', []):
+            if heartbeat.rtt is not None:
+                return heartbeat.rtt
+        return None
+
+    def is_host(self) -> bool:
+        return getattr(self, '_host', False)
+
+    def search_for_hosts(self, first_response: bool = False) -> list:
         '''
         Search for existing games.
+        If first_response is True, returns as soon as one host answers.
+        Games already in progress, which only answer spectators, are skipped.
         Returns a list of Connection objects. One for each host.
         '''
         if not self._port:
             raise ValueError('Port not set.')
-        return check_lan_servers(self._port)
+        return check_lan_servers(self._port, first_response=first_response,
+                                 accept=lambda host: host.server_info['message'] != SPECTATE_MESSAGE)
 
     def connect_to_host(self, host: Connection) -> None:
         '''
         Connect to an existing game.
         '''
+        self._init_session()
         self._connection = host
         self._connection.tcp_connect()
         self._host = False
+        if self._connection.is_connected():
+            self._receive_session_token()
+            self._start_heartbeats()
+
+    def _receive_session_token(self) -> None:
+        '''
+        Read the session token a host sends when a client connects.
+        Any other first message, e.g. the role sent by a MatchServer, is kept for receive_from_peer,
+        and the session cannot be resumed.
+        '''
+        if not self._connection.dynamic_receive():
+            return
+        msg = self._connection.get_recvd_messages().pop(0)
+        if msg.startswith(SESSION_PREFIX):
+            self._session_token = msg[len(SESSION_PREFIX):]
+        else:
+            self._queue_received([msg])
 
     def create_host(self) -> None:
         '''
         Create a new game.
         '''
-        self._connection = ClientHandler(self._port)
+        self._connection = ClientHandler(self._port, spectator_port=self._spectator_port)
         self._broadcast_responder = BroadcastResponder(self._port)
         self._host = True
 
+    def _start_spectator_service(self) -> None:
+        '''
+        Start answering, accepting and sending to spectators on a background thread, if this host takes spectators.
+        '''
+        self.stop_spectator_service()
+        if self._spectator_port is None or not isinstance(self._connection, ClientHandler):
+            return
+        self._spectator_service = SpectatorService(self._connection, self._broadcast_responder, self.GAME_NAME).start()
+
+    def stop_spectator_service(self) -> None:
+        '''
+        Stop the spectator thread and disconnect every spectator.
+        '''
+        service = getattr(self, '_spectator_service', None)
+        if service is not None:
+            service.stop()
+            self._connection.close_spectators()
+        self._spectator_service = None
+
+    def update_spectators(self, msg: str) -> None:
+        '''
+        Send msg to every spectator. Does nothing unless this is a host taking spectators.
+        The message is handed to the spectator thread, so this never blocks.
+        '''
+        service = getattr(self, '_spectator_service', None)
+        if service is not None:
+            service.publish(msg)
+
     def wait_and_connect_client(self) -> None:
         '''
         Wait for a client to connect.
         '''
+        self._init_session()
         while not self._connection.has_clients():
-            self._broadcast_responder.respond_to_broadcast('ping')
+            self._broadcast_responder.respond_to_broadcast('ping', self.GAME_NAME)
             self._connection.accept_clients()
+        self._session_token = secrets.token_hex(8)
+        self._connection.send_tcp_all_clients(SESSION_PREFIX + self._session_token)
+        self._start_heartbeats()
+        self._start_spectator_service()
 
     def send_to_peer(self, msg: str) -> None:
         '''
         Send a message to the peer.
+        If the connection has dropped, the session is resumed and the message is delivered on the new connection.
         '''
+        self._init_session()
+        self._sent_log.append(msg)
 
         if not self._host:
-            self._connection.dynamic_send(msg)
+            if not self._connection.dynamic_send(msg):
+                self._resume_as_client()
         else:
-            self._connection.send_tcp_all_clients(msg)
+            if not self._connection.send_tcp_all_clients(msg):
+                self._resume_as_host()
+        self._record_sent()
     
 
     def receive_from_peer(self) -> str:
         '''
         Receive a message from the peer.
+        If the connection drops while waiting, the session is resumed and waiting continues.
         '''
+        self._init_session()
+        started = time.perf_counter()
 
-        if not self._host:
-            while not self._connection.dynamic_receive():
+        while not self._pending_msgs:
+            if not self._host:
+                received = self._connection.dynamic_receive()
+                if not received and self._connection.closed:
+                    self._resume_as_client()
+                    continue
+            else:
+                received = self._connection.receive_tcp_all_clients()
+                if not received and self._connection.drop_closed_clients():
+                    self._resume_as_host()
+                    continue
+            self._queue_received(self._connection.get_recvd_messages())
+            self._connection.clear_recvd_messages()
+            if not received:
+                if self._host:
+                    self._connection.wait_for_messages(0.1)
+                else:
+                    time.sleep(0.1)
+
+        self._record_received(started)
+        if self._trim_at is not None:
+            del self._sent_log[:self._trim_at - self._sent_base]
+            self._sent_base = self._trim_at
+            self._trim_at = None
+        return self._pending_msgs.popleft()
+
+    # Session resume
+
+    @staticmethod
+    def _receive_handshake(connection: Connection, prefix: str, timeout: float = RESUME_TIMEOUT):
+        '''
+        Wait for the next message from connection, which must start with prefix.
+        Returns:
+            The rest of the message, or None if the connection closed, timed out or sent something else.
+        '''
+        deadline = time.monotonic() + timeout
+        while not connection.dynamic_receive():
+            if connection.closed or time.monotonic() > deadline:
+                return None
+        msg = connection.get_recvd_messages().pop(0)
+        if not msg.startswith(prefix):
+            dlogger.log_warning('Expected %s handshake, got %s.', prefix, msg)
+            return None
+        return msg[len(prefix):]
+
+    def _resume_as_client(self) -> None:
+        '''
+        Reconnect to the same host and resume the session. No discovery or role negotiation is repeated.
+        Raises ConnectionError if the host cannot be reached within RESUME_TIMEOUT.
+        '''
+        if self._session_token is None:
+            raise ConnectionError('Connection lost before a session was established.')
+        old = self._connection
+        dlogger.log_info('Connection to %s lost. Resuming session...', old._ip)
+        self.stop_heartbeats()
+        old.close_socket()
+        deadline = time.monotonic() + RESUME_TIMEOUT
+        while time.monotonic() < deadline:
+            connection = Connection(ip=old._ip, port=old._port, metrics=old.metrics)
+            try:
+                connection.tcp_connect()
+            except OSError as e:
+                dlogger.log_debug('Reconnect failed: %s', e)
+            if not connection.is_connected():
                 time.sleep(0.1)
+                continue
+
+            connection.settimeout(0.1)
+            connection.dynamic_send(f'{RESUME_PREFIX}{self._session_token},{self._received_count}')
+            host_count = self._receive_handshake(connection, RESUMED_PREFIX, deadline - time.monotonic())
+            if host_count is None:
+                connection.close_socket()
+                continue
+            connection.settimeout(None)
+            # Messages the host replayed after its answer stay queued in the socket for receive_from_peer.
+            self._queue_received(connection.get_recvd_messages())
+            connection.clear_recvd_messages()
+            missed = self._missed_messages(int(host_count))
+            if missed:
+                connection.send_frame(b''.join(encode_frame(msg) for msg in missed))
+            self._connection = connection
+            self._start_heartbeats()
+            self.metrics.inc('sessions_resumed')
+            dlogger.log_info('Session resumed. Replayed %s messages.', len(missed))
+            return
+        raise ConnectionError('Could not resume the session.')
+
+    def _resume_as_host(self) -> None:
+        '''
+        Wait for the client to reconnect with the session token and replay the messages it missed.
+        Connections that do not present the token are closed.
+        Raises ConnectionError if the client does not return within RESUME_TIMEOUT.
+        '''
+        if self._session_token is None:
+            raise ConnectionError('Connection lost before a session was established.')
+        dlogger.log_info('Client disconnected. Waiting for it to resume the session...')
+        self.stop_heartbeats()
+        self._connection.drop_closed_clients()
+        deadline = time.monotonic() + RESUME_TIMEOUT
+        while time.monotonic() < deadline:
+            self._connection.accept_clients()
+            for client in self._connection.get_clients():
+                request = self._receive_handshake(client, RESUME_PREFIX, min(1.0, deadline - time.monotonic()))
+                client.clear_recvd_messages()
+                token, _, client_count = (request or '').partition(',')
+                if token != self._session_token or not client_count.isdigit():
+                    dlogger.log_warning('Rejected resume from %s.', client._ip)
+                    client.closed = True
+                    continue
+                missed = self._missed_messages(int(client_count))
+                frames = [encode_frame(f'{RESUMED_PREFIX}{self._received_count}')]
+                frames.extend(encode_frame(msg) for msg in missed)
+                client.send_frame(b''.join(frames))
+                self.metrics.inc('sessions_resumed')
+                dlogger.log_info('Session resumed. Replayed %s messages.', len(missed))
+            self._connection.drop_closed_clients()
+            if self._connection.has_clients():
+                self._start_heartbeats()
+                return
+        raise ConnectionError('Client did not resume the session.')
+
+    # asyncio variants. These wait on the socket instead of sleep-polling.
+
+    async def connect_to_host_async(self, host: Connection) -> None:
+        '''
+        Connect to an existing game using an AsyncConnection.
+        '''
+        self._init_session()
+        self._connection = AsyncConnection.from_connection(host)
+        if not await self._connection.tcp_connect():
+            raise ConnectionError('Could not connect to host.')
+        self._host = False
+        # Keep answering the host's heartbeat while the game is not waiting for a message.
+        self._connection.start_reader()
+        msg = await self._connection.dynamic_receive()
+        if msg is None:
+            raise ConnectionError('Host closed the connection.')
+        if msg.startswith(SESSION_PREFIX):
+            self._session_token = msg[len(SESSION_PREFIX):]
         else:
-            while not self._connection.receive_tcp_all_clients():
-                time.sleep(0.1)
-        msgs = self._connection.get_recvd_messages()
-        self._connection.clear_recvd_messages()
-        return msgs[0]
\ No newline at end of file
+            # A MatchServer sends the role first. Keep it for receive_from_peer_async.
+            self._pending_msgs.append(msg)
+
+    async def create_host_async(self) -> None:
+        '''
+        Create a new game served by an AsyncClientHandler.
+        '''
+        self._connection = AsyncClientHandler(self._port)
+        await self._connection.start()
+        self._broadcast_responder = BroadcastResponder(self._port)
+        self._host = True
+
+    async def wait_and_connect_client_async(self) -> None:
+        '''
+        Answer broadcasts until a client connects.
+        The blocking broadcast responder runs in a worker thread so the event loop stays free.
+        '''
+        self._init_session()
+        while not self._connection.has_clients():
+            await asyncio.to_thread(self._broadcast_responder.respond_to_broadcast, 'ping', self.GAME_NAME)
+        self._session_token = secrets.token_hex(8)
+        await self._connection.send_all_clients(SESSION_PREFIX + self._session_token)
+
+    async def send_to_peer_async(self, msg: str) -> None:
+        '''
+        Send a message to the peer.
+        '''
+        if not self._host:
+            await self._connection.dynamic_send(msg)
+        else:
+            await self._connection.send_all_clients(msg)
+        self._record_sent()
+
+    async def receive_from_peer_async(self) -> str:
+        '''
+        Wait for the next message from the peer.
+        Raises ConnectionError if the peer disconnects.
+        '''
+        started = time.perf_counter()
+        if getattr(self, '_pending_msgs', None):
+            msg = self._pending_msgs.popleft()
+        elif not self._host:
+            msg = await self._connection.dynamic_receive()
+        else:
+            msg = await self._connection.receive()
+        if msg is None:
+            raise ConnectionError('Peer disconnected.')
+        self._record_received(started)
+        return msg
@@ -0,0 +1,74 @@
+'''
+Background service for a host's spectators, so watching does not depend on the turn flow of the game.
+A thread answers broadcasts from spectators looking for the game, accepts new spectators as they connect
+and sends them the messages the game publishes, while the game thread is blocked on input or on the opponent.
+'''
+
+import queue
+import threading
+
+from globals import dlogger
+
+# A host with a game in progress answers broadcasts with this message. Spectators use it to find the game,
+# and players searching for a game to join skip it.
+SPECTATE_MESSAGE = 'spectate'
+
+
+class SpectatorService:
+
+    def __init__(self, handler, responder, game_name: str) -> None:
+        '''
+        Args:
+            handler: the ClientHandler holding the spectators. Only this service touches its spectators once started.
+            responder: the host's BroadcastResponder. Its socket timeout paces the loop, 10 ms by default.
+            game_name: the game name sent in broadcast responses.
+        '''
+        self.handler = handler
+        self.responder = responder
+        self.game_name = game_name
+        self._messages = queue.SimpleQueue()
+        # The last message published. New spectators are sent it straight away.
+        self._last = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='SpectatorService', daemon=True)
+
+    def start(self) -> 'SpectatorService':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        '''
+        Stop the thread after sending what was already published. Spectators stay connected.
+        '''
+        self._stop.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def publish(self, msg: str) -> None:
+        '''
+        Queue msg for every spectator. Safe to call from any thread, and never blocks.
+        '''
+        self._messages.put(msg)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.responder.respond_to_broadcast(SPECTATE_MESSAGE, self.game_name)
+                if self.handler.accept_spectators() and self._last is not None:
+                    self.handler.broadcast_to_spectators(self._last)
+                self._send_published()
+            except OSError as e:
+                dlogger.log_error('Spectator service error: %s', e)
+                return
+        self._send_published()
+
+    def _send_published(self) -> None:
+        while True:
+            try:
+                msg = self._messages.get_nowait()
+            except queue.Empty:
+                break
+            self.handler.broadcast_to_spectators(msg)
+            self._last = msg
+        # Frames that did not fit in a socket buffer last time are sent as the spectators catch up.
+        self.handler.flush_spectators()
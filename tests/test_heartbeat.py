@@ -0,0 +1,133 @@
+'''
+Heartbeat: a peer that stops answering PINGs is detected within timeout + interval.
+Run from the repository root with: python -m pytest tests
+'''
+
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+import lan.multiplayer_game as multiplayer_game
+from lan.connection import Connection
+from lan.heartbeat import Heartbeat
+from lan.multiplayer_game import MultiplayerGame
+
+INTERVAL = 0.05
+TIMEOUT = 0.3
+# Slack for thread scheduling on a busy machine.
+MARGIN = 1.0
+
+
+def connected_pair() -> tuple:
+    '''
+    Returns:
+        Two connected loopback TCP sockets.
+    '''
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        a = socket.create_connection(listener.getsockname())
+        b, _ = listener.accept()
+    return a, b
+
+
+class HeartbeatTest(unittest.TestCase):
+
+    def setUp(self):
+        a, self.peer = connected_pair()
+        self.connection = Connection(ip='127.0.0.1', port=a.getsockname()[1], socket=a)
+        self.addCleanup(self.peer.close)
+        self.addCleanup(self.connection.close_socket)
+
+    def test_silent_peer_is_detected(self):
+        heartbeat = Heartbeat(self.connection, interval=INTERVAL, timeout=TIMEOUT)
+        self.addCleanup(heartbeat.stop)
+        started = time.monotonic()
+        heartbeat.start()
+
+        # The peer never reads or answers, so the PINGs go unanswered.
+        self.assertTrue(heartbeat.disconnected.wait(TIMEOUT + INTERVAL + MARGIN))
+        self.assertGreaterEqual(time.monotonic() - started, TIMEOUT)
+        self.assertTrue(self.connection.closed)
+        counters = self.connection.metrics.snapshot()['counters']
+        self.assertEqual(counters['heartbeat_timeouts']['value'], 1)
+        self.assertGreater(counters['heartbeats_sent']['value'], 0)
+
+    def test_clean_close_is_not_a_timeout(self):
+        heartbeat = Heartbeat(self.connection, interval=INTERVAL, timeout=TIMEOUT)
+        self.addCleanup(heartbeat.stop)
+        heartbeat.start()
+        self.peer.shutdown(socket.SHUT_RDWR)
+
+        self.assertTrue(heartbeat.disconnected.wait(TIMEOUT + INTERVAL + MARGIN))
+        counters = self.connection.metrics.snapshot()['counters']
+        self.assertNotIn('heartbeat_timeouts', counters)
+        self.assertEqual(counters['heartbeat_peer_closed']['value'], 1)
+
+    def test_answering_peer_stays_connected(self):
+        peer = Connection(ip='127.0.0.1', port=self.peer.getsockname()[1], socket=self.peer)
+        heartbeats = [Heartbeat(connection, interval=INTERVAL, timeout=TIMEOUT).start()
+                      for connection in (self.connection, peer)]
+        for heartbeat in heartbeats:
+            self.addCleanup(heartbeat.stop)
+
+        time.sleep(3 * TIMEOUT)
+        for heartbeat in heartbeats:
+            self.assertFalse(heartbeat.disconnected.is_set())
+            self.assertIsNotNone(heartbeat.rtt)
+        self.assertNotIn('heartbeat_timeouts', self.connection.metrics.snapshot()['counters'])
+
+
+class Game(MultiplayerGame):
+    HEARTBEAT_INTERVAL = INTERVAL
+    HEARTBEAT_TIMEOUT = TIMEOUT
+
+    def __init__(self, port: int) -> None:
+        self._port = port
+
+
+class FrozenPeerTest(unittest.TestCase):
+
+    def test_host_gives_up_on_frozen_client(self):
+        with mock.patch.object(multiplayer_game, 'RESUME_TIMEOUT', 0.5):
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                sock.bind(('', 0))
+                port = sock.getsockname()[1]
+            host = Game(port)
+            host.create_host()
+            client = Game(port)
+            result = {}
+
+            def run_host():
+                host.wait_and_connect_client()
+                started = time.monotonic()
+                try:
+                    result['msg'] = host.receive_from_peer()
+                except ConnectionError as e:
+                    result['error'] = e
+                result['elapsed'] = time.monotonic() - started
+
+            thread = threading.Thread(target=run_host, daemon=True)
+            thread.start()
+            try:
+                client.connect_to_host(Connection(ip='127.0.0.1', port=port))
+                # The client freezes: its heartbeat stops and it never reads, but its socket stays open.
+                client.stop_heartbeats()
+                thread.join(TIMEOUT + INTERVAL + 0.5 + MARGIN + 2)
+                self.assertFalse(thread.is_alive())
+            finally:
+                host.stop_heartbeats()
+                host._connection.close_socket()
+                host._broadcast_responder.close_socket()
+                client._connection.close_socket()
+
+        self.assertIsInstance(result.get('error'), ConnectionError)
+        self.assertLess(result['elapsed'], TIMEOUT + INTERVAL + 0.5 + MARGIN)
+        self.assertEqual(host.metrics.snapshot()['counters'].get('sessions_resumed'), None)
+        self.assertEqual(host._connection.metrics.snapshot()['counters']['heartbeat_timeouts']['value'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+'''
+MCTSEngine: proven wins and losses must decide the move, not just the playout statistics.
+Run from the repository root with: python -m pytest tests
+'''
+
+import unittest
+
+from game.bitboard import BitBoard, O, X
+from game.mcts import MCTSEngine
+
+
+def position(x_cells, o_cells, width=7, height=7, win_length=4) -> BitBoard:
+    board = BitBoard(width, height, win_length)
+    for index in x_cells:
+        board.place(index, X)
+    for index in o_cells:
+        board.place(index, O)
+    return board
+
+
+class MCTSSolverTest(unittest.TestCase):
+
+    def test_blocks_a_one_move_win(self):
+        # O has three in a row on the top edge and wins at cell 3 unless X blocks it.
+        board = position([48, 40, 30], [0, 1, 2])
+        for seed in range(3):
+            engine = MCTSEngine(time_limit=None, iterations=3000, seed=seed)
+            self.assertEqual(engine.choose_move(board, X), 3)
+
+    def test_takes_a_win_over_a_block(self):
+        # X wins at 23 or 27. Blocking O at 3 would lose the win.
+        board = position([24, 25, 26, 48], [0, 1, 2, 40])
+        engine = MCTSEngine(time_limit=None, iterations=1000, seed=0)
+        self.assertIn(engine.choose_move(board, X), (23, 27))
+
+    def test_proven_root_stops_the_search(self):
+        board = position([24, 25, 26, 48], [0, 1, 2, 40])
+        engine = MCTSEngine(time_limit=None, iterations=100000, seed=0)
+        engine.choose_move(board, X)
+        self.assertEqual(engine._result[0], X)
+        self.assertLess(engine.last_iterations, 100000)
+
+    def test_full_3x3_self_play_is_a_draw(self):
+        engine = MCTSEngine(time_limit=None, iterations=5000, seed=0)
+        board = BitBoard()
+        player = X
+        while board.winner() is None and not board.is_full():
+            board.place(engine.choose_move(board, player), player)
+            player = 1 - player
+        self.assertIsNone(board.winner())
+
+
+if __name__ == '__main__':
+    unittest.main()
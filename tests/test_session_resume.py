@@ -0,0 +1,162 @@
+'''
+Session resume: after a dropped connection the peers reconnect and replay the messages the other side missed.
+Run from the repository root with: python -m pytest tests
+'''
+
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+import lan.multiplayer_game as multiplayer_game
+from lan.connection import Connection
+from lan.multiplayer_game import MultiplayerGame
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('', 0))
+        return sock.getsockname()[1]
+
+
+class Game(MultiplayerGame):
+    HEARTBEAT_INTERVAL = 0.05
+    HEARTBEAT_TIMEOUT = 0.5
+
+    def __init__(self, port: int) -> None:
+        self._port = port
+
+
+class SessionResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(multiplayer_game, 'RESUME_TIMEOUT', 5.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        port = free_port()
+        self.host = Game(port)
+        self.host.create_host()
+        self.client = Game(port)
+        self.host_received = []
+        self.host_error = None
+        self.addCleanup(self._close)
+
+    def _close(self):
+        self.host.stop_heartbeats()
+        self.client.stop_heartbeats()
+        for client in self.host._connection.get_clients():
+            client.close_socket()
+        self.host._connection.close_socket()
+        self.host._broadcast_responder.close_socket()
+        if getattr(self.client, '_connection', None) is not None and self.client._connection._socket is not None:
+            self.client._connection.close_socket()
+
+    def _run_host(self, script):
+        def run():
+            try:
+                self.host.wait_and_connect_client()
+                script()
+            except Exception as e:
+                self.host_error = e
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def _connect_client(self):
+        self.client.connect_to_host(Connection(ip='127.0.0.1', port=self.host._port))
+        self.assertIsNotNone(self.client._session_token)
+
+    def _finish(self, thread):
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), 'host did not finish')
+        if self.host_error is not None:
+            raise self.host_error
+
+    def test_client_drop_replays_missed_messages_once_in_order(self):
+        client_dropped = threading.Event()
+
+        def host_script():
+            self.host.send_to_peer('h0')
+            self.host_received.append(self.host.receive_from_peer())
+            client_dropped.wait(5)
+            # Sent while the client is gone. They reach it through the resume replay.
+            for msg in ('h1', 'h2', 'h3'):
+                self.host.send_to_peer(msg)
+            self.host_received.extend(self.host.receive_from_peer() for _ in range(2))
+
+        thread = self._run_host(host_script)
+        self._connect_client()
+        client_received = [self.client.receive_from_peer()]
+        self.client.send_to_peer('c0')
+        self.client._connection._socket.shutdown(socket.SHUT_RDWR)
+        client_dropped.set()
+        client_received.extend(self.client.receive_from_peer() for _ in range(3))
+        self.client.send_to_peer('c1')
+        self.client.send_to_peer('c2')
+        self._finish(thread)
+
+        self.assertEqual(client_received, ['h0', 'h1', 'h2', 'h3'])
+        self.assertEqual(self.host_received, ['c0', 'c1', 'c2'])
+        self.assertEqual(self.client.metrics.snapshot()['counters']['sessions_resumed']['value'], 1)
+        self.assertEqual(self.host.metrics.snapshot()['counters']['sessions_resumed']['value'], 1)
+
+    def test_messages_queued_at_the_drop_are_not_replayed(self):
+        client_sent = threading.Event()
+        host_read = threading.Event()
+
+        def host_script():
+            self.host.send_to_peer('h0')
+            client_sent.wait(5)
+            time.sleep(0.2)
+            # c0 and c1 are read off the socket together. c1 is still queued when the connection drops.
+            self.host_received.append(self.host.receive_from_peer())
+            host_read.set()
+            time.sleep(0.2)
+            self.host.send_to_peer('h1')
+            self.host.send_to_peer('h2')
+            self.host_received.extend(self.host.receive_from_peer() for _ in range(2))
+
+        thread = self._run_host(host_script)
+        self._connect_client()
+        client_received = [self.client.receive_from_peer()]
+        self.client.send_to_peer('c0')
+        self.client.send_to_peer('c1')
+        client_sent.set()
+        host_read.wait(5)
+        self.client._connection._socket.shutdown(socket.SHUT_RDWR)
+        client_received.extend(self.client.receive_from_peer() for _ in range(2))
+        self.client.send_to_peer('c2')
+        self._finish(thread)
+
+        self.assertEqual(client_received, ['h0', 'h1', 'h2'])
+        self.assertEqual(self.host_received, ['c0', 'c1', 'c2'])
+
+    def test_host_drop_replays_missed_messages_once_in_order(self):
+        def host_script():
+            self.host.send_to_peer('h0')
+            self.host_received.append(self.host.receive_from_peer())
+            self.host.send_to_peer('h1')
+            # The client's next messages are on their way or not sent yet. Either way each arrives once.
+            self.host._connection.get_clients()[0]._socket.shutdown(socket.SHUT_RDWR)
+            self.host_received.extend(self.host.receive_from_peer() for _ in range(3))
+            self.host.send_to_peer('h2')
+
+        thread = self._run_host(host_script)
+        self._connect_client()
+        client_received = [self.client.receive_from_peer()]
+        self.client.send_to_peer('c0')
+        client_received.append(self.client.receive_from_peer())
+        for msg in ('c1', 'c2', 'c3'):
+            self.client.send_to_peer(msg)
+        client_received.append(self.client.receive_from_peer())
+        self._finish(thread)
+
+        self.assertEqual(client_received, ['h0', 'h1', 'h2'])
+        self.assertEqual(self.host_received, ['c0', 'c1', 'c2', 'c3'])
+        self.assertEqual(self.host.metrics.snapshot()['counters']['sessions_resumed']['value'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()